@@ -0,0 +1,101 @@
+"""
+CPU-bound text extraction and image preprocessing run in worker processes
+by server.py.
+
+Kept apart from server.py so worker processes only import this module and
+its parsers, not the app, its database client or the LLM integrations.
+"""
+import os
+from io import BytesIO
+from typing import Optional
+
+import PyPDF2
+from bs4 import BeautifulSoup
+from PIL import Image, ImageOps
+
+try:
+    import lxml  # noqa: F401  Optional: several times faster than html.parser on large pages
+    DEFAULT_HTML_PARSER = "lxml"
+except ImportError:
+    DEFAULT_HTML_PARSER = "html.parser"
+
+HTML_PARSER = os.environ.get('HTML_PARSER', DEFAULT_HTML_PARSER)
+
+try:
+    from pillow_heif import register_heif_opener  # Optional: lets Pillow open HEIC/HEIF photos from phones
+    register_heif_opener()
+except ImportError:
+    pass
+
+# Elements whose text is page chrome rather than content
+NON_CONTENT_TAGS = ["script", "style", "nav", "footer", "header"]
+
+
+def extract_html_text(content: bytes, encoding: Optional[str], parser: str = HTML_PARSER) -> tuple:
+    """Title and cleaned-up visible text of an HTML page"""
+    soup = BeautifulSoup(content, parser, from_encoding=encoding)
+
+    # Remove script and style elements
+    for element in soup(NON_CONTENT_TAGS):
+        element.decompose()
+
+    # Get text content
+    text = soup.get_text()
+
+    # Clean up text
+    lines = (line.strip() for line in text.splitlines())
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+    text_content = '\n'.join(chunk for chunk in chunks if chunk)
+
+    title = soup.find('title')
+    return (title.string.strip() if title and title.string else None), text_content
+
+
+def pdf_worker_main(conn):
+    """
+    Body of a PDF worker process. Takes one (pdf_bytes, max_pages) document
+    at a time and answers ("count", page_count), one ("page", text) per
+    page as it is extracted, then ("done", None); or ("error", message).
+    The PDF crosses the process boundary once and is parsed once.
+    """
+    while True:
+        try:
+            pdf_bytes, max_pages = conn.recv()
+        except EOFError:
+            return  # The server closed its end
+        try:
+            pdf_reader = PyPDF2.PdfReader(BytesIO(pdf_bytes))
+            page_count = len(pdf_reader.pages)
+            conn.send(("count", page_count))
+            for page_num in range(min(page_count, max_pages)):
+                conn.send(("page", pdf_reader.pages[page_num].extract_text() or ""))
+            conn.send(("done", None))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+def normalize_image(data: bytes, max_long_side: int, max_short_side: int, quality: int) -> tuple:
+    """
+    Downscale to what the vision model actually looks at, drop metadata and
+    re-encode as JPEG. Returns (jpeg bytes, width, height).
+    """
+    with Image.open(BytesIO(data)) as image:
+        scale = min(1.0, max_long_side / max(image.size), max_short_side / min(image.size))
+        target = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        # JPEGs can be decoded straight at a fraction of full size, which is most of the work saved
+        image.draft("RGB", target)
+        # Bake in the orientation before the EXIF block that carries it is dropped
+        image = ImageOps.exif_transpose(image)
+        if scale < 1.0:
+            scale = min(1.0, max_long_side / max(image.size), max_short_side / min(image.size))
+            image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
+        if image.mode in ("RGBA", "LA", "P", "PA"):
+            # JPEG has no alpha; flatten onto white the way a viewer would show it
+            rgba = image.convert("RGBA")
+            image = Image.new("RGB", rgba.size, "white")
+            image.paste(rgba, mask=rgba.getchannel("A"))
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        out = BytesIO()
+        image.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+        return out.getvalue(), image.width, image.height
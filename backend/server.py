@@ -1,68 +1,1142 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends
-from fastapi.responses import Response
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Request
+from fastapi.responses import Response, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.datastructures import UploadFile as StarletteUploadFile
+from starlette.formparsers import MultiPartException, MultiPartParser
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from gridfs.errors import NoFile
+from pymongo import ReturnDocument, UpdateMany, UpdateOne, monitoring
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError, ExecutionTimeout, OperationFailure, PyMongoError
 import os
 import logging
 import asyncio
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional, Dict, Any
+from collections import OrderedDict, deque
+from pydantic import BaseModel, Field, ConfigDict, TypeAdapter
+from typing import List, Optional, Dict, Any, Awaitable, Callable, TypeVar
 import uuid
-from datetime import datetime, timezone
+import time
+import threading
+from contextvars import ContextVar
+from datetime import datetime, timezone, timedelta
 from emergentintegrations.llm.chat import LlmChat, UserMessage, ImageContent
 from emergentintegrations.llm.openai.image_generation import OpenAIImageGeneration
 from emergentintegrations.llm.openai import OpenAITextToSpeech
 import random
+import re
+import html
 import base64
 import hashlib
+import hmac
+import json
+import tempfile
+import mimetypes
+import gzip
+import zlib
+import bson
+from bson.binary import Binary
+from bson.codec_options import CodecOptions
 from reportlab.lib.pagesizes import letter
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
 from reportlab.lib.units import inch
 from io import BytesIO
-import PyPDF2
-import requests
-from bs4 import BeautifulSoup
+import httpx
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from extraction import HTML_PARSER, extract_html_text, normalize_image, pdf_worker_main
+
+try:
+    import zstandard  # Optional: better ratio and speed than gzip/zlib for archives and message bodies
+except ImportError:
+    zstandard = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+class LatencyStats:
+    """Running count / mean / max of an operation's latency in milliseconds"""
+    
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_ms = 0.0
+    
+    def record(self, elapsed_ms: float):
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.last_ms = elapsed_ms
+    
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 2) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 2),
+            "last_ms": round(self.last_ms, 2),
+        }
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """
+    Per-command latency and slow-operation log fed by pymongo's command
+    monitoring. Events arrive on Motor's executor threads, hence the lock.
+    """
+    
+    def __init__(self, slow_ms: float):
+        self.slow_ms = slow_ms
+        self._lock = threading.Lock()
+        self._commands: Dict[str, LatencyStats] = {}
+        self._failures: Dict[str, int] = {}
+        self._targets: Dict[int, str] = {}  # request_id -> collection name
+        self.slow_operations = deque(maxlen=50)
+    
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        with self._lock:
+            self._targets[event.request_id] = target if isinstance(target, str) else event.database_name
+    
+    def _finished(self, event, failed: bool):
+        elapsed_ms = event.duration_micros / 1000
+        with self._lock:
+            target = self._targets.pop(event.request_id, None)
+            self._commands.setdefault(event.command_name, LatencyStats()).record(elapsed_ms)
+            if failed:
+                self._failures[event.command_name] = self._failures.get(event.command_name, 0) + 1
+            if elapsed_ms >= self.slow_ms:
+                self.slow_operations.append({
+                    "command": event.command_name,
+                    "collection": target,
+                    "duration_ms": round(elapsed_ms, 2),
+                    "failed": failed,
+                    "at": datetime.now(timezone.utc).isoformat(),
+                })
+        if elapsed_ms >= self.slow_ms:
+            logging.warning(f"Slow MongoDB {event.command_name} on {target}: {elapsed_ms:.1f}ms")
+    
+    def succeeded(self, event):
+        self._finished(event, failed=False)
+    
+    def failed(self, event):
+        self._finished(event, failed=True)
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "slow_threshold_ms": self.slow_ms,
+                "commands": {
+                    name: {**latency.snapshot(), "failures": self._failures.get(name, 0)}
+                    for name, latency in self._commands.items()
+                },
+                "slow_operations": list(self.slow_operations),
+            }
+
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    """Connection pool occupancy and checkout wait times"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()  # checkout start time; a checkout begins and ends on one thread
+        self.checkout_wait = LatencyStats()
+        self.checkout_failures: Dict[str, int] = {}
+        self.open_connections = 0
+        self.checked_out = 0
+        self.pool_clears = 0
+    
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+    
+    def connection_checked_out(self, event):
+        started = getattr(self._local, 'started', None)
+        with self._lock:
+            self.checked_out += 1
+            if started is not None:
+                self.checkout_wait.record((time.perf_counter() - started) * 1000)
+    
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures[str(event.reason)] = self.checkout_failures.get(str(event.reason), 0) + 1
+    
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+    
+    def connection_created(self, event):
+        with self._lock:
+            self.open_connections += 1
+    
+    def connection_closed(self, event):
+        with self._lock:
+            self.open_connections -= 1
+    
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pool_clears += 1
+    
+    def connection_ready(self, event):
+        pass
+    
+    def pool_created(self, event):
+        pass
+    
+    def pool_ready(self, event):
+        pass
+    
+    def pool_closed(self, event):
+        pass
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "open_connections": self.open_connections,
+                "checked_out": self.checked_out,
+                "checkout_wait": self.checkout_wait.snapshot(),
+                "checkout_failures": dict(self.checkout_failures),
+                "pool_clears": self.pool_clears,
+            }
+
+def _write_concern_from_env(value: str):
+    return int(value) if value.isdigit() else value
+
+# Pool sizing, timeouts, read preference and write concern are set per environment via .env
+MONGO_CLIENT_OPTIONS = {
+    "serverSelectionTimeoutMS": int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000')),
+    "connectTimeoutMS": int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', '10000')),
+    "socketTimeoutMS": int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', '45000')),
+    "waitQueueTimeoutMS": int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', '10000')),  # Max wait for a free pooled connection
+    "maxPoolSize": int(os.environ.get('MONGO_MAX_POOL_SIZE', '100')),
+    "minPoolSize": int(os.environ.get('MONGO_MIN_POOL_SIZE', '5')),
+    "maxIdleTimeMS": int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', '300000')),
+    "readPreference": os.environ.get('MONGO_READ_PREFERENCE', 'primary'),
+    "w": _write_concern_from_env(os.environ.get('MONGO_WRITE_CONCERN', 'majority')),
+    # Wire compression; the server picks the first codec it also supports (empty disables)
+    "compressors": os.environ.get('MONGO_COMPRESSORS', "zstd,zlib" if zstandard else "zlib"),
+}
+if not MONGO_CLIENT_OPTIONS["compressors"]:
+    del MONGO_CLIENT_OPTIONS["compressors"]
+
+mongo_command_metrics = MongoCommandMetrics(slow_ms=float(os.environ.get('MONGO_SLOW_OP_MS', '100')))
+mongo_pool_metrics = MongoPoolMetrics()
+
 mongo_url = os.environ['MONGO_URL']
 # Configure MongoDB client with proper timeouts for Atlas deployment
 client = AsyncIOMotorClient(
     mongo_url,
-    serverSelectionTimeoutMS=5000,  # 5 seconds to select server
-    connectTimeoutMS=10000,  # 10 seconds to establish connection
-    socketTimeoutMS=45000,  # 45 seconds for socket operations
-    maxPoolSize=10,  # Maximum connection pool size
-    minPoolSize=1,  # Minimum connection pool size
     retryWrites=True,  # Enable retryable writes
     retryReads=True,  # Enable retryable reads
-    w='majority',  # Write concern
+    tz_aware=True,  # Return stored BSON dates as timezone-aware UTC datetimes
+    event_listeners=[mongo_command_metrics, mongo_pool_metrics],
+    **MONGO_CLIENT_OPTIONS,
 )
 db = client[os.environ['DB_NAME']]
 
+READ_PREFERENCE_MODES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+# Mongo rejects maxStalenessSeconds below 90
+READ_MAX_STALENESS_SECONDS = max(90, int(os.environ.get('READ_MAX_STALENESS_SECONDS', '90')))
+# After a write, reads of the same key stay on the primary for this long
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('READ_YOUR_WRITES_SECONDS', str(READ_MAX_STALENESS_SECONDS)))
+
+def _read_routing(endpoint: str) -> dict:
+    """READ_PREFERENCE_<ENDPOINT> / READ_CONCERN_<ENDPOINT>, e.g. READ_PREFERENCE_GET_MESSAGES=secondaryPreferred"""
+    mode = os.environ.get(f'READ_PREFERENCE_{endpoint.upper()}', 'primary')
+    if mode not in READ_PREFERENCE_MODES:
+        raise ValueError(f"Unknown read preference {mode!r} for {endpoint}")
+    read_preference = Primary() if mode == "primary" else READ_PREFERENCE_MODES[mode](max_staleness=READ_MAX_STALENESS_SECONDS)
+    read_concern = ReadConcern(os.environ.get(f'READ_CONCERN_{endpoint.upper()}', 'local'))
+    return {"read_preference": read_preference, "read_concern": read_concern}
+
+# Pure-read endpoints that may be served by secondaries
+READ_ROUTING = {
+    endpoint: _read_routing(endpoint)
+    for endpoint in ("get_personas", "get_conversations", "get_messages", "export_pdf")
+}
+
+_recent_writes: Dict[str, float] = {}
+
+def note_write(*keys: str):
+    """Record a write so follow-up reads of these keys read their own writes from the primary"""
+    now = time.monotonic()
+    for key in keys:
+        _recent_writes[key] = now
+        for coalescer in SingleFlight.instances:
+            coalescer.invalidate(key)
+    if len(_recent_writes) > 10000:
+        for key, written_at in list(_recent_writes.items()):
+            if now - written_at > READ_YOUR_WRITES_SECONDS:
+                del _recent_writes[key]
+
+def read_collection(name: str, endpoint: str, key: Optional[str] = None, fresh: bool = False):
+    """
+    Collection handle carrying the endpoint's read preference and read
+    concern. Falls back to the primary when the caller asks for fresh data
+    or wrote to `key` within the read-your-writes window.
+    """
+    written_at = _recent_writes.get(key) if key else None
+    if fresh or (written_at is not None and time.monotonic() - written_at < READ_YOUR_WRITES_SECONDS):
+        return db[name]
+    return db[name].with_options(**READ_ROUTING[endpoint])
+
+T = TypeVar("T")
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent reads. The first caller for a key runs
+    the loader in its own task; everyone arriving while it is in flight
+    awaits that task and gets the same result (serialized bytes for the list
+    endpoints, whatever the loader returns elsewhere). With ttl_seconds > 0
+    the result is also reused for that long. Keys are (scope, variant) where
+    scope is a note_write() key, so every write drops the scope's entries.
+    """
+    
+    instances: List["SingleFlight"] = []
+    
+    def __init__(self, ttl_seconds: float = 0.0, max_scopes: int = 1000):
+        self.ttl_seconds = ttl_seconds
+        self.max_scopes = max_scopes
+        self._inflight: Dict[str, Dict[Any, asyncio.Task]] = {}
+        self._results: "OrderedDict[str, Dict[Any, tuple]]" = OrderedDict()  # scope -> {variant: (body, loaded_at)}
+        self.requests = 0
+        self.loads = 0
+        self.coalesced = 0
+        self.hits = 0
+        SingleFlight.instances.append(self)
+    
+    async def run(self, scope: str, variant: Any, loader: Callable[[], Awaitable[T]]) -> T:
+        self.requests += 1
+        cached = self._results.get(scope, {}).get(variant)
+        if cached and time.monotonic() - cached[1] < self.ttl_seconds:
+            self.hits += 1
+            return cached[0]
+        
+        task = self._inflight.get(scope, {}).get(variant)
+        if task is None:
+            self.loads += 1
+            task = asyncio.ensure_future(loader())
+            self._inflight.setdefault(scope, {})[variant] = task
+            task.add_done_callback(lambda done: self._finish(scope, variant, done))
+        else:
+            self.coalesced += 1
+        # Shielded so a disconnecting client doesn't cancel the read for everyone else
+        return await asyncio.shield(task)
+    
+    def _finish(self, scope: str, variant: Any, task: asyncio.Task):
+        flights = self._inflight.get(scope)
+        if not flights or flights.get(variant) is not task:
+            return  # Invalidated while in flight; don't keep a result that predates the write
+        del flights[variant]
+        if not flights:
+            del self._inflight[scope]
+        if task.cancelled() or task.exception() is not None or self.ttl_seconds <= 0:
+            return
+        self._results.setdefault(scope, {})[variant] = (task.result(), time.monotonic())
+        self._results.move_to_end(scope)
+        while len(self._results) > self.max_scopes:
+            self._results.popitem(last=False)
+    
+    def invalidate(self, scope: str):
+        self._inflight.pop(scope, None)
+        self._results.pop(scope, None)
+    
+    def stats(self) -> dict:
+        shared = self.coalesced + self.hits
+        return {
+            "requests": self.requests,
+            "loads": self.loads,
+            "coalesced": self.coalesced,
+            "cache_hits": self.hits,
+            "coalescing_ratio": round(shared / self.requests, 4) if self.requests else 0.0,
+            "in_flight": sum(len(flights) for flights in self._inflight.values()),
+            "ttl_seconds": self.ttl_seconds,
+        }
+
+# Optional micro-TTL on top of in-flight sharing; 0 only shares reads that overlap
+READ_COALESCE_TTL_SECONDS = float(os.environ.get('READ_COALESCE_TTL_MS', '0')) / 1000
+persona_list_reads = SingleFlight(ttl_seconds=READ_COALESCE_TTL_SECONDS)
+message_list_reads = SingleFlight(ttl_seconds=READ_COALESCE_TTL_SECONDS)
+
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
 
-# Add retry wrapper for database operations
-async def retry_db_operation(operation, max_retries=3, initial_delay=1.0):
+# Server error codes that mean "try again": network trouble, elections, shutdowns
+RETRYABLE_DB_ERROR_CODES = {
+    6,      # HostUnreachable
+    7,      # HostNotFound
+    89,     # NetworkTimeout
+    91,     # ShutdownInProgress
+    134,    # ReadConcernMajorityNotAvailableYet
+    189,    # PrimarySteppedDown
+    262,    # ExceededTimeLimit
+    9001,   # SocketException
+    10107,  # NotWritablePrimary
+    11600,  # InterruptedAtShutdown
+    11602,  # InterruptedDueToReplStateChange
+    13435,  # NotPrimaryNoSecondaryOk
+    13436,  # NotPrimaryOrSecondary
+}
+
+DB_RETRY_ATTEMPTS = int(os.environ.get('DB_RETRY_ATTEMPTS', '3'))
+DB_RETRY_BASE_DELAY = float(os.environ.get('DB_RETRY_BASE_DELAY_SECONDS', '0.2'))
+DB_RETRY_MAX_DELAY = float(os.environ.get('DB_RETRY_MAX_DELAY_SECONDS', '2.0'))
+REQUEST_DEADLINE_SECONDS = float(os.environ.get('REQUEST_DEADLINE_SECONDS', '60'))
+
+# Monotonic deadline of the request being served; None outside requests (background jobs)
+request_deadline: ContextVar[Optional[float]] = ContextVar('request_deadline', default=None)
+
+db_retry_stats = {
+    "calls": 0,
+    "retries": 0,
+    "recovered": 0,
+    "exhausted": 0,
+    "permanent_failures": 0,
+    "deadline_exceeded": 0,
+    "retries_by_error": {},
+}
+
+def extend_request_deadline(seconds: float):
+    """Long-running handlers (autorun, multi-round discussion) widen the retry deadline"""
+    request_deadline.set(time.monotonic() + seconds)
+
+def is_retryable_db_error(error: Exception) -> bool:
+    """Transient network / failover errors are retryable; everything else is permanent"""
+    if isinstance(error, ConnectionFailure):
+        # AutoReconnect, NotPrimaryError, NetworkTimeout, ServerSelectionTimeoutError, WaitQueueTimeoutError
+        return True
+    if isinstance(error, PyMongoError) and (
+        error.has_error_label("RetryableWriteError") or error.has_error_label("TransientTransactionError")
+    ):
+        return True
+    if isinstance(error, OperationFailure) and error.code in RETRYABLE_DB_ERROR_CODES:
+        return True
+    return False
+
+async def retry_db_operation(operation, max_retries=None, initial_delay=None):
     """
-    Retry wrapper for database operations with exponential backoff.
-    Helps handle transient network issues during Atlas MongoDB connections.
+    Run a database call with retries for transient errors.
+    Uses exponential backoff with full jitter, gives up immediately on
+    permanent errors (validation, duplicate keys, auth...) and never sleeps
+    past the current request's deadline. Only pass reads and idempotent
+    writes: the operation may run more than once.
     """
+    max_retries = max_retries or DB_RETRY_ATTEMPTS
+    initial_delay = initial_delay or DB_RETRY_BASE_DELAY
+    db_retry_stats["calls"] += 1
+    
     for attempt in range(max_retries):
         try:
-            return await operation()
+            result = await operation()
+            if attempt > 0:
+                db_retry_stats["recovered"] += 1
+            return result
         except Exception as e:
+            if not is_retryable_db_error(e):
+                db_retry_stats["permanent_failures"] += 1
+                raise
             if attempt == max_retries - 1:
+                db_retry_stats["exhausted"] += 1
                 raise
-            delay = initial_delay * (2 ** attempt)
-            logging.warning(f"Database operation failed (attempt {attempt + 1}/{max_retries}), retrying in {delay}s: {str(e)}")
+            
+            delay = random.uniform(0, min(DB_RETRY_MAX_DELAY, initial_delay * (2 ** attempt)))
+            deadline = request_deadline.get()
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                db_retry_stats["deadline_exceeded"] += 1
+                raise
+            
+            error_name = type(e).__name__
+            db_retry_stats["retries"] += 1
+            db_retry_stats["retries_by_error"][error_name] = db_retry_stats["retries_by_error"].get(error_name, 0) + 1
+            logging.warning(f"Database operation failed (attempt {attempt + 1}/{max_retries}), retrying in {delay:.2f}s: {str(e)}")
             await asyncio.sleep(delay)
 
+@app.middleware("http")
+async def set_request_deadline(request, call_next):
+    token = request_deadline.set(time.monotonic() + REQUEST_DEADLINE_SECONDS)
+    try:
+        return await call_next(request)
+    finally:
+        request_deadline.reset(token)
+
+# Filter for conversations that haven't been tombstoned by delete_conversation
+NOT_DELETED = {"deleted_at": {"$exists": False}}
+
+ARCHIVE_CODEC = "zstd" if zstandard else "gzip"
+ARCHIVE_MAX_BYTES = 15 * 1024 * 1024  # Stay clear of Mongo's 16MB document limit
+ARCHIVE_CODEC_OPTIONS = CodecOptions(tz_aware=True)
+ARCHIVE_CLAIM_TIMEOUT_SECONDS = 600  # An archiving pass holding a conversation longer than this has died
+ARCHIVE_RESTORE_WAIT_SECONDS = 30  # How long a reader waits for a running archiving pass before giving up
+
+archive_stats = {
+    "conversations_archived": 0,
+    "messages_archived": 0,
+    "raw_bytes": 0,
+    "compressed_bytes": 0,
+    "rehydrations": 0,
+}
+rehydration_latency = LatencyStats()
+_rehydrations: Dict[str, asyncio.Task] = {}
+
+def compress_archive(messages: List[dict], codec: str) -> tuple:
+    raw = bson.encode({"messages": messages})
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=10).compress(raw), len(raw)
+    return gzip.compress(raw, compresslevel=6), len(raw)
+
+def decompress_archive(data: bytes, codec: str) -> List[dict]:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read this archive")
+        raw = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        raw = gzip.decompress(data)
+    return bson.decode(raw, codec_options=ARCHIVE_CODEC_OPTIONS)["messages"]
+
+MESSAGE_COMPRESSION_ENABLED = os.environ.get('MESSAGE_COMPRESSION_ENABLED', 'false').lower() == 'true'
+MESSAGE_COMPRESSION_MIN_BYTES = int(os.environ.get('MESSAGE_COMPRESSION_MIN_BYTES', '4096'))
+MESSAGE_COMPRESSION_PREVIEW_CHARS = 512  # Plain-text head left in `content` for the text index and search snippets
+MESSAGE_CODEC = "zstd" if zstandard else "zlib"
+
+message_compression_stats = {
+    "compressed": 0,
+    "raw_bytes": 0,
+    "stored_bytes": 0,
+    "compress_ms": 0.0,
+    "inflated": 0,
+    "inflate_ms": 0.0,
+}
+
+def compress_body(text: str, codec: str) -> bytes:
+    raw = text.encode("utf-8")
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(raw)
+    return zlib.compress(raw, 6)
+
+def decompress_body(data: bytes, codec: str) -> str:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read this message")
+        raw = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        raw = zlib.decompress(data)
+    return raw.decode("utf-8")
+
+def deflate_message(doc: dict) -> dict:
+    """
+    Storage form of a message document. Bodies over the threshold move into
+    content_compressed with a content_codec marker, keeping only a short
+    preview in content; everything else is returned untouched.
+    """
+    content = doc.get('content')
+    if not MESSAGE_COMPRESSION_ENABLED or not isinstance(content, str):
+        return doc
+    raw_bytes = len(content.encode("utf-8"))
+    if raw_bytes < MESSAGE_COMPRESSION_MIN_BYTES:
+        return doc
+    
+    started = time.perf_counter()
+    data = compress_body(content, MESSAGE_CODEC)
+    message_compression_stats["compress_ms"] += (time.perf_counter() - started) * 1000
+    if len(data) > raw_bytes * 0.9:
+        return doc  # Not worth a decompression on every read
+    
+    message_compression_stats["compressed"] += 1
+    message_compression_stats["raw_bytes"] += raw_bytes
+    message_compression_stats["stored_bytes"] += len(data)
+    return {
+        **doc,
+        "content": content[:MESSAGE_COMPRESSION_PREVIEW_CHARS],
+        "content_compressed": Binary(data),
+        "content_codec": MESSAGE_CODEC,
+    }
+
+def inflate_message(doc: dict) -> dict:
+    """Restore the full body of a message stored by deflate_message, in place"""
+    codec = doc.pop('content_codec', None)
+    if codec is None:
+        return doc
+    started = time.perf_counter()
+    doc['content'] = decompress_body(bytes(doc.pop('content_compressed')), codec)
+    message_compression_stats["inflate_ms"] += (time.perf_counter() - started) * 1000
+    message_compression_stats["inflated"] += 1
+    return doc
+
+async def archive_conversation(conversation_id: str, cutoff: datetime) -> bool:
+    """
+    Compact one inactive conversation's messages into a single compressed
+    document in db.message_archives and remove the individual messages.
+    Conversations with forks are skipped since the forks read their history.
+    
+    The conversation is claimed first (archiving_at), so readers wait for the
+    pass to finish instead of restoring underneath it; the messages are only
+    deleted once the archive is written and the claim still holds.
+    """
+    if await retry_db_operation(lambda: db.conversations.find_one({"fork_lineage.conversation_id": conversation_id}, {"_id": 1})):
+        return False
+    
+    claimed_at = datetime.now(timezone.utc)
+    claim = await retry_db_operation(lambda: db.conversations.update_one(
+        {"id": conversation_id, **archivable_filter(cutoff)},
+        {"$set": {"archiving_at": claimed_at}}
+    ))
+    if claim.matched_count == 0:
+        return False
+    
+    async def release():
+        await retry_db_operation(lambda: db.message_archives.delete_one({"conversation_id": conversation_id, "archived_at": claimed_at}))
+        await retry_db_operation(lambda: db.conversations.update_one(
+            {"id": conversation_id, "archiving_at": claimed_at}, {"$unset": {"archiving_at": ""}}
+        ))
+    
+    try:
+        messages = await retry_db_operation(lambda: db.messages.find({"conversation_id": conversation_id}).sort("timestamp", 1).to_list(None))
+        if not messages:
+            await release()
+            return False
+        
+        loop = asyncio.get_running_loop()
+        data, raw_bytes = await loop.run_in_executor(None, compress_archive, messages, ARCHIVE_CODEC)
+        if len(data) > ARCHIVE_MAX_BYTES:
+            logger.warning(f"Skipping archive of {conversation_id}: {len(data)} bytes compressed is too large")
+            await release()
+            return False
+        
+        await retry_db_operation(lambda: db.message_archives.replace_one(
+            {"conversation_id": conversation_id},
+            {
+                "conversation_id": conversation_id,
+                "codec": ARCHIVE_CODEC,
+                "data": Binary(data),
+                "message_count": len(messages),
+                "raw_bytes": raw_bytes,
+                "compressed_bytes": len(data),
+                "archived_at": claimed_at,
+            },
+            upsert=True
+        ))
+        
+        # Back off if somebody wrote to the conversation while we were compressing
+        untouched = await retry_db_operation(lambda: db.conversations.find_one(
+            {"id": conversation_id, "archiving_at": claimed_at, "updated_at": {"$lt": cutoff}, **NOT_DELETED}, {"_id": 1}
+        ))
+        if not untouched:
+            await release()
+            return False
+    except BaseException:
+        await release()
+        raise
+    
+    # From here on the archive is the only full copy; if this pass dies the claim goes stale
+    # and resume_stale_archives() restores from the archive
+    await retry_db_operation(lambda: db.messages.delete_many({"_id": {"$in": [m['_id'] for m in messages]}}))
+    await retry_db_operation(lambda: db.conversations.update_one(
+        {"id": conversation_id, "archiving_at": claimed_at},
+        {"$set": {"archived_at": claimed_at}, "$unset": {"archiving_at": ""}}
+    ))
+    
+    archive_stats["conversations_archived"] += 1
+    archive_stats["messages_archived"] += len(messages)
+    archive_stats["raw_bytes"] += raw_bytes
+    archive_stats["compressed_bytes"] += len(data)
+    return True
+
+def archivable_filter(cutoff: datetime) -> dict:
+    return {
+        "updated_at": {"$lt": cutoff},
+        "archived_at": {"$exists": False},
+        "archiving_at": {"$exists": False},
+        # Opening an archived conversation doesn't touch updated_at; without this every
+        # visit would be followed by another decompress, reinsert, recompress cycle
+        "rehydrated_at": {"$not": {"$gte": cutoff}},
+        # Bucketed conversations are already compact and stay where they are
+        "storage": {"$ne": "bucket"},
+        **NOT_DELETED,
+    }
+
+async def resume_stale_archives(limit: int = 100) -> int:
+    """Put back the messages of archiving passes that died between deleting them and finishing"""
+    stale_before = datetime.now(timezone.utc) - timedelta(seconds=ARCHIVE_CLAIM_TIMEOUT_SECONDS)
+    stale = await retry_db_operation(lambda: db.conversations.find(
+        {"archiving_at": {"$lt": stale_before}}, {"_id": 0, "id": 1}
+    ).limit(limit).to_list(limit))
+    for conv in stale:
+        try:
+            await rehydrate_conversation(conv['id'])
+        except Exception as e:
+            logger.error(f"Failed to recover interrupted archive of {conv['id']}: {e}")
+    return len(stale)
+
+async def archive_inactive_conversations(inactive_days: int, limit: int = 100) -> int:
+    await resume_stale_archives(limit)
+    
+    cutoff = datetime.now(timezone.utc) - timedelta(days=inactive_days)
+    candidates = await retry_db_operation(lambda: db.conversations.find(
+        archivable_filter(cutoff), {"_id": 0, "id": 1}
+    ).limit(limit).to_list(limit))
+    
+    archived = 0
+    for conv in candidates:
+        try:
+            if await archive_conversation(conv['id'], cutoff):
+                archived += 1
+        except Exception as e:
+            logger.error(f"Failed to archive conversation {conv['id']}: {e}")
+    return archived
+
+def is_archived(conv: dict) -> bool:
+    """Archived, or being archived right now; either way its messages go through rehydrate_conversation"""
+    return bool(conv.get('archived_at') or conv.get('archiving_at'))
+
+async def _wait_for_archive_state(conversation_id: str) -> Optional[dict]:
+    """
+    The conversation once no archiving pass is running on it (or the pass
+    has gone stale), None if it's gone. Restoring while a pass is still
+    running could hand it messages it is about to delete.
+    """
+    deadline = time.monotonic() + ARCHIVE_RESTORE_WAIT_SECONDS
+    while True:
+        conv = await retry_db_operation(lambda: db.conversations.find_one(
+            {"id": conversation_id}, {"_id": 0, "archived_at": 1, "archiving_at": 1}
+        ))
+        archiving_at = (conv or {}).get('archiving_at')
+        if archiving_at is None:
+            return conv
+        if datetime.now(timezone.utc) - archiving_at > timedelta(seconds=ARCHIVE_CLAIM_TIMEOUT_SECONDS):
+            return conv  # The pass died; restore from whatever it archived
+        if time.monotonic() >= deadline:
+            raise HTTPException(status_code=503, detail="Conversation is being archived, try again shortly")
+        await asyncio.sleep(0.25)
+
+async def _restore_archive(conversation_id: str) -> bool:
+    conv = await _wait_for_archive_state(conversation_id)
+    if not conv or not is_archived(conv):
+        return False
+    # Only the state we saw is cleared, so a newer archiving pass is never undone by this one
+    state = {"archived_at": conv['archived_at']} if conv.get('archived_at') else {"archiving_at": conv['archiving_at']}
+    
+    started = time.perf_counter()
+    archive = await retry_db_operation(lambda: db.message_archives.find_one({"conversation_id": conversation_id}))
+    if archive:
+        loop = asyncio.get_running_loop()
+        messages = await loop.run_in_executor(None, decompress_archive, bytes(archive['data']), archive['codec'])
+        try:
+            await db.messages.insert_many(messages, ordered=False)
+        except BulkWriteError as e:
+            # Original _ids are kept, so duplicates just mean another worker restored them first
+            if any(err.get('code') != 11000 for err in e.details.get('writeErrors', [])):
+                raise
+        
+        # The archive may be the only copy left; keep it until every message is verifiably back
+        restored = await retry_db_operation(lambda: db.messages.count_documents(
+            {"_id": {"$in": [m['_id'] for m in messages]}}
+        ))
+        if restored < len(messages):
+            raise RuntimeError(f"Only {restored} of {len(messages)} archived messages of {conversation_id} were restored")
+    
+    await retry_db_operation(lambda: db.conversations.update_one(
+        {"id": conversation_id, **state},
+        {"$unset": {"archived_at": "", "archiving_at": ""}, "$set": {"rehydrated_at": datetime.now(timezone.utc)}}
+    ))
+    if archive:
+        await retry_db_operation(lambda: db.message_archives.delete_one(
+            {"conversation_id": conversation_id, "archived_at": archive['archived_at']}
+        ))
+    
+    rehydration_latency.record((time.perf_counter() - started) * 1000)
+    archive_stats["rehydrations"] += 1
+    return True
+
+async def rehydrate_conversation(conversation_id: str) -> bool:
+    """Move an archived conversation's messages back into db.messages; concurrent callers share one restore"""
+    task = _rehydrations.get(conversation_id)
+    if task is None:
+        task = asyncio.ensure_future(_restore_archive(conversation_id))
+        _rehydrations[conversation_id] = task
+        task.add_done_callback(lambda _: _rehydrations.pop(conversation_id, None))
+    return await asyncio.shield(task)
+
+# "document" stores one document per message; "bucket" packs up to
+# MESSAGE_BUCKET_SIZE messages per message_buckets document. The mode is
+# stamped on each conversation when it is created, so switching it only
+# affects new conversations.
+MESSAGE_STORAGE_MODE = os.environ.get('MESSAGE_STORAGE_MODE', 'document')
+MESSAGE_BUCKET_SIZE = int(os.environ.get('MESSAGE_BUCKET_SIZE', '200'))
+
+bucket_stats = {
+    "appends": 0,
+    "messages_appended": 0,
+    "buckets_opened": 0,
+}
+
+async def append_to_bucket(conversation_id: str, docs: List[dict]):
+    """
+    Append messages to the conversation's newest bucket with a single $push,
+    opening the next bucket once it is full. A batch always lands in one
+    bucket, so a bucket can overshoot the size by less than a batch.
+    """
+    for _ in range(5):
+        bucket = await db.message_buckets.find_one_and_update(
+            {"conversation_id": conversation_id, "count": {"$lt": MESSAGE_BUCKET_SIZE}},
+            {
+                "$push": {"messages": {"$each": docs}},
+                "$inc": {"count": len(docs)},
+                "$max": {"last_timestamp": docs[-1]['timestamp']},
+            },
+            sort=[("seq", -1)],
+            projection={"_id": 1}
+        )
+        if bucket:
+            break
+        
+        newest = await retry_db_operation(lambda: db.message_buckets.find_one(
+            {"conversation_id": conversation_id}, {"_id": 0, "seq": 1}, sort=[("seq", -1)]
+        ))
+        try:
+            await db.message_buckets.insert_one({
+                "conversation_id": conversation_id,
+                "seq": newest['seq'] + 1 if newest else 0,
+                "count": len(docs),
+                "first_timestamp": docs[0]['timestamp'],
+                "last_timestamp": docs[-1]['timestamp'],
+                "messages": docs,
+            })
+            bucket_stats["buckets_opened"] += 1
+            break
+        except DuplicateKeyError:
+            continue  # Another writer opened that bucket first; append to it instead
+    else:
+        raise RuntimeError(f"Could not append to a message bucket of {conversation_id}")
+    
+    bucket_stats["appends"] += 1
+    bucket_stats["messages_appended"] += len(docs)
+
+async def store_messages(conversation_id: str, docs: List[dict], storage: Optional[str], owner_id: Optional[str] = None):
+    """
+    Write message documents (already in storage form) using the conversation's
+    layout. Message documents carry the conversation owner's user_id so search
+    can scope by owner without first listing the owner's conversations.
+    """
+    if storage == "bucket":
+        await append_to_bucket(conversation_id, docs)
+        return
+    docs = [{**doc, "user_id": owner_id} for doc in docs]
+    if len(docs) == 1:
+        await db.messages.insert_one(docs[0])
+    else:
+        await db.messages.insert_many(docs, ordered=True)
+
+async def count_bucketed_messages(conversation_id: str) -> int:
+    """Messages a conversation holds in message_buckets; counted by array size since $pull doesn't update count"""
+    totals = await retry_db_operation(lambda: db.message_buckets.aggregate([
+        {"$match": {"conversation_id": conversation_id}},
+        {"$group": {"_id": None, "messages": {"$sum": {"$size": "$messages"}}}},
+    ]).to_list(1))
+    return totals[0]['messages'] if totals else 0
+
+async def discard_messages(conversation_id: str, message_ids: List[str], storage: Optional[str]):
+    """Remove specific messages written by store_messages"""
+    if storage == "bucket":
+        await retry_db_operation(lambda: db.message_buckets.update_many(
+            {"conversation_id": conversation_id}, {"$pull": {"messages": {"id": {"$in": message_ids}}}}
+        ))
+    else:
+        await retry_db_operation(lambda: db.messages.delete_many({"id": {"$in": message_ids}}))
+
+async def _read_messages(conversation_id: str, limit: int, endpoint: Optional[str], fresh: bool, bucketed: bool,
+                         until: Optional[datetime] = None, newest: bool = False) -> List[dict]:
+    """The conversation's own messages in timestamp order, optionally only those up to `until`.
+
+    Returns the first `limit` of them, or the last `limit` when `newest` is set.
+    """
+    direction = -1 if newest else 1
+    if not bucketed:
+        query: Dict[str, Any] = {"conversation_id": conversation_id}
+        if until is not None:
+            query["timestamp"] = {"$lte": until}
+        messages_collection = read_collection("messages", endpoint, key=conversation_id, fresh=fresh) if endpoint else db.messages
+        messages = await retry_db_operation(lambda: messages_collection.find(query, {"_id": 0, "user_id": 0}).sort("timestamp", direction).to_list(limit))
+        return messages[::-1] if newest else messages
+    
+    # A page of up to MESSAGE_BUCKET_SIZE messages is a single document read
+    buckets_needed = -(-limit // MESSAGE_BUCKET_SIZE)
+    query = {"conversation_id": conversation_id}
+    if newest and until is not None:
+        # Skip buckets started after the cutoff; the newest one left may be only partly before it
+        query["first_timestamp"] = {"$lte": until}
+        buckets_needed += 1
+    buckets_collection = read_collection("message_buckets", endpoint, key=conversation_id, fresh=fresh) if endpoint else db.message_buckets
+    buckets = await retry_db_operation(lambda: buckets_collection.find(
+        query, {"_id": 0, "messages": 1}
+    ).sort("seq", direction).to_list(buckets_needed))
+    messages = [msg for bucket in buckets for msg in bucket['messages'] if until is None or msg['timestamp'] <= until]
+    messages.sort(key=lambda msg: msg['timestamp'])  # Concurrent appends can land slightly out of order
+    return messages[-limit:] if newest else messages[:limit]
+
+# Conversation fields that decide where its messages are read from
+MESSAGE_SOURCE_PROJECTION = {"_id": 0, "id": 1, "storage": 1, "archived_at": 1, "archiving_at": 1, "fork_lineage": 1}
+
+async def fetch_messages(conversation_id: str, limit: int, conv: Optional[dict] = None,
+                         endpoint: Optional[str] = None, fresh: bool = False) -> List[dict]:
+    """
+    Messages of a conversation in timestamp order, transparently restoring
+    archived conversations. Forks read the newest `limit` messages across
+    the prefix they share with their ancestors and their own messages, so
+    a long inherited history never hides the fork's latest replies. Handlers that already loaded
+    the conversation pass it in; otherwise it is looked up alongside the
+    most likely read. Pure-read endpoints pass their name to use its read
+    routing; generation handlers leave it out and always read from the primary.
+    """
+    own = None
+    if conv is None:
+        guessed_bucketed = MESSAGE_STORAGE_MODE == "bucket"
+        conversations_collection = read_collection("conversations", endpoint, key=conversation_id, fresh=fresh) if endpoint else db.conversations
+        conv, own = await asyncio.gather(
+            retry_db_operation(lambda: conversations_collection.find_one({"id": conversation_id, **NOT_DELETED}, MESSAGE_SOURCE_PROJECTION)),
+            _read_messages(conversation_id, limit, endpoint, fresh, guessed_bucketed)
+        )
+        if conv is None:
+            return []
+        if is_archived(conv) or (conv.get('storage') == "bucket") != guessed_bucketed:
+            own = None  # Guessed wrong; read again below
+    
+    if is_archived(conv):
+        await rehydrate_conversation(conversation_id)
+        fresh = True  # The restored messages may not have reached the secondaries yet
+    
+    lineage = conv.get('fork_lineage') or []
+    reads = []
+    if lineage:
+        ancestor_ids = [entry['conversation_id'] for entry in lineage]
+        ancestors = await retry_db_operation(lambda: db.conversations.find(
+            {"id": {"$in": ancestor_ids}}, MESSAGE_SOURCE_PROJECTION
+        ).to_list(len(ancestor_ids)))
+        archived = [ancestor['id'] for ancestor in ancestors if is_archived(ancestor)]
+        if archived:
+            await asyncio.gather(*[rehydrate_conversation(ancestor_id) for ancestor_id in archived])
+            fresh = True
+        storage_by_id = {ancestor['id']: ancestor.get('storage') for ancestor in ancestors}
+        reads = [
+            _read_messages(entry['conversation_id'], limit, endpoint, fresh,
+                           storage_by_id.get(entry['conversation_id']) == "bucket", until=entry['until'], newest=True)
+            for entry in lineage
+        ]
+        if own is not None and len(own) >= limit:
+            own = None  # The guess read the oldest page; the fork needs its newest
+    if own is None:
+        reads.append(_read_messages(conversation_id, limit, endpoint, fresh, conv.get('storage') == "bucket",
+                                    newest=bool(lineage)))
+    
+    segments = await asyncio.gather(*reads)
+    if own is not None:
+        segments.append(own)
+    messages = [msg for segment in segments for msg in segment]
+    messages = messages[-limit:] if lineage else messages[:limit]
+    # Bodies are only inflated here, so projections without content never pay for it
+    return [inflate_message(msg) for msg in messages]
+
+class PersonaCache:
+    """
+    Read-through in-process cache of persona documents keyed by id.
+    Every invalidation bumps a version counter; a database read that raced
+    with an invalidation is served but not stored, so stale documents never
+    make it into the cache. Cached documents are handed out as shallow copies.
+    """
+    
+    def __init__(self, ttl_seconds: float = 300.0):
+        self.ttl_seconds = ttl_seconds  # Safety net for multi-worker setups without change streams
+        self.version = 0
+        self._entries: Dict[str, tuple] = {}  # id -> (doc, loaded_at)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+    
+    def invalidate(self, persona_id: Optional[str] = None):
+        """Drop one persona, or everything when no id is given"""
+        self.version += 1
+        self.invalidations += 1
+        note_write("personas")  # Every persona write passes through here
+        if persona_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(persona_id, None)
+    
+    def _lookup(self, persona_id: str) -> Optional[dict]:
+        entry = self._entries.get(persona_id)
+        if entry is None:
+            return None
+        doc, loaded_at = entry
+        if self.ttl_seconds > 0 and time.monotonic() - loaded_at > self.ttl_seconds:
+            self._entries.pop(persona_id, None)
+            return None
+        return doc
+    
+    async def get_many(self, persona_ids: List[str]) -> List[dict]:
+        """Return the personas for the given ids (missing ids are skipped), in request order"""
+        persona_ids = list(dict.fromkeys(persona_ids))
+        found = {}
+        missing = []
+        
+        for persona_id in persona_ids:
+            doc = self._lookup(persona_id)
+            if doc is None:
+                self.misses += 1
+                missing.append(persona_id)
+            else:
+                self.hits += 1
+                found[persona_id] = doc
+        
+        if missing:
+            version = self.version
+            docs = await retry_db_operation(lambda: db.personas.find({"id": {"$in": missing}}, {"_id": 0}).to_list(len(missing)))
+            loaded_at = time.monotonic()
+            for doc in docs:
+                found[doc['id']] = doc
+                if version == self.version:
+                    self._entries[doc['id']] = (doc, loaded_at)
+        
+        return [dict(found[persona_id]) for persona_id in persona_ids if persona_id in found]
+    
+    async def get(self, persona_id: str) -> Optional[dict]:
+        personas = await self.get_many([persona_id])
+        return personas[0] if personas else None
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+persona_cache = PersonaCache(ttl_seconds=float(os.environ.get('PERSONA_CACHE_TTL_SECONDS', '300')))
+
+class MessageWriteBatch:
+    """
+    Coalesces the writes of one generation handler: buffered messages go
+    out as a single insert_many and the conversation's updated_at bump (plus
+    any extra fields passed to touch()) is merged into one update_one.
+    
+    Use as an async context manager: leaving the block always flushes,
+    including on errors, and the shutdown hook flushes any batch that is
+    still open when the worker stops. If the conversation is deleted while
+    the handler runs, the flush that notices removes what it just wrote and
+    sets conversation_deleted so long-running loops can stop.
+    """
+    
+    open_batches = set()
+    insert_latency = LatencyStats()
+    touch_latency = LatencyStats()
+    documents_written = 0
+    
+    def __init__(self, conversation_id: str, storage: Optional[str] = None, owner_id: Optional[str] = None):
+        self.conversation_id = conversation_id
+        self.storage = storage  # The conversation's message layout, see MESSAGE_STORAGE_MODE
+        self.owner_id = owner_id
+        self._pending: List[dict] = []
+        self._touch_fields: Dict[str, Any] = {}
+        self._closed = False
+        self.conversation_deleted = False
+    
+    def add(self, msg: "Message"):
+        self._pending.append(deflate_message(msg.model_dump()))
+    
+    def touch(self, **fields):
+        """Extra conversation fields to set together with updated_at"""
+        self._touch_fields.update(fields)
+    
+    async def flush(self):
+        """Insert buffered messages now, e.g. between autorun rounds"""
+        docs, self._pending = self._pending, []
+        if not docs or self.conversation_deleted:
+            return
+        note_write(self.conversation_id)
+        started = time.perf_counter()
+        await store_messages(self.conversation_id, docs, self.storage, self.owner_id)
+        MessageWriteBatch.insert_latency.record((time.perf_counter() - started) * 1000)
+        
+        # Checked after the insert: a delete that comes later starts its cascade after these
+        # messages exist and removes them; one that came earlier is caught here
+        live = await retry_db_operation(lambda: db.conversations.find_one({"id": self.conversation_id, **NOT_DELETED}, {"_id": 1}))
+        if not live:
+            self.conversation_deleted = True
+            await discard_messages(self.conversation_id, [doc['id'] for doc in docs], self.storage)
+            logger.info(f"Conversation {self.conversation_id} was deleted mid-generation; dropped {len(docs)} new messages")
+            return
+        MessageWriteBatch.documents_written += len(docs)
+    
+    async def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        await self.flush()
+        if self.conversation_deleted:
+            return
+        started = time.perf_counter()
+        await retry_db_operation(lambda: db.conversations.update_one(
+            {"id": self.conversation_id, **NOT_DELETED},
+            {"$set": {**self._touch_fields, "updated_at": datetime.now(timezone.utc)}}
+        ))
+        MessageWriteBatch.touch_latency.record((time.perf_counter() - started) * 1000)
+    
+    async def __aenter__(self):
+        MessageWriteBatch.open_batches.add(self)
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await self.close()
+        finally:
+            MessageWriteBatch.open_batches.discard(self)
+        return False
+    
+    @classmethod
+    async def flush_all(cls):
+        for batch in list(cls.open_batches):
+            try:
+                await batch.close()
+            except Exception as e:
+                logger.error(f"Failed to flush pending messages for {batch.conversation_id}: {e}")
+    
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            "open_batches": len(cls.open_batches),
+            "documents_written": cls.documents_written,
+            "insert_many": cls.insert_latency.snapshot(),
+            "conversation_touch": cls.touch_latency.snapshot(),
+        }
+
+async def watch_persona_changes():
+    """
+    Invalidate the persona cache from a Mongo change stream so every worker
+    sees edits made by the others. Change streams need a replica set; on a
+    standalone server this logs once and leaves the TTL as the only safety net.
+    """
+    while True:
+        try:
+            async with db.personas.watch() as stream:
+                async for change in stream:
+                    # Change events carry only _id, and personas change rarely, so drop everything
+                    persona_cache.invalidate()
+        except OperationFailure as e:
+            logger.warning(f"Persona change stream unavailable, relying on cache TTL: {e}")
+            return
+        except PyMongoError as e:
+            logger.warning(f"Persona change stream interrupted, reconnecting: {e}")
+            persona_cache.invalidate()
+            await asyncio.sleep(5)
+
 # Health check endpoint (doesn't require DB) - on API router for proper routing
 @api_router.get("/health")
 async def health_check():
@@ -100,6 +1174,199 @@ async def db_health_check():
             "timestamp": datetime.now(timezone.utc).isoformat()
         }
 
+@api_router.get("/metrics")
+async def get_metrics():
+    """In-process performance counters for this worker"""
+    return {
+        "persona_cache": persona_cache.stats(),
+        "write_batching": MessageWriteBatch.stats(),
+        "db_retries": db_retry_stats,
+        "url_cache": {
+            **url_cache_stats,
+            "entries": len(url_cache),
+            "hit_rate": round(url_cache_stats["hits"] / (url_cache_stats["hits"] + url_cache_stats["misses"]), 4) if url_cache_stats["hits"] + url_cache_stats["misses"] else 0.0,
+            "fetches_coalesced": url_extract_flights.coalesced,
+        },
+        "pdf_extract": {
+            **pdf_extract_stats,
+            "workers": PDF_EXTRACT_WORKERS,
+            "max_pages": PDF_MAX_PAGES,
+            "latency": pdf_extract_latency.snapshot(),
+        },
+        "attachments": {
+            **attachment_stats,
+            "max_bytes": ATTACHMENT_MAX_BYTES,
+            "spool_bytes": ATTACHMENT_SPOOL_BYTES,
+            "upload_latency": attachment_upload_latency.snapshot(),
+        },
+        "vision_images": {
+            **vision_image_stats,
+            "enabled": VISION_IMAGE_NORMALIZE,
+            "entries": len(vision_image_cache),
+            "bytes_saved": vision_image_stats["bytes_in"] - vision_image_stats["bytes_out"],
+            "max_sides": [VISION_IMAGE_MAX_LONG_SIDE, VISION_IMAGE_MAX_SHORT_SIDE],
+            "latency": vision_image_latency.snapshot(),
+        },
+        "vision_prepass": {
+            **image_description_stats,
+            "enabled": VISION_PREPASS,
+            "model": VISION_PREPASS_MODEL,
+            "coalesced": image_description_flights.coalesced,
+            "latency": image_description_latency.snapshot(),
+        },
+        "html_extract": {
+            "parser": HTML_PARSER,
+            "workers": EXTRACTION_WORKERS,
+            "latency": html_extract_latency.snapshot(),
+        },
+        "url_fetch": {
+            **url_fetch_stats,
+            "latency": url_fetch_latency.snapshot(),
+            "max_bytes": URL_FETCH_MAX_BYTES,
+        },
+        "read_coalescing": {
+            "get_personas": persona_list_reads.stats(),
+            "get_messages": message_list_reads.stats(),
+        },
+        "archive": {
+            **archive_stats,
+            "codec": ARCHIVE_CODEC,
+            "bytes_saved": archive_stats["raw_bytes"] - archive_stats["compressed_bytes"],
+            "rehydration": rehydration_latency.snapshot(),
+        },
+        "guest_expiry": {
+            **guest_expiry_stats,
+            "ttl_days": GUEST_CONVERSATION_TTL_DAYS,
+        },
+        "message_storage": {
+            **bucket_stats,
+            "mode": MESSAGE_STORAGE_MODE,
+            "bucket_size": MESSAGE_BUCKET_SIZE,
+        },
+        "message_compression": {
+            **message_compression_stats,
+            "enabled": MESSAGE_COMPRESSION_ENABLED,
+            "codec": MESSAGE_CODEC,
+            "min_bytes": MESSAGE_COMPRESSION_MIN_BYTES,
+            "ratio": round(message_compression_stats["raw_bytes"] / message_compression_stats["stored_bytes"], 2) if message_compression_stats["stored_bytes"] else None,
+        },
+        "mongo": {
+            "config": MONGO_CLIENT_OPTIONS,
+            "pool": mongo_pool_metrics.stats(),
+            **mongo_command_metrics.stats(),
+        },
+        "timestamp": datetime.now(timezone.utc).isoformat()
+    }
+
+# Maintenance endpoints are off unless ADMIN_API_KEY is set, and then need it in X-Admin-Key
+ADMIN_API_KEY = os.environ.get('ADMIN_API_KEY')
+ADMIN_MAX_BATCH = 1000
+
+def require_admin(x_admin_key: Optional[str] = Header(None)):
+    if not ADMIN_API_KEY:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_key or not hmac.compare_digest(x_admin_key.encode(), ADMIN_API_KEY.encode()):
+        raise HTTPException(status_code=403, detail="Admin key required")
+
+class ArchiveRunRequest(BaseModel):
+    inactive_days: Optional[int] = Field(None, ge=1)
+    limit: int = Field(100, ge=1, le=ADMIN_MAX_BATCH)
+
+class GuestExpiryRunRequest(BaseModel):
+    ttl_days: Optional[int] = Field(None, ge=1)
+    limit: int = Field(100, ge=1, le=ADMIN_MAX_BATCH)
+
+@api_router.post("/admin/archive-inactive", dependencies=[Depends(require_admin)])
+async def archive_inactive(request: ArchiveRunRequest):
+    """Run one archiver pass now, e.g. {"inactive_days": 30, "limit": 100}"""
+    inactive_days = request.inactive_days or ARCHIVE_AFTER_DAYS or 30
+    archived = await archive_inactive_conversations(inactive_days, limit=request.limit)
+    return {"archived": archived, "inactive_days": inactive_days}
+
+search_index_build = {"status": "not_started", "started_at": None, "finished_at": None, "error": None, "owners_backfilled": 0}
+
+async def backfill_message_owners(batch_size: int = 200, pause_seconds: float = 0.05):
+    """
+    Stamp the conversation owner's user_id on messages written before
+    store_messages did. Walks conversations in _id order and stores a
+    checkpoint in db.migrations after every batch, like migrate_datetime_fields.
+    """
+    checkpoint_id = "message_owners"
+    checkpoint = await retry_db_operation(lambda: db.migrations.find_one({"_id": checkpoint_id})) or {}
+    if checkpoint.get("completed"):
+        return
+    
+    last_id = checkpoint.get("last_id")
+    while True:
+        query = {"storage": {"$ne": "bucket"}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = await retry_db_operation(lambda: db.conversations.find(
+            query, {"_id": 1, "id": 1, "user_id": 1}
+        ).sort("_id", 1).limit(batch_size).to_list(batch_size))
+        if not batch:
+            break
+        
+        # Messages that already carry an owner were written by store_messages and are left alone
+        operations = [
+            UpdateMany({"conversation_id": conv['id'], "user_id": {"$exists": False}}, {"$set": {"user_id": conv.get('user_id')}})
+            for conv in batch
+        ]
+        result = await retry_db_operation(lambda: db.messages.bulk_write(operations, ordered=False))
+        search_index_build["owners_backfilled"] += result.modified_count
+        
+        last_id = batch[-1]["_id"]
+        await retry_db_operation(lambda: db.migrations.update_one(
+            {"_id": checkpoint_id},
+            {"$set": {"last_id": last_id, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True
+        ))
+        await asyncio.sleep(pause_seconds)
+    
+    await retry_db_operation(lambda: db.migrations.update_one(
+        {"_id": checkpoint_id},
+        {"$set": {"completed": True, "updated_at": datetime.now(timezone.utc)}},
+        upsert=True
+    ))
+
+async def build_search_indexes():
+    """
+    Backfill message owners, then build the text index search needs over
+    every message. On a large collection this takes a long time, so startup
+    runs it in the background instead of awaiting it in ensure_indexes();
+    the admin endpoint below reruns it after a failure. Both steps are
+    no-ops once done, so every worker can run it.
+    """
+    search_index_build.update(status="building", started_at=datetime.now(timezone.utc), finished_at=None, error=None)
+    try:
+        await backfill_message_owners()
+        await db.messages.create_index([("content", "text")], name="messages_content_text", default_language="english")
+        search_index_build["status"] = "ready"
+    except Exception as e:
+        logger.error(f"Search index build failed: {e}")
+        search_index_build.update(status="failed", error=str(e))
+    search_index_build["finished_at"] = datetime.now(timezone.utc)
+
+@api_router.post("/admin/build-search-indexes", dependencies=[Depends(require_admin)])
+async def start_search_index_build():
+    """Start the owner backfill and message text index build in the background; poll again to see its status"""
+    if search_index_build["status"] != "building":
+        run_in_background(build_search_indexes())
+        await asyncio.sleep(0)
+    return search_index_build
+
+@api_router.post("/admin/expire-guests", dependencies=[Depends(require_admin)])
+async def expire_guests(request: GuestExpiryRunRequest):
+    """Run one guest sweeper batch now, e.g. {"ttl_days": 30, "limit": 100}"""
+    if GUEST_CONVERSATION_TTL_DAYS <= 0:
+        raise HTTPException(status_code=409, detail="Guest expiry is disabled (GUEST_CONVERSATION_TTL_DAYS=0)")
+    ttl_days = request.ttl_days or GUEST_CONVERSATION_TTL_DAYS
+    if ttl_days < GUEST_CONVERSATION_TTL_DAYS:
+        # A manual run can catch up with the policy, not tighten it
+        raise HTTPException(status_code=400, detail=f"ttl_days can't be below GUEST_CONVERSATION_TTL_DAYS ({GUEST_CONVERSATION_TTL_DAYS})")
+    result = await expire_guest_conversations(ttl_days, limit=request.limit)
+    return {**result, "ttl_days": ttl_days}
+
 class VoiceMeta(BaseModel):
     """TTS-specific voice parameters for audio generation"""
     pitch_range: str = "medium"  # low, medium, high
@@ -162,6 +1429,43 @@ class Persona(PersonaBase):
     avatar_base64: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class PersonaPatch(BaseModel):
+    """PATCH body: any subset of the editable persona fields"""
+    model_config = ConfigDict(extra="forbid")
+    display_name: Optional[str] = None
+    type: Optional[str] = None
+    bio: Optional[str] = None
+    quirks: Optional[List[str]] = None
+    voice: Optional[Voice] = None
+    intelligence_profile: Optional[IntelligenceProfile] = None
+    color: Optional[str] = None
+    tags: Optional[List[str]] = None
+    sort_order: Optional[int] = None
+    era_context: Optional[str] = None
+    knowledge_scope: Optional[str] = None
+    avatar_base64: Optional[str] = None
+
+# Fields a PATCH may change but not clear
+PERSONA_REQUIRED_FIELDS = ("display_name", "type", "bio", "quirks", "voice")
+
+class PersonaSummary(PersonaBase):
+    """Persona without the avatar blob"""
+    model_config = ConfigDict(extra="ignore")
+    id: str
+    version: int = 0
+    created_at: Optional[datetime] = None  # Seeded personas predate created_at
+    updated_at: Optional[datetime] = None
+
+PERSONA_SLIM_PROJECTION = {"_id": 0, "avatar_base64": 0, "avatar_url": 0}
+
+def avatar_data_url(avatar_base64: Optional[str]) -> Optional[str]:
+    """data: URL for an avatar, without doubling a prefix the client already sent"""
+    if not avatar_base64:
+        return None
+    if avatar_base64.startswith('data:image'):
+        return avatar_base64
+    return f"data:image/png;base64,{avatar_base64}"
+
 class User(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -193,6 +1497,10 @@ class Message(BaseModel):
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     is_user: bool = False
 
+# Validate and serialize list responses once, outside FastAPI's per-request response_model pass
+PERSONA_LIST_ADAPTER = TypeAdapter(List[Persona])
+MESSAGE_LIST_ADAPTER = TypeAdapter(List[Message])
+
 class Conversation(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -202,20 +1510,52 @@ class Conversation(BaseModel):
     mode: str
     topic: Optional[str] = None
     active_personas: List[str] = []
+    parent_id: Optional[str] = None  # Set on forks: the conversation branched from
+    fork_message_id: Optional[str] = None  # Last message of the parent the fork inherits
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class ConversationSummary(BaseModel):
+    """List-view fields only"""
+    model_config = ConfigDict(extra="ignore")
+    id: str
+    user_id: Optional[str] = None
+    title: str = "New Conversation"
+    mode: str
+    topic: Optional[str] = None
+    parent_id: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+
+# Projection matching ConversationSummary, so listing never drags full documents over the wire
+CONVERSATION_LIST_PROJECTION = {"_id": 0, **{field: 1 for field in ConversationSummary.model_fields}}
+
 class ConversationCreate(BaseModel):
     mode: str
     topic: Optional[str] = None
     active_personas: List[str] = []
 
+class ConversationFork(BaseModel):
+    """Branch after message_id; unset fields are taken from the parent"""
+    message_id: str
+    mode: Optional[str] = None
+    active_personas: Optional[List[str]] = None
+    title: Optional[str] = None
+
 class MessageCreate(BaseModel):
     content: str
     persona_id: Optional[str] = None
     is_user: bool = False
     attachments: Optional[List[Dict[str, Any]]] = None
 
+class PersonaOrder(BaseModel):
+    id: str
+    sort_order: int
+
+class PersonaReorderRequest(BaseModel):
+    orders: List[PersonaOrder] = []
+    atomic: bool = False  # Apply all-or-nothing inside a transaction (needs a replica set)
+
 class PersonaLookupRequest(BaseModel):
     name: str
 
@@ -223,6 +1563,7 @@ class ChatGenerateRequest(BaseModel):
     conversation_id: str
     user_message: str
     attachments: Optional[List[Dict[str, Any]]] = None
+    vision_prepass: Optional[bool] = None  # None follows VISION_PREPASS
 
 @api_router.get("/")
 async def root():
@@ -233,7 +1574,7 @@ def hash_password(password: str) -> str:
 
 @api_router.post("/auth/register")
 async def register_user(user: UserCreate):
-    existing = await db.users.find_one({"username": user.username}, {"_id": 0})
+    existing = await retry_db_operation(lambda: db.users.find_one({"username": user.username}, {"_id": 0}))
     if existing:
         raise HTTPException(status_code=400, detail="Username already exists")
     
@@ -244,7 +1585,6 @@ async def register_user(user: UserCreate):
     )
     
     doc = user_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     
     await db.users.insert_one(doc)
     
@@ -252,7 +1592,7 @@ async def register_user(user: UserCreate):
 
 @api_router.post("/auth/login")
 async def login_user(credentials: UserLogin):
-    user = await db.users.find_one({"username": credentials.username}, {"_id": 0})
+    user = await retry_db_operation(lambda: db.users.find_one({"username": credentials.username}, {"_id": 0}))
     if not user or user['password_hash'] != hash_password(credentials.password):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
@@ -342,15 +1682,7 @@ async def create_persona(persona: PersonaCreate):
         )
     
     # Create avatar_url, handling cases where avatar_base64 might already include data URL prefix
-    avatar_url = None
-    if avatar_base64:
-        # Strip any existing data URL prefix to avoid duplication
-        if avatar_base64.startswith('data:image'):
-            # Already has full data URL
-            avatar_url = avatar_base64
-        else:
-            # Just base64 data, add prefix
-            avatar_url = f"data:image/png;base64,{avatar_base64}"
+    avatar_url = avatar_data_url(avatar_base64)
     
     persona_obj = Persona(
         display_name=persona.display_name,
@@ -366,43 +1698,40 @@ async def create_persona(persona: PersonaCreate):
     )
     
     doc = persona_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     
     await db.personas.insert_one(doc)
+    persona_cache.invalidate(persona_obj.id)
     return persona_obj
 
 @api_router.get("/personas", response_model=List[Persona])
-async def get_personas():
-    personas = await db.personas.find({}, {"_id": 0}).to_list(100)
-    
-    for persona in personas:
-        # Only process created_at if it exists
-        if 'created_at' in persona and persona['created_at'] and isinstance(persona['created_at'], str):
-            try:
-                persona['created_at'] = datetime.fromisoformat(persona['created_at'])
-            except:
-                pass  # If parsing fails, skip it
+async def get_personas(fresh: bool = False):
+    """
+    Concurrent requests share one query and one validated, serialized
+    payload (see SingleFlight), returned as-is.
+    """
+    async def load() -> bytes:
+        # Sorted by Mongo using the sort_order index instead of in Python
+        personas_collection = read_collection("personas", "get_personas", key="personas", fresh=fresh)
+        personas = await retry_db_operation(lambda: personas_collection.find({}, {"_id": 0}).sort("sort_order", 1).to_list(100))
         
-        # Add default values for new fields if they don't exist
-        if 'tags' not in persona:
-            persona['tags'] = []
-        if 'sort_order' not in persona:
-            persona['sort_order'] = 0
-    
-    # Sort by sort_order
-    personas.sort(key=lambda p: p.get('sort_order', 0))
+        for persona in personas:
+            # Add default values for new fields if they don't exist
+            if 'tags' not in persona:
+                persona['tags'] = []
+            if 'sort_order' not in persona:
+                persona['sort_order'] = 0
+        
+        return PERSONA_LIST_ADAPTER.dump_json(PERSONA_LIST_ADAPTER.validate_python(personas))
     
-    return personas
+    body = await persona_list_reads.run("personas", fresh, load)
+    return Response(content=body, media_type="application/json")
 
 @api_router.get("/personas/{persona_id}", response_model=Persona)
 async def get_persona(persona_id: str):
-    persona = await db.personas.find_one({"id": persona_id}, {"_id": 0})
+    persona = await retry_db_operation(lambda: db.personas.find_one({"id": persona_id}, {"_id": 0}))
     if not persona:
         raise HTTPException(status_code=404, detail="Persona not found")
     
-    if isinstance(persona['created_at'], str):
-        persona['created_at'] = datetime.fromisoformat(persona['created_at'])
-    
     # Add default values for new fields if they don't exist
     if 'tags' not in persona:
         persona['tags'] = []
@@ -413,7 +1742,7 @@ async def get_persona(persona_id: str):
 
 @api_router.put("/personas/{persona_id}", response_model=Persona)
 async def update_persona(persona_id: str, persona_update: PersonaCreate):
-    existing = await db.personas.find_one({"id": persona_id}, {"_id": 0})
+    existing = await retry_db_operation(lambda: db.personas.find_one({"id": persona_id}, {"_id": 0}))
     if not existing:
         raise HTTPException(status_code=404, detail="Persona not found")
     
@@ -421,15 +1750,7 @@ async def update_persona(persona_id: str, persona_update: PersonaCreate):
     avatar_base64 = persona_update.avatar_base64 or existing.get('avatar_base64')
     
     # Handle avatar_url creation, avoiding duplicate prefixes
-    avatar_url = existing.get('avatar_url')
-    if avatar_base64:
-        # Strip any existing data URL prefix to avoid duplication
-        if avatar_base64.startswith('data:image'):
-            # Already has full data URL
-            avatar_url = avatar_base64
-        else:
-            # Just base64 data, add prefix
-            avatar_url = f"data:image/png;base64,{avatar_base64}"
+    avatar_url = avatar_data_url(avatar_base64) or existing.get('avatar_url')
     
     updated_persona = Persona(
         id=persona_id,
@@ -443,39 +1764,126 @@ async def update_persona(persona_id: str, persona_update: PersonaCreate):
         avatar_url=avatar_url,
         tags=persona_update.tags or existing.get('tags', []),
         sort_order=persona_update.sort_order if persona_update.sort_order is not None else existing.get('sort_order', 0),
-        created_at=datetime.fromisoformat(existing['created_at']) if isinstance(existing['created_at'], str) else existing['created_at']
+        created_at=existing['created_at']  # Pydantic also accepts not-yet-migrated ISO strings
     )
     
     doc = updated_persona.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
+    doc['updated_at'] = datetime.now(timezone.utc)  # Kept in step with PATCH
     
-    await db.personas.update_one({"id": persona_id}, {"$set": doc})
+    # $inc isn't idempotent, so this write relies on the driver's retryable writes only
+    await db.personas.update_one({"id": persona_id}, {"$set": doc, "$inc": {"version": 1}})
+    persona_cache.invalidate(persona_id)
     return updated_persona
 
+@api_router.patch("/personas/{persona_id}", response_model=PersonaSummary)
+async def patch_persona(persona_id: str, persona_patch: PersonaPatch):
+    """
+    Partial update: validates and $sets only the supplied fields, bumps the
+    persona version, and returns the persona without its avatar blob.
+    """
+    updates = persona_patch.model_dump(exclude_unset=True)
+    if not updates:
+        raise HTTPException(status_code=400, detail="No fields to update")
+    
+    cleared = [field for field in PERSONA_REQUIRED_FIELDS if field in updates and updates[field] is None]
+    if cleared:
+        raise HTTPException(status_code=400, detail=f"Fields cannot be null: {', '.join(cleared)}")
+    
+    if 'avatar_base64' in updates:
+        updates['avatar_url'] = avatar_data_url(updates['avatar_base64'])
+    updates['updated_at'] = datetime.now(timezone.utc)
+    
+    persona = await db.personas.find_one_and_update(
+        {"id": persona_id},
+        {"$set": updates, "$inc": {"version": 1}},
+        projection=PERSONA_SLIM_PROJECTION,
+        return_document=ReturnDocument.AFTER
+    )
+    if not persona:
+        raise HTTPException(status_code=404, detail="Persona not found")
+    persona_cache.invalidate(persona_id)
+    
+    return persona
+
 @api_router.post("/personas/reorder")
-async def reorder_personas(request: dict):
+async def reorder_personas(request: PersonaReorderRequest):
     """
-    Bulk update persona sort order after drag-drop
+    Bulk update persona sort order after drag-drop.
+    All updates go to Mongo as a single unordered bulk_write instead of one
+    round trip per persona. With atomic=True the batch runs in a transaction
+    and unknown ids fail it with 404; otherwise the known ids are updated and
+    the unknown ones are listed under "missing".
     """
-    persona_orders = request.get('orders', [])  # [{"id": "...", "sort_order": 0}, ...]
+    persona_orders = request.orders  # [{"id": "...", "sort_order": 0}, ...]
     
-    for item in persona_orders:
-        await db.personas.update_one(
-            {"id": item['id']},
-            {"$set": {"sort_order": item['sort_order']}}
-        )
+    if not persona_orders:
+        return {"success": True, "updated": 0, "matched": 0, "modified": 0}
+    
+    ids = [item.id for item in persona_orders]
+    if len(set(ids)) != len(ids):
+        raise HTTPException(status_code=400, detail="Duplicate persona ids in reorder payload")
+    
+    operations = [
+        UpdateOne({"id": item.id}, {"$set": {"sort_order": item.sort_order}})
+        for item in persona_orders
+    ]
+    
+    try:
+        if request.atomic:
+            async with await client.start_session() as session:
+                async with session.start_transaction():
+                    result = await db.personas.bulk_write(operations, ordered=True, session=session)
+                    if result.matched_count != len(operations):
+                        # Raising inside the block aborts the transaction
+                        raise HTTPException(status_code=404, detail="One or more personas not found")
+        else:
+            result = await retry_db_operation(lambda: db.personas.bulk_write(operations, ordered=False))
+    except BulkWriteError as e:
+        logging.error(f"Persona reorder failed: {e.details}")
+        raise HTTPException(status_code=500, detail="Failed to reorder personas")
+    except OperationFailure as e:
+        if e.code == 20:  # IllegalOperation: standalone mongod, no transactions
+            raise HTTPException(status_code=501, detail="Atomic reorder needs a replica set; retry with atomic=false")
+        logging.error(f"Persona reorder failed: {e}")
+        raise HTTPException(status_code=500, detail="Failed to reorder personas")
+    except PyMongoError as e:
+        logging.error(f"Persona reorder failed: {e}")
+        raise HTTPException(status_code=500, detail="Failed to reorder personas")
+    finally:
+        persona_cache.invalidate()
     
-    return {"success": True, "updated": len(persona_orders)}
+    missing = []
+    if result.matched_count < len(operations):
+        # Unordered writes still applied the known ids; say which ones weren't there
+        found = await retry_db_operation(lambda: db.personas.find({"id": {"$in": ids}}, {"_id": 0, "id": 1}).to_list(len(ids)))
+        found_ids = {persona['id'] for persona in found}
+        missing = [persona_id for persona_id in ids if persona_id not in found_ids]
+    
+    return {
+        "success": not missing,
+        "updated": len(persona_orders),
+        "matched": result.matched_count,
+        "modified": result.modified_count,
+        "missing": missing
+    }
 
 @api_router.delete("/personas/{persona_id}")
 async def delete_persona(persona_id: str):
     result = await db.personas.delete_one({"id": persona_id})
+    persona_cache.invalidate(persona_id)
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Persona not found")
     return {"message": "Persona deleted"}
 
+def normalize_owner_id(user_id: Optional[str]) -> Optional[str]:
+    # The arena sends `user_id=${user?.id}`, which arrives as "undefined" before login
+    if user_id in (None, "", "undefined", "null"):
+        return None
+    return user_id
+
 @api_router.post("/conversations", response_model=Conversation)
 async def create_conversation(conv: ConversationCreate, user_id: Optional[str] = None):
+    user_id = normalize_owner_id(user_id)
     conversation = Conversation(
         session_id=str(uuid.uuid4()),
         user_id=user_id,
@@ -486,58 +1894,189 @@ async def create_conversation(conv: ConversationCreate, user_id: Optional[str] =
     )
     
     doc = conversation.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    doc['updated_at'] = doc['updated_at'].isoformat()
+    if MESSAGE_STORAGE_MODE == "bucket":
+        doc['storage'] = "bucket"
     
     await db.conversations.insert_one(doc)
+    note_write(conversation.id, f"user:{user_id}")
     return conversation
 
-@api_router.get("/conversations", response_model=List[Conversation])
-async def get_conversations(user_id: Optional[str] = None):
-    query = {"user_id": user_id} if user_id else {}
-    convs = await db.conversations.find(query, {"_id": 0}).sort("updated_at", -1).to_list(50)
+FORK_MAX_DEPTH = int(os.environ.get('FORK_MAX_DEPTH', '10'))  # Each ancestor is one more read per history fetch
+
+async def find_fork_point(parent: dict, message_id: str) -> Optional[datetime]:
+    """Timestamp of a message in the parent's history (own or inherited), or None"""
+    until_by_id = {entry['conversation_id']: entry['until'] for entry in parent.get('fork_lineage') or []}
+    conversation_ids = [parent['id'], *until_by_id]
+    in_documents, in_buckets = await asyncio.gather(
+        retry_db_operation(lambda: db.messages.find_one(
+            {"conversation_id": {"$in": conversation_ids}, "id": message_id},
+            {"_id": 0, "conversation_id": 1, "timestamp": 1}
+        )),
+        retry_db_operation(lambda: db.message_buckets.find_one(
+            {"conversation_id": {"$in": conversation_ids}, "messages.id": message_id},
+            {"_id": 0, "conversation_id": 1, "messages.$": 1}
+        ))
+    )
+    if in_documents:
+        owner_id, timestamp = in_documents['conversation_id'], in_documents['timestamp']
+    elif in_buckets:
+        owner_id, timestamp = in_buckets['conversation_id'], in_buckets['messages'][0]['timestamp']
+    else:
+        return None
+    
+    until = until_by_id.get(owner_id)
+    if until is not None and timestamp > until:
+        return None  # Posted to an ancestor after the parent branched off
+    return timestamp
+
+@api_router.post("/conversations/{conversation_id}/fork", response_model=Conversation)
+async def fork_conversation(conversation_id: str, fork: ConversationFork, user_id: Optional[str] = None):
+    """
+    Branch a conversation after one of its messages. The fork references the
+    parent's history up to that message (fork_lineage) instead of copying
+    it, so forking is a single insert however long the history is.
+    """
+    parent = await retry_db_operation(lambda: db.conversations.find_one({"id": conversation_id, **NOT_DELETED}, {"_id": 0}))
+    if not parent:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    if is_archived(parent):
+        await rehydrate_conversation(conversation_id)
+    
+    fork_point = await find_fork_point(parent, fork.message_id)
+    if fork_point is None:
+        raise HTTPException(status_code=404, detail="Message not found in this conversation")
     
-    for conv in convs:
-        if isinstance(conv['created_at'], str):
-            conv['created_at'] = datetime.fromisoformat(conv['created_at'])
-        if isinstance(conv['updated_at'], str):
-            conv['updated_at'] = datetime.fromisoformat(conv['updated_at'])
+    lineage = [
+        {"conversation_id": entry['conversation_id'], "until": min(entry['until'], fork_point)}
+        for entry in parent.get('fork_lineage') or []
+    ]
+    lineage.append({"conversation_id": conversation_id, "until": fork_point})
+    if len(lineage) > FORK_MAX_DEPTH:
+        raise HTTPException(status_code=400, detail=f"Forks can be nested at most {FORK_MAX_DEPTH} levels deep")
+    
+    owner_id = normalize_owner_id(user_id) or parent.get('user_id')
+    conversation = Conversation(
+        session_id=str(uuid.uuid4()),
+        user_id=owner_id,
+        mode=fork.mode or parent['mode'],
+        topic=parent.get('topic'),
+        active_personas=fork.active_personas if fork.active_personas is not None else parent.get('active_personas', []),
+        title=fork.title or f"{parent.get('title', 'New Conversation')} (fork)",
+        parent_id=conversation_id,
+        fork_message_id=fork.message_id
+    )
+    
+    doc = conversation.model_dump()
+    doc['fork_lineage'] = lineage
+    if MESSAGE_STORAGE_MODE == "bucket":
+        doc['storage'] = "bucket"
     
+    await db.conversations.insert_one(doc)
+    note_write(conversation.id, f"user:{owner_id}")
+    return conversation
+
+def unscoped_reads_allowed() -> bool:
+    """Debug switch: list and search conversations across every owner"""
+    return os.environ.get('ALLOW_UNSCOPED_CONVERSATION_LISTING', 'false').lower() == 'true'
+
+@api_router.get("/conversations", response_model=List[ConversationSummary])
+async def get_conversations(user_id: Optional[str] = None, fresh: bool = False):
+    """
+    Most recent conversations of one owner: a registered user's id or the
+    id handed out by /auth/guest. Served by the (user_id, updated_at) index.
+    """
+    user_id = normalize_owner_id(user_id)
+    if user_id is None:
+        if not unscoped_reads_allowed():
+            raise HTTPException(status_code=400, detail="user_id is required to list conversations")
+        query = {}  # Debug only: sorts across every conversation in the database
+    else:
+        query = {"user_id": user_id}
+    query.update(NOT_DELETED)
+    
+    conversations_collection = read_collection("conversations", "get_conversations", key=f"user:{user_id}", fresh=fresh)
+    convs = await retry_db_operation(lambda: conversations_collection.find(query, CONVERSATION_LIST_PROJECTION).sort("updated_at", -1).to_list(50))
     return convs
 
 @api_router.get("/conversations/{conversation_id}", response_model=Conversation)
 async def get_conversation(conversation_id: str):
-    conv = await db.conversations.find_one({"id": conversation_id}, {"_id": 0})
+    conv = await retry_db_operation(lambda: db.conversations.find_one({"id": conversation_id, **NOT_DELETED}, {"_id": 0}))
     if not conv:
         raise HTTPException(status_code=404, detail="Conversation not found")
     
-    if isinstance(conv['created_at'], str):
-        conv['created_at'] = datetime.fromisoformat(conv['created_at'])
-    if isinstance(conv['updated_at'], str):
-        conv['updated_at'] = datetime.fromisoformat(conv['updated_at'])
-    
     return conv
 
 @api_router.delete("/conversations/{conversation_id}")
 async def delete_conversation(conversation_id: str):
-    result = await db.conversations.delete_one({"id": conversation_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Conversation not found")
+    """
+    Tombstone the conversation and return immediately; its messages are
+    removed in throttled batches by a background job.
+    """
+    now = datetime.now(timezone.utc)
+    result = await retry_db_operation(lambda: db.conversations.update_one(
+        {"id": conversation_id, **NOT_DELETED},
+        {"$set": {"deleted_at": now, "deletion": {"status": "pending", "messages_deleted": 0, "updated_at": now}}}
+    ))
+    if result.matched_count == 0:
+        existing = await retry_db_operation(lambda: db.conversations.find_one({"id": conversation_id}, {"_id": 0, "deletion": 1}))
+        if not existing:
+            raise HTTPException(status_code=404, detail="Conversation not found")
+        # Already tombstoned - make sure a job is running (e.g. after a restart)
     
-    await db.messages.delete_many({"conversation_id": conversation_id})
-    return {"message": "Conversation and messages deleted"}
+    run_in_background(cascade_delete_conversation(conversation_id))
+    return {"message": "Conversation deleted", "status": "pending"}
+
+@api_router.get("/conversations/{conversation_id}/deletion")
+async def get_conversation_deletion(conversation_id: str):
+    """Progress of a background cascade delete"""
+    job = deletion_jobs.get(conversation_id)
+    if job and job['status'] == "completed":
+        return {"conversation_id": conversation_id, **job}
+    
+    conv = await retry_db_operation(lambda: db.conversations.find_one({"id": conversation_id}, {"_id": 0, "deleted_at": 1, "deletion": 1}))
+    if not conv or 'deleted_at' not in conv:
+        raise HTTPException(status_code=404, detail="No deletion in progress for this conversation")
+    
+    documents, bucketed = await asyncio.gather(
+        retry_db_operation(lambda: db.messages.count_documents({"conversation_id": conversation_id})),
+        count_bucketed_messages(conversation_id)
+    )
+    remaining = documents + bucketed
+    progress = job or conv.get('deletion', {})
+    return {
+        "conversation_id": conversation_id,
+        "status": progress.get('status', "pending"),
+        "messages_deleted": progress.get('messages_deleted', 0),
+        "messages_remaining": remaining
+    }
 
 @api_router.post("/conversations/{conversation_id}/messages", response_model=Message)
 async def create_message(conversation_id: str, message: MessageCreate):
-    conv = await db.conversations.find_one({"id": conversation_id}, {"_id": 0})
+    # Bump updated_at (and name the conversation on its first user message)
+    # in the same round trip that checks the conversation exists
+    touch = {"updated_at": datetime.now(timezone.utc)}
+    if message.is_user:
+        title_preview = message.content[:50] + "..." if len(message.content) > 50 else message.content
+        touch["title"] = {"$cond": [{"$eq": ["$title", "New Conversation"]}, {"$literal": title_preview}, "$title"]}
+    
+    lookups = [retry_db_operation(lambda: db.conversations.find_one_and_update(
+        {"id": conversation_id, **NOT_DELETED},
+        [{"$set": touch}],
+        projection={"_id": 0, "user_id": 1, "archived_at": 1, "archiving_at": 1, "storage": 1}
+    ))]
+    if message.persona_id:
+        lookups.append(persona_cache.get(message.persona_id))
+    conv, *persona = await asyncio.gather(*lookups)
+    
     if not conv:
         raise HTTPException(status_code=404, detail="Conversation not found")
+    if is_archived(conv):
+        # Restore the history before appending so the archive never goes stale
+        await rehydrate_conversation(conversation_id)
     
     persona_name = "User"
-    if message.persona_id:
-        persona = await db.personas.find_one({"id": message.persona_id}, {"_id": 0})
-        if persona:
-            persona_name = persona['display_name']
+    if persona and persona[0]:
+        persona_name = persona[0]['display_name']
     
     msg = Message(
         conversation_id=conversation_id,
@@ -547,41 +2086,25 @@ async def create_message(conversation_id: str, message: MessageCreate):
         is_user=message.is_user
     )
     
-    doc = msg.model_dump()
-    doc['timestamp'] = doc['timestamp'].isoformat()
+    doc = deflate_message(msg.model_dump())
     
-    await db.messages.insert_one(doc)
-    
-    if message.is_user and conv['title'] == "New Conversation":
-        title_preview = message.content[:50] + "..." if len(message.content) > 50 else message.content
-        await db.conversations.update_one(
-            {"id": conversation_id},
-            {"$set": {"title": title_preview, "updated_at": datetime.now(timezone.utc).isoformat()}}
-        )
-    else:
-        await db.conversations.update_one(
-            {"id": conversation_id},
-            {"$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
-        )
+    await store_messages(conversation_id, [doc], conv.get('storage'), conv.get('user_id'))
+    note_write(conversation_id, f"user:{conv.get('user_id')}")
     
     return msg
 
 @api_router.get("/conversations/{conversation_id}/messages", response_model=List[Message])
-async def get_messages(conversation_id: str):
-    messages = await db.messages.find({"conversation_id": conversation_id}, {"_id": 0}).sort("timestamp", 1).to_list(200)
-    
-    for msg in messages:
-        if isinstance(msg['timestamp'], str):
-            msg['timestamp'] = datetime.fromisoformat(msg['timestamp'])
+async def get_messages(conversation_id: str, fresh: bool = False):
+    async def load() -> bytes:
+        messages = await fetch_messages(conversation_id, 200, endpoint="get_messages", fresh=fresh)
+        return MESSAGE_LIST_ADAPTER.dump_json(MESSAGE_LIST_ADAPTER.validate_python(messages))
     
-    return messages
+    # Clients reloading the same conversation together share one read and one serialization
+    body = await message_list_reads.run(conversation_id, fresh, load)
+    return Response(content=body, media_type="application/json")
 
 @api_router.put("/conversations/{conversation_id}")
 async def update_conversation(conversation_id: str, update_data: dict):
-    conv = await db.conversations.find_one({"id": conversation_id}, {"_id": 0})
-    if not conv:
-        raise HTTPException(status_code=404, detail="Conversation not found")
-    
     # Update allowed fields
     update_fields = {}
     if 'active_personas' in update_data:
@@ -591,16 +2114,192 @@ async def update_conversation(conversation_id: str, update_data: dict):
     if 'title' in update_data:
         update_fields['title'] = update_data['title']
     
-    if update_fields:
-        update_fields['updated_at'] = datetime.now(timezone.utc).isoformat()
-        await db.conversations.update_one(
-            {"id": conversation_id},
-            {"$set": update_fields}
-        )
+    if not update_fields:
+        conv = await retry_db_operation(lambda: db.conversations.find_one({"id": conversation_id, **NOT_DELETED}, {"_id": 0}))
+        if not conv:
+            raise HTTPException(status_code=404, detail="Conversation not found")
+        return conv
     
-    updated_conv = await db.conversations.find_one({"id": conversation_id}, {"_id": 0})
+    update_fields['updated_at'] = datetime.now(timezone.utc)
+    updated_conv = await retry_db_operation(lambda: db.conversations.find_one_and_update(
+        {"id": conversation_id, **NOT_DELETED},
+        {"$set": update_fields},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    ))
+    if not updated_conv:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    note_write(conversation_id, f"user:{updated_conv.get('user_id')}")
     return updated_conv
 
+SEARCH_MAX_TIME_MS = int(os.environ.get('SEARCH_MAX_TIME_MS', '1000'))
+SEARCH_MAX_PAGE_SIZE = 50
+SEARCH_MAX_PAGES = 20  # Deep skip() over text matches gets expensive; refine the query instead
+
+def parse_search_terms(query: str) -> List[str]:
+    """Words and quoted phrases from a $text query, without negated terms"""
+    phrases = re.findall(r'"([^"]+)"', query)
+    words = [w for w in re.sub(r'"[^"]*"', ' ', query).split() if not w.startswith('-')]
+    return [t for t in phrases + words if t.strip()]
+
+def build_search_snippet(content: str, terms: List[str], radius: int = 80) -> str:
+    """HTML-escaped excerpt around the first matching term, with matches wrapped in <mark>"""
+    if not terms:
+        return html.escape(content[:radius * 2])
+    
+    pattern = re.compile('|'.join(re.escape(t) for t in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    match = pattern.search(content)
+    if match:
+        start = max(0, match.start() - radius)
+        end = min(len(content), match.end() + radius)
+    else:
+        # Stemmed match (e.g. "running" for "run") - fall back to the opening
+        start, end = 0, min(len(content), radius * 2)
+    
+    excerpt = content[start:end]
+    highlighted = []
+    last = 0
+    for m in pattern.finditer(excerpt):
+        highlighted.append(html.escape(excerpt[last:m.start()]))
+        highlighted.append(f"<mark>{html.escape(m.group(0))}</mark>")
+        last = m.end()
+    highlighted.append(html.escape(excerpt[last:]))
+    
+    return ("..." if start > 0 else "") + "".join(highlighted) + ("..." if end < len(content) else "")
+
+@api_router.get("/search")
+async def search_conversations(
+    q: str,
+    persona_id: Optional[str] = None,
+    user_id: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    page: int = 1,
+    page_size: int = 20
+):
+    """
+    Full-text search over message content and conversation titles using the
+    text indexes, ranked by textScore. Conversation title matches are only
+    returned with the first page. Scoped to one owner like /conversations.
+    
+    Messages of bucketed and archived conversations aren't in the text
+    index; the first page reports how many of the owner's conversations
+    that leaves out under "not_searched".
+    """
+    user_id = normalize_owner_id(user_id)
+    if user_id is None and not unscoped_reads_allowed():
+        raise HTTPException(status_code=400, detail="user_id is required to search")
+    q = q.strip()
+    if len(q) < 2:
+        raise HTTPException(status_code=400, detail="Search query must be at least 2 characters")
+    if page < 1 or page > SEARCH_MAX_PAGES:
+        raise HTTPException(status_code=400, detail=f"page must be between 1 and {SEARCH_MAX_PAGES}")
+    page_size = max(1, min(page_size, SEARCH_MAX_PAGE_SIZE))
+    
+    started = time.perf_counter()
+    message_query: Dict[str, Any] = {"$text": {"$search": q}}
+    conversation_query: Dict[str, Any] = {"$text": {"$search": q}, **NOT_DELETED}
+    
+    if persona_id:
+        message_query["persona_id"] = persona_id
+    if start or end:
+        date_range = {}
+        if start:
+            date_range["$gte"] = start
+        if end:
+            date_range["$lte"] = end
+        message_query["timestamp"] = date_range
+        conversation_query["updated_at"] = date_range
+    if user_id:
+        message_query["user_id"] = user_id  # Stamped on every message, see store_messages
+        conversation_query["user_id"] = user_id
+    
+    if search_index_build["status"] != "ready":
+        # Until the owner backfill has finished, older messages would silently drop out of scoped results
+        raise HTTPException(status_code=503, detail="Search isn't available yet: the message search index is still being built")
+    
+    score = {"score": {"$meta": "textScore"}}
+    
+    def find_messages():
+        return (db.messages.find(message_query, {"_id": 0, "persona_avatar": 0, "content_compressed": 0, "user_id": 0, **score})
+                .sort([("score", {"$meta": "textScore"})])
+                .skip((page - 1) * page_size)
+                .limit(page_size + 1)  # One extra row tells us whether there is a next page
+                .max_time_ms(SEARCH_MAX_TIME_MS)
+                .to_list(page_size + 1))
+    
+    def find_conversations():
+        return (db.conversations.find(conversation_query, {"_id": 0, "id": 1, "title": 1, "mode": 1, "updated_at": 1, **score})
+                .sort([("score", {"$meta": "textScore"})])
+                .limit(10)
+                .max_time_ms(SEARCH_MAX_TIME_MS)
+                .to_list(10))
+    
+    def count_unsearched(layout: dict):
+        scope = {"user_id": user_id} if user_id else {}
+        return db.conversations.count_documents({**scope, **layout, **NOT_DELETED}, maxTimeMS=SEARCH_MAX_TIME_MS)
+    
+    not_searched = None
+    try:
+        if page == 1:
+            messages, conversations, bucketed, archived = await asyncio.gather(
+                retry_db_operation(find_messages),
+                retry_db_operation(find_conversations),
+                retry_db_operation(lambda: count_unsearched({"storage": "bucket"})),
+                retry_db_operation(lambda: count_unsearched({"archived_at": {"$exists": True}}))
+            )
+            not_searched = {"bucketed_conversations": bucketed, "archived_conversations": archived}
+        else:
+            messages, conversations = await retry_db_operation(find_messages), []
+    except ExecutionTimeout:
+        raise HTTPException(status_code=504, detail="Search took too long - try a more specific query or add filters")
+    except OperationFailure as e:
+        if e.code == 27:  # IndexNotFound: build_search_indexes() hasn't run here yet
+            raise HTTPException(status_code=503, detail="Search isn't available yet: the message search index hasn't been built")
+        raise
+    
+    has_more = len(messages) > page_size
+    messages = messages[:page_size]
+    if messages:
+        # Hits in tombstoned conversations (being deleted, or kept only for their forks) are dropped
+        # here, checking just this page's conversations rather than every tombstone up front
+        page_ids = list({msg['conversation_id'] for msg in messages})
+        tombstoned = await retry_db_operation(lambda: db.conversations.find(
+            {"id": {"$in": page_ids}, "deleted_at": {"$exists": True}}, {"_id": 0, "id": 1}
+        ).to_list(len(page_ids)))
+        if tombstoned:
+            hidden = {conv['id'] for conv in tombstoned}
+            messages = [msg for msg in messages if msg['conversation_id'] not in hidden]
+    terms = parse_search_terms(q)
+    took_ms = (time.perf_counter() - started) * 1000
+    if took_ms > 100:
+        logging.warning(f"Slow search ({took_ms:.0f}ms) for {q!r}")
+    
+    return {
+        "query": q,
+        "page": page,
+        "page_size": page_size,
+        "has_more": has_more,
+        "took_ms": round(took_ms, 1),
+        "not_searched": not_searched,
+        "messages": [
+            {
+                "message_id": msg['id'],
+                "conversation_id": msg['conversation_id'],
+                "persona_id": msg.get('persona_id'),
+                "persona_name": msg.get('persona_name'),
+                "timestamp": msg.get('timestamp'),
+                "score": round(msg['score'], 3),
+                "snippet": build_search_snippet(msg.get('content', ''), terms),
+            }
+            for msg in messages
+        ],
+        "conversations": [
+            {**conv, "score": round(conv['score'], 3), "title_highlighted": build_search_snippet(conv.get('title', ''), terms)}
+            for conv in conversations
+        ],
+    }
+
 def generate_persona_system_prompt(persona: dict, mode: str, mode_instructions: dict, is_direct_mention: bool = False, is_multi_turn: bool = False) -> str:
     """
     Generate comprehensive system prompt using the Persona Summoner and Enforcer framework.
@@ -803,7 +2502,7 @@ KEY PATTERN: When faced with complex topics, you must:
 @api_router.post("/chat/generate-multi")
 async def generate_multi_responses(request: ChatGenerateRequest):
     """Generate initial responses from all active personas to user message"""
-    conv = await db.conversations.find_one({"id": request.conversation_id}, {"_id": 0})
+    conv = await retry_db_operation(lambda: db.conversations.find_one({"id": request.conversation_id, **NOT_DELETED}, {"_id": 0}))
     if not conv:
         raise HTTPException(status_code=404, detail="Conversation not found")
     
@@ -811,7 +2510,11 @@ async def generate_multi_responses(request: ChatGenerateRequest):
     if not active_persona_ids:
         return {"responses": []}
     
-    personas_data = await db.personas.find({"id": {"$in": active_persona_ids}}, {"_id": 0}).to_list(100)
+    # Personas and history are independent reads; fetch them side by side
+    personas_data, all_messages = await asyncio.gather(
+        persona_cache.get_many(active_persona_ids),
+        fetch_messages(request.conversation_id, 50, conv=conv)
+    )
     
     mentioned_personas = []
     user_message_lower = request.user_message.lower()
@@ -852,62 +2555,64 @@ async def generate_multi_responses(request: ChatGenerateRequest):
         "Socratic Debate": "Use question-driven probing, challenge assumptions. Engage with others' points directly."
     }
     
-    all_messages = await db.messages.find({"conversation_id": request.conversation_id}, {"_id": 0}).sort("timestamp", 1).to_list(50)
     context_str = "\n".join([f"{msg['persona_name']}: {msg['content']}" for msg in all_messages[-10:]])
     
     attachment_context = ""
     has_images = False
     image_contents = []
+    described_images = 0
+    use_vision_prepass = VISION_PREPASS if request.vision_prepass is None else request.vision_prepass
     
     if request.attachments:
+        # Fetch all attached links at once rather than one after another
+        url_attachments = [att for att in request.attachments if att['type'] == 'url']
+        url_pages = iter(await asyncio.gather(
+            *[get_url_extract(att.get('url', '')) for att in url_attachments],
+            return_exceptions=True
+        ))
+        # Images (normalised for the vision model) and uploaded files, read alongside the links
+        loaded_attachments = [
+            att for att in request.attachments
+            if att['type'] == 'image' or (att['type'] == 'file' and att.get('attachment_id') and not att.get('extractedText'))
+        ]
+        loaded_contents = iter(await asyncio.gather(
+            *[
+                prepare_image(att, use_vision_prepass) if att['type'] == 'image' else attachment_text(att['attachment_id'])
+                for att in loaded_attachments
+            ],
+            return_exceptions=True
+        ))
+        
         for att in request.attachments:
             if att['type'] == 'image':
+                image = next(loaded_contents)
+                if isinstance(image, BaseException):
+                    logging.warning(f"Failed to load image attachment: {image}")
+                    attachment_context += f"\n[User shared an image that could not be loaded: {att.get('description', 'visual content')}]"
+                    continue
+                base64_data, image_description = image
+                if image_description:
+                    # Described once by the vision pre-pass; personas read the description instead
+                    described_images += 1
+                    attachment_context += f"\n[User shared an image: {att.get('description', 'visual content')}]\nWhat the image shows:\n{image_description}"
+                    continue
                 has_images = True
-                # Extract base64 data from data URL format
-                image_data = att.get('data', '')
-                if image_data.startswith('data:'):
-                    # Format: data:image/png;base64,<base64_data>
-                    base64_data = image_data.split(',', 1)[1] if ',' in image_data else image_data
-                else:
-                    base64_data = image_data
                 
                 # Create ImageContent object for the image
                 image_content = ImageContent(image_base64=base64_data)
                 image_contents.append(image_content)
                 attachment_context += f"\n[User shared an image: {att.get('description', 'visual content')}]"
             elif att['type'] == 'url':
-                # Fetch and extract URL content
+                # Extract the content of the page fetched above
                 url_text = att.get('url', '')
+                page = next(url_pages)
                 try:
-                    # Fetch the URL with timeout
-                    headers = {
-                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-                    }
-                    response = requests.get(url_text, headers=headers, timeout=10)
-                    response.raise_for_status()
-                    
-                    # Parse HTML
-                    soup = BeautifulSoup(response.content, 'html.parser')
-                    
-                    # Remove script and style elements
-                    for script in soup(["script", "style", "nav", "footer", "header"]):
-                        script.decompose()
-                    
-                    # Get text content
-                    text = soup.get_text()
-                    
-                    # Clean up text
-                    lines = (line.strip() for line in text.splitlines())
-                    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-                    text_content = '\n'.join(chunk for chunk in chunks if chunk)
-                    
-                    # Get title
-                    title = soup.find('title')
-                    title_text = title.string if title else url_text
+                    if isinstance(page, BaseException):
+                        raise page
                     
+                    title_text = page['title'] or url_text
                     # Limit text length
-                    if len(text_content) > 1500:
-                        text_content = text_content[:1500]
+                    text_content = page['text'][:1500]
                     
                     attachment_context += f"\n[User shared a web link: {title_text}]\nURL: {url_text}\nContent summary:\n{text_content}"
                 except Exception as e:
@@ -916,6 +2621,12 @@ async def generate_multi_responses(request: ChatGenerateRequest):
             elif att['type'] == 'file':
                 file_name = att.get('name', 'document')
                 extracted_text = att.get('extractedText', '')
+                if att.get('attachment_id') and not extracted_text:
+                    stored_text = next(loaded_contents)
+                    if isinstance(stored_text, BaseException):
+                        logging.warning(f"Failed to read file attachment: {stored_text}")
+                    else:
+                        extracted_text = stored_text or ''
                 
                 if extracted_text:
                     # Include extracted PDF text in context
@@ -937,59 +2648,56 @@ async def generate_multi_responses(request: ChatGenerateRequest):
         "Socratic Debate": "Use question-driven probing, challenge assumptions. Engage with others' points directly."
     }
     
-    for persona in responding_personas:
-        # Use the comprehensive Persona Summoner and Enforcer prompt system
-        system_message = generate_persona_system_prompt(
-            persona=persona,
-            mode=mode,
-            mode_instructions=mode_instructions,
-            is_direct_mention=(persona in mentioned_personas),
-            is_multi_turn=False
-        )
-        
-        api_key = os.environ.get('EMERGENT_LLM_KEY')
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=f"{request.conversation_id}-{persona['id']}",
-            system_message=system_message
-        )
-        
-        # Use vision model when images are present
-        if has_images:
-            chat = chat.with_model("openai", "gpt-4o")
-        else:
-            chat = chat.with_model("openai", "gpt-5.2")
-        
-        prompt = f"Recent conversation:\n{context_str}\n\nRespond as {persona['display_name']}:"
-        
-        # Create message with images if present
-        if has_images and image_contents:
-            user_message = UserMessage(text=prompt, file_contents=image_contents)
-        else:
-            user_message = UserMessage(text=prompt)
-        
-        response_text = await chat.send_message(user_message)
-        
-        msg = Message(
-            conversation_id=request.conversation_id,
-            persona_id=persona['id'],
-            persona_name=persona['display_name'],
-            persona_color=persona.get('color', '#A855F7'),
-            persona_avatar=persona.get('avatar_url') or persona.get('avatar_base64'),
-            content=response_text,
-            is_user=False
-        )
-        
-        doc = msg.model_dump()
-        doc['timestamp'] = doc['timestamp'].isoformat()
-        
-        await db.messages.insert_one(doc)
-        responses.append(msg)
+    if described_images and not has_images:
+        image_description_stats["persona_vision_calls_avoided"] += len(responding_personas)
     
-    await db.conversations.update_one(
-        {"id": request.conversation_id},
-        {"$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
-    )
+    # Replies are inserted together and the conversation touched once when the block exits
+    async with MessageWriteBatch(request.conversation_id, storage=conv.get('storage'), owner_id=conv.get('user_id')) as batch:
+        for persona in responding_personas:
+            # Use the comprehensive Persona Summoner and Enforcer prompt system
+            system_message = generate_persona_system_prompt(
+                persona=persona,
+                mode=mode,
+                mode_instructions=mode_instructions,
+                is_direct_mention=(persona in mentioned_personas),
+                is_multi_turn=False
+            )
+            
+            api_key = os.environ.get('EMERGENT_LLM_KEY')
+            chat = LlmChat(
+                api_key=api_key,
+                session_id=f"{request.conversation_id}-{persona['id']}",
+                system_message=system_message
+            )
+            
+            # Use vision model when images are present
+            if has_images:
+                chat = chat.with_model("openai", "gpt-4o")
+            else:
+                chat = chat.with_model("openai", "gpt-5.2")
+            
+            prompt = f"Recent conversation:\n{context_str}\n\nRespond as {persona['display_name']}:"
+            
+            # Create message with images if present
+            if has_images and image_contents:
+                user_message = UserMessage(text=prompt, file_contents=image_contents)
+            else:
+                user_message = UserMessage(text=prompt)
+            
+            response_text = await chat.send_message(user_message)
+            
+            msg = Message(
+                conversation_id=request.conversation_id,
+                persona_id=persona['id'],
+                persona_name=persona['display_name'],
+                persona_color=persona.get('color', '#A855F7'),
+                persona_avatar=persona.get('avatar_url') or persona.get('avatar_base64'),
+                content=response_text,
+                is_user=False
+            )
+            
+            batch.add(msg)
+            responses.append(msg)
     
     return {"responses": responses}
 
@@ -1001,8 +2709,9 @@ async def continue_discussion(request: dict):
     """
     conversation_id = request.get('conversation_id')
     max_rounds = request.get('max_rounds', 2)  # Limit to prevent infinite loops
+    extend_request_deadline(REQUEST_DEADLINE_SECONDS * max(1, max_rounds))
     
-    conv = await db.conversations.find_one({"id": conversation_id}, {"_id": 0})
+    conv = await retry_db_operation(lambda: db.conversations.find_one({"id": conversation_id, **NOT_DELETED}, {"_id": 0}))
     if not conv:
         raise HTTPException(status_code=404, detail="Conversation not found")
     
@@ -1010,7 +2719,7 @@ async def continue_discussion(request: dict):
     if not active_persona_ids or len(active_persona_ids) < 2:
         return {"responses": [], "rounds_completed": 0}
     
-    personas_data = await db.personas.find({"id": {"$in": active_persona_ids}}, {"_id": 0}).to_list(100)
+    personas_data = await persona_cache.get_many(active_persona_ids)
     mode = conv['mode']
     
     mode_instructions = {
@@ -1022,78 +2731,76 @@ async def continue_discussion(request: dict):
     
     all_responses = []
     
-    for round_num in range(max_rounds):
-        # Get recent conversation context (last 15 messages)
-        all_messages = await db.messages.find({"conversation_id": conversation_id}, {"_id": 0}).sort("timestamp", 1).to_list(100)
-        recent_context = all_messages[-15:]
-        
-        # Build context string showing the ongoing discussion
-        context_str = "Recent discussion:\n" + "\n".join([
-            f"{msg['persona_name']}: {msg['content'][:200]}..." if len(msg['content']) > 200 else f"{msg['persona_name']}: {msg['content']}"
-            for msg in recent_context
-        ])
-        
-        # Select 2-3 personas to respond in this round (not all at once for natural flow)
-        num_speakers = min(random.randint(2, 3), len(personas_data))
-        round_personas = random.sample(personas_data, num_speakers)
-        
-        round_responses = []
-        
-        for persona in round_personas:
-            # Use the comprehensive Persona Summoner and Enforcer prompt system
-            system_message = generate_persona_system_prompt(
-                persona=persona,
-                mode=mode,
-                mode_instructions=mode_instructions,
-                is_direct_mention=False,
-                is_multi_turn=True
-            )
+    async with MessageWriteBatch(conversation_id, storage=conv.get('storage'), owner_id=conv.get('user_id')) as batch:
+        for round_num in range(max_rounds):
+            # Get recent conversation context (last 15 messages)
+            all_messages = await fetch_messages(conversation_id, 100, conv=conv)
+            recent_context = all_messages[-15:]
+            
+            # Build context string showing the ongoing discussion
+            context_str = "Recent discussion:\n" + "\n".join([
+                f"{msg['persona_name']}: {msg['content'][:200]}..." if len(msg['content']) > 200 else f"{msg['persona_name']}: {msg['content']}"
+                for msg in recent_context
+            ])
+            
+            # Select 2-3 personas to respond in this round (not all at once for natural flow)
+            num_speakers = min(random.randint(2, 3), len(personas_data))
+            round_personas = random.sample(personas_data, num_speakers)
+            
+            round_responses = []
+            
+            for persona in round_personas:
+                # Use the comprehensive Persona Summoner and Enforcer prompt system
+                system_message = generate_persona_system_prompt(
+                    persona=persona,
+                    mode=mode,
+                    mode_instructions=mode_instructions,
+                    is_direct_mention=False,
+                    is_multi_turn=True
+                )
+                
+                prompt = f"{context_str}\n\nAs {persona['display_name']}, respond naturally to the discussion above. What are your thoughts?"
+                
+                api_key = os.environ.get('EMERGENT_LLM_KEY')
+                chat = LlmChat(
+                    api_key=api_key,
+                    session_id=f"{conversation_id}-{persona['id']}-round{round_num}",
+                    system_message=system_message
+                ).with_model("openai", "gpt-5.2")
+                
+                try:
+                    response_text = await chat.send_message(UserMessage(text=prompt))
+                    
+                    # Only add if persona actually has something to say
+                    if response_text and len(response_text.strip()) > 10:
+                        msg = Message(
+                            conversation_id=conversation_id,
+                            persona_id=persona['id'],
+                            persona_name=persona['display_name'],
+                            persona_color=persona.get('color', '#A855F7'),
+                            persona_avatar=persona.get('avatar_url') or persona.get('avatar_base64'),
+                            content=response_text,
+                            is_user=False
+                        )
+                        
+                        batch.add(msg)
+                        round_responses.append(msg)
+                        all_responses.append(msg)
+                except Exception as e:
+                    logging.error(f"Error generating response for {persona['display_name']}: {e}")
+                    continue
             
-            prompt = f"{context_str}\n\nAs {persona['display_name']}, respond naturally to the discussion above. What are your thoughts?"
+            # Persist the round so the next one sees it in its context
+            await batch.flush()
+            if batch.conversation_deleted:
+                break
             
-            api_key = os.environ.get('EMERGENT_LLM_KEY')
-            chat = LlmChat(
-                api_key=api_key,
-                session_id=f"{conversation_id}-{persona['id']}-round{round_num}",
-                system_message=system_message
-            ).with_model("openai", "gpt-5.2")
+            # If no one had anything to say, end the discussion
+            if not round_responses:
+                break
             
-            try:
-                response_text = await chat.send_message(UserMessage(text=prompt))
-                
-                # Only add if persona actually has something to say
-                if response_text and len(response_text.strip()) > 10:
-                    msg = Message(
-                        conversation_id=conversation_id,
-                        persona_id=persona['id'],
-                        persona_name=persona['display_name'],
-                        persona_color=persona.get('color', '#A855F7'),
-                        persona_avatar=persona.get('avatar_url') or persona.get('avatar_base64'),
-                        content=response_text,
-                        is_user=False
-                    )
-                    
-                    doc = msg.model_dump()
-                    doc['timestamp'] = doc['timestamp'].isoformat()
-                    await db.messages.insert_one(doc)
-                    
-                    round_responses.append(msg)
-                    all_responses.append(msg)
-            except Exception as e:
-                logging.error(f"Error generating response for {persona['display_name']}: {e}")
-                continue
-        
-        # If no one had anything to say, end the discussion
-        if not round_responses:
-            break
-        
-        # Small delay between rounds for natural pacing
-        await asyncio.sleep(0.5)
-    
-    await db.conversations.update_one(
-        {"id": conversation_id},
-        {"$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
-    )
+            # Small delay between rounds for natural pacing
+            await asyncio.sleep(0.5)
     
     return {"responses": all_responses, "rounds_completed": len(all_responses) // 2}
 
@@ -1104,8 +2811,9 @@ async def autorun_discussion(request: dict):
     """
     conversation_id = request.get('conversation_id')
     duration_seconds = request.get('duration_seconds', 300)  # Default 5 minutes
+    extend_request_deadline(duration_seconds + REQUEST_DEADLINE_SECONDS)
     
-    conv = await db.conversations.find_one({"id": conversation_id}, {"_id": 0})
+    conv = await retry_db_operation(lambda: db.conversations.find_one({"id": conversation_id, **NOT_DELETED}, {"_id": 0}))
     if not conv:
         raise HTTPException(status_code=404, detail="Conversation not found")
     
@@ -1113,7 +2821,7 @@ async def autorun_discussion(request: dict):
     if not active_persona_ids or len(active_persona_ids) < 2:
         raise HTTPException(status_code=400, detail="Need at least 2 active personas")
     
-    personas_data = await db.personas.find({"id": {"$in": active_persona_ids}}, {"_id": 0}).to_list(100)
+    personas_data = await persona_cache.get_many(active_persona_ids)
     mode = conv['mode']
     
     mode_instructions = {
@@ -1129,75 +2837,73 @@ async def autorun_discussion(request: dict):
     total_responses = []
     
     # Keep discussing until time runs out
-    while datetime.now(timezone.utc).timestamp() < end_time:
-        round_num += 1
-        
-        # Get recent conversation context
-        all_messages = await db.messages.find({"conversation_id": conversation_id}, {"_id": 0}).sort("timestamp", 1).to_list(200)
-        recent_context = all_messages[-15:]
-        
-        context_str = "Recent discussion:\n" + "\n".join([
-            f"{msg['persona_name']}: {msg['content'][:200]}..." if len(msg['content']) > 200 else f"{msg['persona_name']}: {msg['content']}"
-            for msg in recent_context
-        ])
-        
-        # Select 2-3 personas to respond in this round
-        num_speakers = min(random.randint(2, 3), len(personas_data))
-        round_personas = random.sample(personas_data, num_speakers)
-        
-        for persona in round_personas:
-            # Check time limit
-            if datetime.now(timezone.utc).timestamp() >= end_time:
-                break
-                
-            # Use the comprehensive Persona Summoner and Enforcer prompt system
-            system_message = generate_persona_system_prompt(
-                persona=persona,
-                mode=mode,
-                mode_instructions=mode_instructions,
-                is_direct_mention=False,
-                is_multi_turn=True
-            )
+    async with MessageWriteBatch(conversation_id, storage=conv.get('storage'), owner_id=conv.get('user_id')) as batch:
+        while datetime.now(timezone.utc).timestamp() < end_time:
+            round_num += 1
             
-            prompt = f"{context_str}\n\nContinue the discussion as {persona['display_name']}. What are your thoughts?"
+            # Get recent conversation context
+            all_messages = await fetch_messages(conversation_id, 200, conv=conv)
+            recent_context = all_messages[-15:]
             
-            api_key = os.environ.get('EMERGENT_LLM_KEY')
-            chat = LlmChat(
-                api_key=api_key,
-                session_id=f"{conversation_id}-autorun-{persona['id']}-{round_num}",
-                system_message=system_message
-            ).with_model("openai", "gpt-5.2")
+            context_str = "Recent discussion:\n" + "\n".join([
+                f"{msg['persona_name']}: {msg['content'][:200]}..." if len(msg['content']) > 200 else f"{msg['persona_name']}: {msg['content']}"
+                for msg in recent_context
+            ])
             
-            try:
-                response_text = await chat.send_message(UserMessage(text=prompt))
-                
-                if response_text and len(response_text.strip()) > 10:
-                    msg = Message(
-                        conversation_id=conversation_id,
-                        persona_id=persona['id'],
-                        persona_name=persona['display_name'],
-                        persona_color=persona.get('color', '#A855F7'),
-                        persona_avatar=persona.get('avatar_url') or persona.get('avatar_base64'),
-                        content=response_text,
-                        is_user=False
-                    )
+            # Select 2-3 personas to respond in this round
+            num_speakers = min(random.randint(2, 3), len(personas_data))
+            round_personas = random.sample(personas_data, num_speakers)
+            
+            for persona in round_personas:
+                # Check time limit
+                if datetime.now(timezone.utc).timestamp() >= end_time:
+                    break
                     
-                    doc = msg.model_dump()
-                    doc['timestamp'] = doc['timestamp'].isoformat()
-                    await db.messages.insert_one(doc)
+                # Use the comprehensive Persona Summoner and Enforcer prompt system
+                system_message = generate_persona_system_prompt(
+                    persona=persona,
+                    mode=mode,
+                    mode_instructions=mode_instructions,
+                    is_direct_mention=False,
+                    is_multi_turn=True
+                )
+                
+                prompt = f"{context_str}\n\nContinue the discussion as {persona['display_name']}. What are your thoughts?"
+                
+                api_key = os.environ.get('EMERGENT_LLM_KEY')
+                chat = LlmChat(
+                    api_key=api_key,
+                    session_id=f"{conversation_id}-autorun-{persona['id']}-{round_num}",
+                    system_message=system_message
+                ).with_model("openai", "gpt-5.2")
+                
+                try:
+                    response_text = await chat.send_message(UserMessage(text=prompt))
                     
-                    total_responses.append(msg)
-            except Exception as e:
-                logging.error(f"Autorun error for {persona['display_name']}: {e}")
-                continue
-        
-        # Small delay between rounds
-        await asyncio.sleep(2)
-    
-    await db.conversations.update_one(
-        {"id": conversation_id},
-        {"$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
-    )
+                    if response_text and len(response_text.strip()) > 10:
+                        msg = Message(
+                            conversation_id=conversation_id,
+                            persona_id=persona['id'],
+                            persona_name=persona['display_name'],
+                            persona_color=persona.get('color', '#A855F7'),
+                            persona_avatar=persona.get('avatar_url') or persona.get('avatar_base64'),
+                            content=response_text,
+                            is_user=False
+                        )
+                        
+                        batch.add(msg)
+                        total_responses.append(msg)
+                except Exception as e:
+                    logging.error(f"Autorun error for {persona['display_name']}: {e}")
+                    continue
+            
+            # Persist the round so the next one sees it in its context
+            await batch.flush()
+            if batch.conversation_deleted:
+                break
+            
+            # Small delay between rounds
+            await asyncio.sleep(2)
     
     return {
         "responses": total_responses,
@@ -1351,37 +3057,426 @@ async def generate_speech(request: dict):
         logging.error(f"TTS generation failed: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to generate speech: {str(e)}")
 
+URL_FETCH_MAX_BYTES = int(os.environ.get('URL_FETCH_MAX_BYTES', str(1024 * 1024)))  # Stop reading a page after this many bytes
+URL_FETCH_TIMEOUT_SECONDS = float(os.environ.get('URL_FETCH_TIMEOUT_SECONDS', '10'))  # Whole fetch, not per read
+URL_FETCH_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+URL_FETCH_TEXT_TYPES = {"application/xhtml+xml", "application/xml"}  # Besides text/*
+
+url_fetch_stats = {
+    "fetches": 0,
+    "bytes_downloaded": 0,
+    "truncated": 0,
+    "rejected_content_type": 0,
+    "errors": 0,
+}
+url_fetch_latency = LatencyStats()
+
+class UnsupportedContentType(Exception):
+    """The server answered with something we can't extract text from"""
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """Process-wide pooled client for outbound fetches, created on first use"""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            headers=URL_FETCH_HEADERS,
+            follow_redirects=True,
+            timeout=httpx.Timeout(URL_FETCH_TIMEOUT_SECONDS, connect=5.0),
+            limits=httpx.Limits(
+                max_connections=int(os.environ.get('URL_FETCH_MAX_CONNECTIONS', '50')),
+                max_keepalive_connections=int(os.environ.get('URL_FETCH_MAX_KEEPALIVE', '20')),
+            ),
+        )
+    return _http_client
+
+async def _stream_page(url: str, max_bytes: int, headers: Optional[dict]) -> dict:
+    async with get_http_client().stream("GET", url, headers=headers) as response:
+        page = {
+            "url": str(response.url),
+            "etag": response.headers.get("etag"),
+            "last_modified": response.headers.get("last-modified"),
+            "not_modified": response.status_code == 304,
+        }
+        if page['not_modified']:
+            return {**page, "content": b"", "content_type": None, "encoding": None, "truncated": False}
+        response.raise_for_status()
+        content_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+        if content_type and not (content_type.startswith("text/") or content_type in URL_FETCH_TEXT_TYPES):
+            # Decided from the headers alone, before any of the body is read
+            raise UnsupportedContentType(content_type)
+        
+        chunks = []
+        size = 0
+        truncated = False
+        async for chunk in response.aiter_bytes():
+            chunks.append(chunk[:max_bytes - size])
+            size += len(chunks[-1])
+            if size >= max_bytes:
+                truncated = True
+                break
+        return {
+            **page,
+            "content": b"".join(chunks),
+            "content_type": content_type,
+            "encoding": response.charset_encoding,
+            "truncated": truncated,
+        }
+
+async def fetch_url(url: str, max_bytes: int = URL_FETCH_MAX_BYTES, headers: Optional[dict] = None) -> dict:
+    """
+    GET a web page over the shared client, streaming at most max_bytes of
+    the body. Conditional requests (If-None-Match / If-Modified-Since in
+    headers) come back with not_modified set and no content on a 304.
+    Raises UnsupportedContentType for non-text responses,
+    httpx.HTTPError for transport and status errors and asyncio.TimeoutError
+    when the whole fetch takes longer than URL_FETCH_TIMEOUT_SECONDS.
+    """
+    started = time.perf_counter()
+    url_fetch_stats["fetches"] += 1
+    try:
+        page = await asyncio.wait_for(_stream_page(url, max_bytes, headers), timeout=URL_FETCH_TIMEOUT_SECONDS)
+    except UnsupportedContentType:
+        url_fetch_stats["rejected_content_type"] += 1
+        raise
+    except Exception:
+        url_fetch_stats["errors"] += 1
+        raise
+    
+    url_fetch_latency.record((time.perf_counter() - started) * 1000)
+    url_fetch_stats["bytes_downloaded"] += len(page['content'])
+    if page['truncated']:
+        url_fetch_stats["truncated"] += 1
+    return page
+
+# Worker processes for CPU-heavy parsing (see extraction.py); 0 runs it on the default thread pool instead
+EXTRACTION_WORKERS = int(os.environ.get('EXTRACTION_WORKERS', str(min(4, os.cpu_count() or 1))))
+_extraction_pool: Optional[ProcessPoolExecutor] = None
+html_extract_latency = LatencyStats()
+
+def get_extraction_pool() -> Optional[ProcessPoolExecutor]:
+    global _extraction_pool
+    if _extraction_pool is None and EXTRACTION_WORKERS > 0:
+        # spawn, not fork: children must not inherit the event loop or the Mongo client's threads
+        _extraction_pool = ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _extraction_pool
+
+async def run_extraction(fn, *args):
+    """Run a function from extraction.py off the event loop, in the worker pool"""
+    global _extraction_pool
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(get_extraction_pool(), fn, *args)
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM on a huge page); start a fresh pool for the next caller
+        _extraction_pool = None
+        raise
+
+async def extract_html(content: bytes, encoding: Optional[str]) -> tuple:
+    started = time.perf_counter()
+    result = await run_extraction(extract_html_text, content, encoding)
+    html_extract_latency.record((time.perf_counter() - started) * 1000)
+    return result
+
+URL_CACHE_TTL_SECONDS = float(os.environ.get('URL_CACHE_TTL_SECONDS', '900'))  # Revalidate with a conditional GET after this
+URL_CACHE_MAX_ENTRIES = int(os.environ.get('URL_CACHE_MAX_ENTRIES', '500'))
+URL_CACHE_MAX_TEXT_CHARS = 20000  # Callers only ever use the first few thousand characters
+TRACKING_QUERY_PARAMS = {"fbclid", "gclid", "mc_cid", "mc_eid", "ref_src"}
+
+url_cache: "OrderedDict[str, dict]" = OrderedDict()
+url_extract_flights = SingleFlight()
+url_cache_stats = {
+    "hits": 0,
+    "misses": 0,
+    "revalidated": 0,  # 304 Not Modified
+    "refetched": 0,  # Expired and changed (or no validators)
+    "stale_served": 0,  # Revalidation failed, cached copy used
+    "bytes_saved": 0,
+}
+
+def normalize_url(url: str) -> str:
+    """Cache key: lower-case scheme and host, no default port, fragment or tracking parameters"""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and (scheme, parts.port) not in (("http", 80), ("https", 443)):
+        host = f"{host}:{parts.port}"
+    query = urlencode([
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.startswith("utm_") and key not in TRACKING_QUERY_PARAMS
+    ])
+    return urlunsplit((scheme, host, parts.path or "/", query, ""))
+
+async def _load_url_extract(key: str, url: str, cached: Optional[dict]) -> dict:
+    headers = {}
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+    
+    try:
+        page = await fetch_url(url, headers=headers or None)
+    except Exception as e:
+        if cached is None:
+            raise
+        logging.warning(f"Revalidating {url} failed, serving cached copy: {e}")
+        url_cache_stats["stale_served"] += 1
+        return cached
+    
+    if page['not_modified'] and cached:
+        url_cache_stats["revalidated"] += 1
+        url_cache_stats["bytes_saved"] += cached['raw_bytes']
+        entry = {**cached, "fetched_at": time.monotonic()}
+    else:
+        if cached:
+            url_cache_stats["refetched"] += 1
+        title, text = await extract_html(page['content'], page['encoding'])
+        entry = {
+            "url": page['url'],
+            "title": title,
+            "text": text[:URL_CACHE_MAX_TEXT_CHARS],
+            "etag": page['etag'],
+            "last_modified": page['last_modified'],
+            "raw_bytes": len(page['content']),
+            "fetched_at": time.monotonic(),
+        }
+    
+    url_cache[key] = entry
+    url_cache.move_to_end(key)
+    while len(url_cache) > URL_CACHE_MAX_ENTRIES:
+        url_cache.popitem(last=False)
+    return entry
+
+async def get_url_extract(url: str) -> dict:
+    """
+    Title and text of a web page, from the cache while fresh. Expired entries
+    are revalidated with a conditional GET, and concurrent requests for the
+    same page share one fetch.
+    """
+    key = normalize_url(url)
+    cached = url_cache.get(key)
+    if cached and time.monotonic() - cached['fetched_at'] < URL_CACHE_TTL_SECONDS:
+        url_cache_stats["hits"] += 1
+        url_cache_stats["bytes_saved"] += cached['raw_bytes']
+        url_cache.move_to_end(key)
+        return cached
+    
+    url_cache_stats["misses"] += 1
+    return await url_extract_flights.run(key, None, lambda: _load_url_extract(key, url, cached))
+
+PDF_MAX_PAGES = int(os.environ.get('PDF_MAX_PAGES', '200'))  # Pages past this are skipped and the result marked truncated
+PDF_EXTRACT_TIMEOUT_SECONDS = float(os.environ.get('PDF_EXTRACT_TIMEOUT_SECONDS', '60'))  # Whole document
+PDF_EXTRACT_WORKERS = int(os.environ.get('PDF_EXTRACT_WORKERS', '2'))  # Documents extracted at once; each gets its own process
+PDF_CACHE_TTL_DAYS = int(os.environ.get('PDF_CACHE_TTL_DAYS', '30'))  # 0 keeps cached extracts forever
+
+pdf_extract_flights = SingleFlight()
+pdf_extract_latency = LatencyStats()
+pdf_extract_stats = {
+    "extractions": 0,
+    "cache_hits": 0,
+    "pages_extracted": 0,
+    "truncated": 0,
+    "timeouts": 0,
+}
+
+class PdfWorker:
+    """
+    One PDF extraction process. A document has it to itself from the page
+    count to the last page, so a timeout can kill exactly the process that
+    is stuck without touching anyone else's extraction.
+    """
+    
+    def __init__(self):
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=pdf_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+    
+    async def send(self, message, deadline: float):
+        loop = asyncio.get_running_loop()
+        await asyncio.wait_for(asyncio.to_thread(self.conn.send, message), timeout=max(0.0, deadline - loop.time()))
+    
+    async def receive(self, deadline: float):
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(asyncio.to_thread(self.conn.recv), timeout=max(0.0, deadline - loop.time()))
+    
+    def kill(self):
+        # A thread still blocked in recv() gets EOFError once the process is gone
+        self.process.kill()
+        self.process.join(timeout=1)
+
+_idle_pdf_workers: List[PdfWorker] = []
+_pdf_worker_slots: Optional[asyncio.Semaphore] = None
+
+def pdf_worker_slots() -> asyncio.Semaphore:
+    global _pdf_worker_slots
+    if _pdf_worker_slots is None:
+        _pdf_worker_slots = asyncio.Semaphore(max(1, PDF_EXTRACT_WORKERS))
+    return _pdf_worker_slots
+
+def kill_pdf_workers():
+    while _idle_pdf_workers:
+        _idle_pdf_workers.pop().kill()
+
+def decode_pdf_payload(pdf_base64: str) -> tuple:
+    """Raw bytes and SHA-256 of a (possibly data-URL prefixed) base64 PDF"""
+    # Remove data URL prefix if present
+    if 'base64,' in pdf_base64:
+        pdf_base64 = pdf_base64.split('base64,')[1]
+    pdf_bytes = base64.b64decode(pdf_base64)
+    return pdf_bytes, hashlib.sha256(pdf_bytes).hexdigest()
+
+async def stream_pdf_pages(pdf_bytes: bytes):
+    """
+    Yield ("count", page_count), then ("page", text) for each page up to
+    PDF_MAX_PAGES as the worker extracts it. Documents queue for one of
+    PDF_EXTRACT_WORKERS processes; the timeout starts once one is theirs.
+    """
+    async with pdf_worker_slots():
+        worker = _idle_pdf_workers.pop() if _idle_pdf_workers else await asyncio.to_thread(PdfWorker)
+        finished = False
+        try:
+            deadline = asyncio.get_running_loop().time() + PDF_EXTRACT_TIMEOUT_SECONDS
+            await worker.send((pdf_bytes, PDF_MAX_PAGES), deadline)
+            while True:
+                kind, value = await worker.receive(deadline)
+                if kind == "done":
+                    finished = True
+                    return
+                if kind == "error":
+                    finished = True  # The document was bad, the worker is fine
+                    raise ValueError(value)
+                yield kind, value
+        except asyncio.TimeoutError:
+            pdf_extract_stats["timeouts"] += 1
+            raise
+        finally:
+            # A worker left mid-document (timeout, crash, client gone) still has pages to send; replace it
+            if finished and worker.process.is_alive():
+                _idle_pdf_workers.append(worker)
+            else:
+                worker.kill()
+
+async def save_pdf_extract(sha256: str, pages: List[str], page_count: int) -> dict:
+    extract = {
+        "_id": sha256,
+        "pages": pages,
+        "page_count": page_count,
+        "truncated": page_count > len(pages),
+        "created_at": datetime.now(timezone.utc),
+    }
+    pdf_extract_stats["extractions"] += 1
+    pdf_extract_stats["pages_extracted"] += len(pages)
+    if extract['truncated']:
+        pdf_extract_stats["truncated"] += 1
+    try:
+        await retry_db_operation(lambda: db.pdf_extracts.replace_one({"_id": sha256}, extract, upsert=True))
+    except PyMongoError as e:
+        # e.g. a huge document over the 16MB limit; the result is still good, just not cached
+        logger.warning(f"Could not cache PDF extract {sha256[:12]}: {e}")
+    return extract
+
+async def find_pdf_extract(sha256: str) -> Optional[dict]:
+    cached = await retry_db_operation(lambda: db.pdf_extracts.find_one({"_id": sha256}))
+    if cached:
+        pdf_extract_stats["cache_hits"] += 1
+        return {**cached, "cached": True}
+    return None
+
+async def load_pdf_extract(sha256: str, pdf_bytes: bytes) -> dict:
+    cached = await find_pdf_extract(sha256)
+    if cached:
+        return cached
+    return await run_pdf_extract(sha256, pdf_bytes)
+
+async def run_pdf_extract(sha256: str, pdf_bytes: bytes) -> dict:
+    started = time.perf_counter()
+    page_count = 0
+    pages = []
+    async for kind, value in stream_pdf_pages(pdf_bytes):
+        if kind == "count":
+            page_count = value
+        else:
+            pages.append(value)
+    pdf_extract_latency.record((time.perf_counter() - started) * 1000)
+    return await save_pdf_extract(sha256, pages, page_count)
+
+async def stream_pdf_extract(sha256: str, pdf_bytes: bytes):
+    """NDJSON lines: a summary line, then one line per page as soon as it is extracted"""
+    def line(obj: dict) -> bytes:
+        return (json.dumps(obj) + "\n").encode()
+    
+    try:
+        cached = await find_pdf_extract(sha256)
+        if cached:
+            yield line({"pages": cached['page_count'], "pages_extracted": len(cached['pages']), "truncated": cached['truncated'], "cached": True})
+            for page_num, text in enumerate(cached['pages'], start=1):
+                yield line({"page": page_num, "text": text})
+        else:
+            started = time.perf_counter()
+            page_count = 0
+            pages = []
+            async for kind, value in stream_pdf_pages(pdf_bytes):
+                if kind == "count":
+                    page_count = value
+                    pages_to_extract = min(page_count, PDF_MAX_PAGES)
+                    yield line({"pages": page_count, "pages_extracted": pages_to_extract, "truncated": page_count > pages_to_extract, "cached": False})
+                else:
+                    pages.append(value)
+                    yield line({"page": len(pages), "text": value})
+            pdf_extract_latency.record((time.perf_counter() - started) * 1000)
+            await save_pdf_extract(sha256, pages, page_count)
+        yield line({"done": True})
+    except asyncio.TimeoutError:
+        yield line({"error": "PDF extraction timed out"})
+    except Exception as e:
+        logging.error(f"PDF extraction failed: {e}")
+        yield line({"error": f"Failed to extract PDF text: {str(e)}"})
+
 @api_router.post("/extract-pdf")
 async def extract_pdf_text(request: dict):
     """
-    Extract text from PDF file
+    Extract text from PDF file. Runs in worker processes with a timeout and
+    page limit; results are cached by the SHA-256 of the file, so uploading
+    the same PDF again is instant. With {"stream": true} pages come back as
+    NDJSON lines while they are being extracted. Files uploaded through
+    /attachments are passed as {"attachment_id": ...} instead of pdf_data.
     """
     pdf_base64 = request.get('pdf_data', '')
+    attachment_id = request.get('attachment_id')
     
-    if not pdf_base64:
+    if not pdf_base64 and not attachment_id:
         raise HTTPException(status_code=400, detail="No PDF data provided")
     
+    stored = await open_attachment(attachment_id) if attachment_id else None
+    
     try:
-        # Remove data URL prefix if present
-        if 'base64,' in pdf_base64:
-            pdf_base64 = pdf_base64.split('base64,')[1]
-        
-        # Decode base64
-        pdf_bytes = base64.b64decode(pdf_base64)
+        if stored is not None:
+            # Attachment ids are the SHA-256 of the file, the same key the extract cache uses
+            pdf_bytes, sha256 = await stored.read(), attachment_id
+        else:
+            pdf_bytes, sha256 = await asyncio.to_thread(decode_pdf_payload, pdf_base64)
         
-        # Extract text from PDF
-        pdf_reader = PyPDF2.PdfReader(BytesIO(pdf_bytes))
-        text_content = ""
+        if request.get('stream'):
+            return StreamingResponse(stream_pdf_extract(sha256, pdf_bytes), media_type="application/x-ndjson")
         
-        for page_num in range(len(pdf_reader.pages)):
-            page = pdf_reader.pages[page_num]
-            text_content += page.extract_text() + "\n\n"
+        # Identical uploads in flight at the same time share one extraction
+        extract = await pdf_extract_flights.run(sha256, None, lambda: load_pdf_extract(sha256, pdf_bytes))
         
         return {
-            "text": text_content.strip(),
-            "pages": len(pdf_reader.pages)
+            "text": "\n\n".join(extract['pages']).strip(),
+            "pages": extract['page_count'],
+            "pages_extracted": len(extract['pages']),
+            "truncated": extract['truncated'],
+            "cached": extract.get('cached', False),
         }
-        
+    
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=f"PDF extraction took longer than {PDF_EXTRACT_TIMEOUT_SECONDS:.0f}s")
     except Exception as e:
         logging.error(f"PDF extraction failed: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to extract PDF text: {str(e)}")
@@ -1397,33 +3492,9 @@ async def extract_url_content(request: dict):
         raise HTTPException(status_code=400, detail="No URL provided")
     
     try:
-        # Set headers to mimic a browser
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        
-        # Fetch the URL with timeout
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        
-        # Parse HTML
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
-        # Remove script and style elements
-        for script in soup(["script", "style", "nav", "footer", "header"]):
-            script.decompose()
-        
-        # Get text content
-        text = soup.get_text()
-        
-        # Clean up text
-        lines = (line.strip() for line in text.splitlines())
-        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        text_content = '\n'.join(chunk for chunk in chunks if chunk)
-        
-        # Get title
-        title = soup.find('title')
-        title_text = title.string if title else url
+        page = await get_url_extract(url)
+        title_text = page['title'] or url
+        text_content = page['text']
         
         # Limit text length
         if len(text_content) > 5000:
@@ -1436,12 +3507,423 @@ async def extract_url_content(request: dict):
             "success": True
         }
         
-    except requests.exceptions.Timeout:
+    except (asyncio.TimeoutError, httpx.TimeoutException):
         raise HTTPException(status_code=504, detail="URL request timed out")
-    except requests.exceptions.RequestException as e:
+    except UnsupportedContentType as e:
+        raise HTTPException(status_code=415, detail=f"Unsupported content type: {e}")
+    except (httpx.HTTPError, httpx.InvalidURL) as e:
         logging.error(f"URL extraction failed: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to extract URL content: {str(e)}")
 
+ATTACHMENT_MAX_BYTES = int(os.environ.get('ATTACHMENT_MAX_BYTES', str(25 * 1024 * 1024)))
+ATTACHMENT_SPOOL_BYTES = int(os.environ.get('ATTACHMENT_SPOOL_BYTES', str(1024 * 1024)))  # Raw uploads past this go to a temp file instead of memory
+ATTACHMENT_READ_CHUNK_BYTES = 256 * 1024
+ATTACHMENT_FORM_OVERHEAD_BYTES = 64 * 1024  # Multipart boundaries and part headers on top of the file itself
+ATTACHMENT_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+# What the vision models accept as is; other images (HEIC, BMP, TIFF...) are accepted too and
+# converted to JPEG by normalize_image() before a vision call. SVG is refused, it can carry script.
+VISION_NATIVE_IMAGE_TYPES = {"image/png", "image/jpeg", "image/gif", "image/webp"}
+ATTACHMENT_TYPES = {
+    *VISION_NATIVE_IMAGE_TYPES,
+    "application/pdf",
+    "text/plain",
+    "application/msword",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+}
+
+_attachment_bucket: Optional[AsyncIOMotorGridFSBucket] = None
+_attachment_locks: Dict[str, asyncio.Lock] = {}
+attachment_upload_latency = LatencyStats()
+attachment_stats = {
+    "uploads": 0,
+    "deduplicated": 0,
+    "bytes_received": 0,
+    "spooled_to_disk": 0,
+    "rejected": 0,
+    "reads": 0,
+}
+
+# Browsers send an empty type for formats the OS doesn't know, typically HEIC photos
+mimetypes.add_type("image/heic", ".heic")
+mimetypes.add_type("image/heif", ".heif")
+
+def resolve_attachment_type(declared: str, filename: Optional[str]) -> str:
+    """The upload's media type, guessed from the file name when the client didn't say"""
+    declared = declared.split(";")[0].strip().lower()
+    if declared in ("", "application/octet-stream") and filename:
+        guessed, _ = mimetypes.guess_type(filename)
+        return guessed or declared
+    return declared
+
+def attachment_type_allowed(content_type: str) -> bool:
+    return content_type in ATTACHMENT_TYPES or (content_type.startswith("image/") and content_type != "image/svg+xml")
+
+def get_attachment_bucket() -> AsyncIOMotorGridFSBucket:
+    global _attachment_bucket
+    if _attachment_bucket is None:
+        _attachment_bucket = AsyncIOMotorGridFSBucket(db, bucket_name="attachments")
+    return _attachment_bucket
+
+def reject_upload(status_code: int, detail: str):
+    attachment_stats["rejected"] += 1
+    raise HTTPException(status_code=status_code, detail=detail)
+
+async def spool_upload(chunks) -> tuple:
+    """
+    Copy a streamed request body into a temp spool, hashing as it arrives.
+    At most ATTACHMENT_SPOOL_BYTES of it is ever held in memory.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_BYTES)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > ATTACHMENT_MAX_BYTES:
+                reject_upload(413, f"Attachments are limited to {ATTACHMENT_MAX_BYTES // (1024 * 1024)}MB")
+            digest.update(chunk)
+            spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    if getattr(spool, "_rolled", False):
+        attachment_stats["spooled_to_disk"] += 1
+    spool.seek(0)
+    return spool, digest.hexdigest(), size
+
+async def capped_stream(chunks, max_bytes: int):
+    """Pass a request body through, rejecting it as soon as more than max_bytes have arrived"""
+    size = 0
+    async for chunk in chunks:
+        size += len(chunk)
+        if size > max_bytes:
+            reject_upload(413, f"Attachments are limited to {ATTACHMENT_MAX_BYTES // (1024 * 1024)}MB")
+        yield chunk
+
+async def hash_upload(upload) -> tuple:
+    """Hash a multipart file part; Starlette has already spooled it to disk past 1MB"""
+    digest = hashlib.sha256()
+    size = 0
+    while chunk := await upload.read(ATTACHMENT_READ_CHUNK_BYTES):
+        size += len(chunk)
+        if size > ATTACHMENT_MAX_BYTES:
+            reject_upload(413, f"Attachments are limited to {ATTACHMENT_MAX_BYTES // (1024 * 1024)}MB")
+        digest.update(chunk)
+    await upload.seek(0)
+    if getattr(upload.file, "_rolled", False):
+        attachment_stats["spooled_to_disk"] += 1
+    return upload.file, digest.hexdigest(), size
+
+async def store_attachment(sha256: str, source, size: int, filename: str, content_type: str) -> bool:
+    """Content-addressed: identical bytes are stored once. False if they already were."""
+    # Identical uploads arriving together take turns; the later ones find the file already stored.
+    # Letting them race would be worse than slow: a GridFS upload that hits a duplicate chunk
+    # aborts by deleting every chunk with its id, including the winner's.
+    lock = _attachment_locks.setdefault(sha256, asyncio.Lock())
+    try:
+        async with lock:
+            existing = await retry_db_operation(lambda: db["attachments.files"].find_one({"_id": sha256}, {"_id": 1}))
+            if existing:
+                return False
+            # GridFS reads the spool a chunk at a time, so the file never has to fit in memory
+            await get_attachment_bucket().upload_from_stream_with_id(
+                sha256, filename, source,
+                metadata={"content_type": content_type, "size": size},
+            )
+            return True
+    finally:
+        if _attachment_locks.get(sha256) is lock and not lock.locked():
+            del _attachment_locks[sha256]
+
+async def open_attachment(attachment_id: str):
+    if not ATTACHMENT_ID_PATTERN.match(attachment_id or ""):
+        raise HTTPException(status_code=400, detail="Invalid attachment id")
+    try:
+        grid_out = await get_attachment_bucket().open_download_stream(attachment_id)
+    except NoFile:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    attachment_stats["reads"] += 1
+    return grid_out
+
+def attachment_content_type(grid_out) -> str:
+    return (grid_out.metadata or {}).get("content_type", "application/octet-stream")
+
+async def attachment_text(attachment_id: str) -> Optional[str]:
+    """Text of an uploaded PDF (through the PDF extract cache) or plain-text file; None for other types"""
+    cached = await find_pdf_extract(attachment_id)
+    if cached:
+        return "\n\n".join(cached['pages']).strip()
+    grid_out = await open_attachment(attachment_id)
+    content_type = attachment_content_type(grid_out)
+    if content_type == "application/pdf":
+        pdf_bytes = await grid_out.read()
+        extract = await pdf_extract_flights.run(attachment_id, None, lambda: run_pdf_extract(attachment_id, pdf_bytes))
+        return "\n\n".join(extract['pages']).strip()
+    if content_type == "text/plain":
+        return (await grid_out.read()).decode("utf-8", errors="replace")
+    return None
+
+@api_router.post("/attachments")
+async def upload_attachment(request: Request, filename: Optional[str] = None):
+    """
+    Upload an image or document once and refer to it by id afterwards
+    ({"type": "image" | "file", "attachment_id": ...} in chat attachments,
+    {"attachment_id": ...} for /extract-pdf) instead of sending base64 blobs.
+    Accepts multipart/form-data with a "file" field, or the raw file as the
+    request body with its own Content-Type and ?filename=. The id is the
+    SHA-256 of the contents, so re-uploading a file costs no extra storage.
+    """
+    started = time.perf_counter()
+    declared_length = request.headers.get("content-length")
+    if declared_length and declared_length.isdigit() and int(declared_length) > ATTACHMENT_MAX_BYTES + ATTACHMENT_FORM_OVERHEAD_BYTES:
+        reject_upload(413, f"Attachments are limited to {ATTACHMENT_MAX_BYTES // (1024 * 1024)}MB")
+    
+    request_type = request.headers.get("content-type", "")
+    form = upload = None
+    if request_type.startswith("multipart/form-data"):
+        # Parsed from a capped stream: request.form() would spool a chunked body of any size to disk
+        body = capped_stream(request.stream(), ATTACHMENT_MAX_BYTES + ATTACHMENT_FORM_OVERHEAD_BYTES)
+        try:
+            form = await MultiPartParser(request.headers, body, max_files=1, max_fields=10).parse()
+        except MultiPartException as exc:
+            raise HTTPException(status_code=400, detail=exc.message)
+        upload = form.get("file")
+        if not isinstance(upload, StarletteUploadFile):
+            await form.close()
+            raise HTTPException(status_code=400, detail="No file field in upload")
+        filename = upload.filename or filename
+        content_type = resolve_attachment_type(upload.content_type or "", filename)
+    else:
+        content_type = resolve_attachment_type(request_type, filename)
+    
+    try:
+        if not attachment_type_allowed(content_type):
+            reject_upload(415, f"Unsupported attachment type: {content_type or 'unknown'}")
+        
+        source, sha256, size = await (hash_upload(upload) if upload is not None else spool_upload(request.stream()))
+        try:
+            if size == 0:
+                raise HTTPException(status_code=400, detail="Empty upload")
+            filename = filename or "attachment"
+            stored = await store_attachment(sha256, source, size, filename, content_type)
+        finally:
+            source.close()
+    finally:
+        if form is not None:
+            await form.close()
+    
+    attachment_stats["uploads"] += 1
+    attachment_stats["bytes_received"] += size
+    if not stored:
+        attachment_stats["deduplicated"] += 1
+    attachment_upload_latency.record((time.perf_counter() - started) * 1000)
+    
+    return {
+        "id": sha256,
+        "filename": filename,
+        "content_type": content_type,
+        "size": size,
+        "deduplicated": not stored,
+    }
+
+@api_router.get("/attachments/{attachment_id}")
+async def download_attachment(attachment_id: str):
+    grid_out = await open_attachment(attachment_id)
+    
+    async def chunks():
+        while chunk := await grid_out.readchunk():
+            yield chunk
+    
+    return StreamingResponse(
+        chunks(),
+        media_type=attachment_content_type(grid_out),
+        headers={
+            "Content-Length": str(grid_out.length),
+            "ETag": f'"{attachment_id}"',
+            "Cache-Control": "private, max-age=31536000, immutable",  # Content-addressed, never changes
+            "X-Content-Type-Options": "nosniff",
+        },
+    )
+
+VISION_IMAGE_NORMALIZE = os.environ.get('VISION_IMAGE_NORMALIZE', 'true').lower() == 'true'
+# gpt-4o fits a high-detail image into 2048x2048, then scales its short side down to 768;
+# pixels beyond that are uploaded, tokenised and paid for but never seen
+VISION_IMAGE_MAX_LONG_SIDE = int(os.environ.get('VISION_IMAGE_MAX_LONG_SIDE', '2048'))
+VISION_IMAGE_MAX_SHORT_SIDE = int(os.environ.get('VISION_IMAGE_MAX_SHORT_SIDE', '768'))
+VISION_IMAGE_QUALITY = int(os.environ.get('VISION_IMAGE_QUALITY', '85'))
+VISION_IMAGE_CACHE_MAX_BYTES = int(os.environ.get('VISION_IMAGE_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+
+vision_image_cache: "OrderedDict[str, str]" = OrderedDict()  # SHA-256 of the original -> base64 JPEG
+vision_image_flights = SingleFlight()
+vision_image_latency = LatencyStats()
+vision_image_stats = {
+    "normalized": 0,
+    "cache_hits": 0,
+    "failures": 0,
+    "bytes_in": 0,
+    "bytes_out": 0,
+    "cache_bytes": 0,
+}
+
+def decode_image_payload(image_data: str) -> bytes:
+    # Format: data:image/png;base64,<base64_data>
+    if image_data.startswith('data:'):
+        image_data = image_data.split(',', 1)[1] if ',' in image_data else image_data
+    return base64.b64decode(image_data)
+
+def cache_vision_image(sha256: str, encoded: str):
+    previous = vision_image_cache.pop(sha256, None)
+    if previous is not None:
+        vision_image_stats["cache_bytes"] -= len(previous)
+    vision_image_cache[sha256] = encoded
+    vision_image_stats["cache_bytes"] += len(encoded)
+    while vision_image_stats["cache_bytes"] > VISION_IMAGE_CACHE_MAX_BYTES and len(vision_image_cache) > 1:
+        _, evicted = vision_image_cache.popitem(last=False)
+        vision_image_stats["cache_bytes"] -= len(evicted)
+
+def cached_vision_image(sha256: str) -> Optional[str]:
+    encoded = vision_image_cache.get(sha256)
+    if encoded is not None:
+        vision_image_cache.move_to_end(sha256)
+        vision_image_stats["cache_hits"] += 1
+    return encoded
+
+async def _normalize_vision_image(sha256: str, image_bytes: bytes, native: bool = True) -> str:
+    started = time.perf_counter()
+    try:
+        jpeg, _, _ = await run_extraction(
+            normalize_image, image_bytes, VISION_IMAGE_MAX_LONG_SIDE, VISION_IMAGE_MAX_SHORT_SIDE, VISION_IMAGE_QUALITY
+        )
+    except Exception as e:
+        vision_image_stats["failures"] += 1
+        logger.warning(f"Could not normalise image {sha256[:12]}: {e}")
+        if not native:
+            # e.g. HEIC without pillow-heif installed; the model would reject the original too
+            raise RuntimeError(f"Could not convert the image for the vision model: {e}")
+        # Something Pillow can't read in a format the model takes; let the model try the original
+        return base64.b64encode(image_bytes).decode()
+    vision_image_latency.record((time.perf_counter() - started) * 1000)
+    vision_image_stats["normalized"] += 1
+    vision_image_stats["bytes_in"] += len(image_bytes)
+    vision_image_stats["bytes_out"] += len(jpeg)
+    encoded = base64.b64encode(jpeg).decode()
+    cache_vision_image(sha256, encoded)
+    return encoded
+
+async def vision_image_base64(att: dict) -> str:
+    """
+    Base64 of an attached image as sent to the vision model: downscaled to
+    the model's effective resolution, metadata stripped, re-encoded as JPEG.
+    Cached by the SHA-256 of the original, which for uploads is their id.
+    """
+    attachment_id = att.get('attachment_id')
+    if attachment_id:
+        cached = cached_vision_image(attachment_id)
+        if cached is not None:
+            return cached
+        grid_out = await open_attachment(attachment_id)
+        native = attachment_content_type(grid_out) in VISION_NATIVE_IMAGE_TYPES
+        image_bytes, sha256 = await grid_out.read(), attachment_id
+    else:
+        image_data = att.get('data', '')
+        # data:image/heic;base64,... - anything without a type is assumed to be a format the model takes
+        declared = image_data[5:].split(';', 1)[0].split(',', 1)[0].lower() if image_data.startswith('data:') else ""
+        native = not declared or declared in VISION_NATIVE_IMAGE_TYPES
+        if not VISION_IMAGE_NORMALIZE and native:
+            return image_data.split(',', 1)[1] if image_data.startswith('data:') and ',' in image_data else image_data
+        image_bytes = await asyncio.to_thread(decode_image_payload, image_data)
+        sha256 = hashlib.sha256(image_bytes).hexdigest()
+        cached = cached_vision_image(sha256)
+        if cached is not None:
+            return cached
+    
+    if not VISION_IMAGE_NORMALIZE and native:
+        return base64.b64encode(image_bytes).decode()
+    # The same picture attached to concurrent requests is only processed once. Formats the model
+    # doesn't take are converted even with VISION_IMAGE_NORMALIZE off.
+    return await vision_image_flights.run(sha256, None, lambda: _normalize_vision_image(sha256, image_bytes, native))
+
+# One vision call describes each image; every persona then answers from the description with the
+# text model instead of sending the pixels again. Off by default: personas only see what the
+# description mentions. Requests can override with "vision_prepass".
+VISION_PREPASS = os.environ.get('VISION_PREPASS', 'false').lower() == 'true'
+VISION_PREPASS_MODEL = os.environ.get('VISION_PREPASS_MODEL', 'gpt-4o')
+IMAGE_DESCRIPTION_TTL_DAYS = int(os.environ.get('IMAGE_DESCRIPTION_TTL_DAYS', '30'))  # 0 keeps descriptions forever
+VISION_PREPASS_SYSTEM_PROMPT = (
+    "You describe images for other assistants who cannot see them. They will discuss the image "
+    "with the user based only on what you write, so be thorough, concrete and neutral. "
+    "Never address the user and never speculate beyond what is visible without saying so."
+)
+VISION_PREPASS_PROMPT = """Describe this image using exactly these sections:
+
+SUMMARY: one or two sentences on what the image is (photo, screenshot, chart, meme, document...) and its subject.
+CONTENTS: the people, objects, animals and places shown, with positions, counts, colours and actions.
+TEXT: every piece of legible text, verbatim, in reading order. "None" if there is none.
+DATA: for charts, tables, diagrams or code: the values, labels, axes, structure and trends. "None" otherwise.
+STYLE AND MOOD: composition, lighting, art style, tone.
+NOTABLE DETAILS: anything small, unusual, humorous or likely to be what the user wants to talk about.
+UNCERTAIN: things you cannot make out or are guessing at."""
+
+image_description_flights = SingleFlight()
+image_description_latency = LatencyStats()
+image_description_stats = {
+    "described": 0,
+    "cache_hits": 0,
+    "failures": 0,
+    "persona_vision_calls_avoided": 0,
+}
+
+async def _load_image_description(key: str, base64_data: str) -> str:
+    cached = await retry_db_operation(lambda: db.image_descriptions.find_one({"_id": key}, {"description": 1}))
+    if cached:
+        image_description_stats["cache_hits"] += 1
+        return cached['description']
+    
+    started = time.perf_counter()
+    chat = LlmChat(
+        api_key=os.environ.get('EMERGENT_LLM_KEY'),
+        session_id=f"vision-prepass-{key[:16]}",
+        system_message=VISION_PREPASS_SYSTEM_PROMPT
+    ).with_model("openai", VISION_PREPASS_MODEL)
+    description = (await chat.send_message(
+        UserMessage(text=VISION_PREPASS_PROMPT, file_contents=[ImageContent(image_base64=base64_data)])
+    ) or "").strip()
+    if not description:
+        raise ValueError("Vision model returned an empty description")
+    image_description_latency.record((time.perf_counter() - started) * 1000)
+    image_description_stats["described"] += 1
+    
+    try:
+        await retry_db_operation(lambda: db.image_descriptions.replace_one(
+            {"_id": key},
+            {"_id": key, "description": description, "model": VISION_PREPASS_MODEL, "created_at": datetime.now(timezone.utc)},
+            upsert=True
+        ))
+    except PyMongoError as e:
+        logger.warning(f"Could not cache image description {key[:12]}: {e}")
+    return description
+
+async def describe_image(base64_data: str) -> str:
+    """
+    Structured text description of an image from one vision call, cached by
+    the SHA-256 of the exact (normalised) image the model was shown.
+    """
+    key = hashlib.sha256(base64_data.encode()).hexdigest()
+    return await image_description_flights.run(key, None, lambda: _load_image_description(key, base64_data))
+
+async def prepare_image(att: dict, describe: bool) -> tuple:
+    """Normalised base64 image and, in pre-pass mode, its description (None if that failed)"""
+    base64_data = await vision_image_base64(att)
+    if not describe:
+        return base64_data, None
+    try:
+        return base64_data, await describe_image(base64_data)
+    except Exception as e:
+        # This image falls back to being sent to every persona
+        image_description_stats["failures"] += 1
+        logger.warning(f"Vision pre-pass failed: {e}")
+        return base64_data, None
+
 @api_router.post("/tts/generate")
 async def generate_tts(request: dict):
     """
@@ -1487,10 +3969,7 @@ async def export_pdf(request: dict):
     
     if not messages:
         # Fetch from database if not provided
-        messages = await db.messages.find(
-            {"conversation_id": conversation_id}, 
-            {"_id": 0}
-        ).sort("timestamp", 1).to_list(1000)
+        messages = await fetch_messages(conversation_id, 1000, endpoint="export_pdf")
     
     # Create PDF in memory
     buffer = BytesIO()
@@ -1533,6 +4012,8 @@ async def export_pdf(request: dict):
         persona_name = msg.get('persona_name', 'Unknown')
         content = msg.get('content', '')
         timestamp = msg.get('timestamp', '')
+        if isinstance(timestamp, datetime):
+            timestamp = timestamp.strftime('%Y-%m-%d %H:%M UTC')
         
         # Escape HTML characters
         content = content.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
@@ -1641,7 +4122,7 @@ async def seed_default_personas():
     created = []
     
     # Get existing count
-    existing_count = await db.personas.count_documents({})
+    existing_count = await retry_db_operation(lambda: db.personas.count_documents({}))
     logger.info(f"📊 Existing personas in DB: {existing_count}")
     
     # Only create if database is empty
@@ -1660,7 +4141,8 @@ async def seed_default_personas():
             logger.error(f"❌ Failed to create {p['display_name']}: {str(e)}")
             continue
     
-    final_count = await db.personas.count_documents({})
+    persona_cache.invalidate()
+    final_count = await retry_db_operation(lambda: db.personas.count_documents({}))
     logger.info(f"🎉 Seed complete: {len(created)} created, {final_count} total in DB")
     
     return {
@@ -1678,7 +4160,7 @@ async def force_create_personas():
     """
     try:
         # DELETE ALL PERSONAS
-        delete_result = await db.personas.delete_many({})
+        delete_result = await retry_db_operation(lambda: db.personas.delete_many({}))
         logger.info(f"🗑️ Deleted {delete_result.deleted_count} existing personas")
         
         # CREATE FRESH PERSONAS - NO CHECKS, JUST CREATE
@@ -1692,14 +4174,15 @@ async def force_create_personas():
         
         # INSERT ALL AT ONCE
         insert_result = await db.personas.insert_many(personas)
+        persona_cache.invalidate()
         logger.info(f"✅ Inserted {len(insert_result.inserted_ids)} personas")
         
         # VERIFY
-        count = await db.personas.count_documents({})
+        count = await retry_db_operation(lambda: db.personas.count_documents({}))
         logger.info(f"📊 Final count: {count}")
         
         # GET ALL AND RETURN
-        all_personas = await db.personas.find({}, {"_id": 0}).to_list(100)
+        all_personas = await retry_db_operation(lambda: db.personas.find({}, {"_id": 0}).to_list(100))
         
         return {
             "success": True,
@@ -1725,7 +4208,7 @@ async def fix_broken_avatars():
     generated = []
     
     # Get all personas
-    all_personas = await db.personas.find({}, {"_id": 0}).to_list(1000)
+    all_personas = await retry_db_operation(lambda: db.personas.find({}, {"_id": 0}).to_list(1000))
     
     for persona in all_personas:
         persona_id = persona['id']
@@ -1776,10 +4259,11 @@ async def fix_broken_avatars():
         
         # Update if needed
         if needs_update:
-            await db.personas.update_one(
+            await retry_db_operation(lambda: db.personas.update_one(
                 {"id": persona_id},
                 {"$set": update_data}
-            )
+            ))
+            persona_cache.invalidate(persona_id)
     
     return {
         "message": "Avatar fix complete",
@@ -1836,6 +4320,301 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Keep strong references to fire-and-forget tasks so they aren't garbage collected mid-run
+_background_tasks = set()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+# Progress of cascade deletes started by this worker, most recent last
+deletion_jobs: "OrderedDict[str, dict]" = OrderedDict()
+MAX_TRACKED_DELETION_JOBS = 1000
+
+async def cascade_delete_conversation(conversation_id: str):
+    """
+    Remove a tombstoned conversation's messages in small batches with a pause
+    in between, so deleting a huge autorun conversation doesn't spike the
+    primary. The conversation document itself goes last; if the worker dies
+    half way the tombstone stays and the job is resumed at the next startup.
+    A conversation that still has forks keeps its messages until the last
+    fork is gone, whose own cascade then finishes the job.
+    """
+    if deletion_jobs.get(conversation_id, {}).get('status') == "running":
+        return
+    
+    batch_size = int(os.environ.get('CASCADE_DELETE_BATCH_SIZE', '500'))
+    pause_seconds = float(os.environ.get('CASCADE_DELETE_PAUSE_SECONDS', '0.1'))
+    job = {"status": "running", "messages_deleted": 0, "started_at": datetime.now(timezone.utc)}
+    deletion_jobs[conversation_id] = job
+    deletion_jobs.move_to_end(conversation_id)
+    while len(deletion_jobs) > MAX_TRACKED_DELETION_JOBS:
+        deletion_jobs.popitem(last=False)
+    
+    try:
+        if await retry_db_operation(lambda: db.conversations.find_one({"fork_lineage.conversation_id": conversation_id}, {"_id": 1})):
+            job['status'] = "retained_for_forks"
+            await retry_db_operation(lambda: db.conversations.update_one(
+                {"id": conversation_id},
+                {"$set": {"deletion": {"status": "retained_for_forks", "messages_deleted": 0, "updated_at": datetime.now(timezone.utc)}}}
+            ))
+            return
+        conv = await retry_db_operation(lambda: db.conversations.find_one({"id": conversation_id}, {"_id": 0, "fork_lineage": 1})) or {}
+        
+        while True:
+            batch = await retry_db_operation(lambda: db.messages.find({"conversation_id": conversation_id}, {"_id": 1}).limit(batch_size).to_list(batch_size))
+            if not batch:
+                break
+            
+            result = await retry_db_operation(lambda: db.messages.delete_many({"_id": {"$in": [doc['_id'] for doc in batch]}}))
+            job['messages_deleted'] += result.deleted_count
+            await retry_db_operation(lambda: db.conversations.update_one(
+                {"id": conversation_id},
+                {"$set": {"deletion": {"status": "running", "messages_deleted": job['messages_deleted'], "updated_at": datetime.now(timezone.utc)}}}
+            ))
+            await asyncio.sleep(pause_seconds)
+        
+        # Buckets hold at most a few hundred messages each, so they go in one call
+        bucketed = await count_bucketed_messages(conversation_id)
+        await retry_db_operation(lambda: db.message_buckets.delete_many({"conversation_id": conversation_id}))
+        job['messages_deleted'] += bucketed
+        await retry_db_operation(lambda: db.message_archives.delete_one({"conversation_id": conversation_id}))
+        await retry_db_operation(lambda: db.conversations.delete_one({"id": conversation_id, "deleted_at": {"$exists": True}}))
+        job['status'] = "completed"
+        job['completed_at'] = datetime.now(timezone.utc)
+        logger.info(f"Cascade delete of {conversation_id} finished: {job['messages_deleted']} messages removed")
+        
+        # Deleted ancestors that were only kept around for this fork can go now
+        ancestor_ids = [entry['conversation_id'] for entry in conv.get('fork_lineage') or []]
+        if ancestor_ids:
+            pending = await retry_db_operation(lambda: db.conversations.find(
+                {"id": {"$in": ancestor_ids}, "deleted_at": {"$exists": True}}, {"_id": 0, "id": 1}
+            ).to_list(len(ancestor_ids)))
+            for ancestor in pending:
+                run_in_background(cascade_delete_conversation(ancestor['id']))
+    except Exception as e:
+        job['status'] = "failed"
+        job['error'] = str(e)
+        logger.error(f"Cascade delete of {conversation_id} failed, will resume on next startup: {e}")
+
+guest_expiry_stats = {
+    "runs": 0,
+    "conversations_expired": 0,
+    "messages_deleted": 0,
+    "last_run_at": None,
+}
+
+async def expire_guest_conversations(ttl_days: int, limit: int = 100) -> dict:
+    """
+    Tombstone conversations of guest owners (ids with no users record) that
+    have been idle for ttl_days, then remove them through the regular
+    cascade delete so messages, buckets and archives all go with them.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(days=ttl_days)
+    candidates = await retry_db_operation(lambda: db.conversations.aggregate([
+        {"$match": {"updated_at": {"$lt": cutoff}, "user_id": {"$type": "string"}, **NOT_DELETED}},
+        {"$lookup": {
+            "from": "users",
+            "localField": "user_id",
+            "foreignField": "id",
+            "pipeline": [{"$project": {"_id": 1}}],
+            "as": "owner",
+        }},
+        {"$match": {"owner": {"$size": 0}}},
+        {"$limit": limit},
+        {"$project": {"_id": 0, "id": 1}},
+    ]).to_list(limit))
+    if not candidates:
+        return {"conversations_expired": 0, "messages_deleted": 0}
+    
+    # Same tombstone as delete_conversation; the updated_at guard skips guests who came back meanwhile
+    now = datetime.now(timezone.utc)
+    ids = [conv['id'] for conv in candidates]
+    await retry_db_operation(lambda: db.conversations.update_many(
+        {"id": {"$in": ids}, "updated_at": {"$lt": cutoff}, **NOT_DELETED},
+        {"$set": {"deleted_at": now, "deletion": {"status": "pending", "reason": "guest_expired", "messages_deleted": 0, "updated_at": now}}}
+    ))
+    expired = await retry_db_operation(lambda: db.conversations.find(
+        {"id": {"$in": ids}, "deleted_at": now}, {"_id": 0, "id": 1}
+    ).to_list(len(ids)))
+    
+    messages_deleted = 0
+    for conv in expired:
+        await cascade_delete_conversation(conv['id'])
+        messages_deleted += deletion_jobs.get(conv['id'], {}).get('messages_deleted', 0)
+    
+    guest_expiry_stats["conversations_expired"] += len(expired)
+    guest_expiry_stats["messages_deleted"] += messages_deleted
+    return {"conversations_expired": len(expired), "messages_deleted": messages_deleted}
+
+async def resume_pending_deletions():
+    """Restart cascade deletes that were interrupted by a restart"""
+    tombstones = await retry_db_operation(lambda: db.conversations.find({"deleted_at": {"$exists": True}}, {"_id": 0, "id": 1}).to_list(1000))
+    for conv in tombstones:
+        await cascade_delete_conversation(conv['id'])
+
+# Date fields that older deployments stored as ISO strings via .isoformat()
+DATETIME_FIELDS = {
+    "users": ["created_at"],
+    "personas": ["created_at"],
+    "conversations": ["created_at", "updated_at"],
+    "messages": ["timestamp"],
+}
+
+async def migrate_datetime_fields(batch_size: int = 500, pause_seconds: float = 0.05):
+    """
+    Online migration converting ISO-string dates to native BSON dates.
+    Walks each collection in _id order in small batches and stores a
+    checkpoint in db.migrations after every batch, so a restart resumes
+    where it stopped instead of rescanning converted documents.
+    """
+    for collection_name, fields in DATETIME_FIELDS.items():
+        collection = db[collection_name]
+        checkpoint_id = f"bson_datetimes:{collection_name}"
+        checkpoint = await retry_db_operation(lambda: db.migrations.find_one({"_id": checkpoint_id})) or {}
+        if checkpoint.get("completed"):
+            continue
+        
+        last_id = checkpoint.get("last_id")
+        converted = 0
+        
+        while True:
+            query = {"$or": [{field: {"$type": "string"}} for field in fields]}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            
+            batch = await collection.find(query, {field: 1 for field in fields}).sort("_id", 1).limit(batch_size).to_list(batch_size)
+            if not batch:
+                break
+            
+            operations = []
+            for doc in batch:
+                updates = {}
+                for field in fields:
+                    value = doc.get(field)
+                    if not isinstance(value, str):
+                        continue
+                    try:
+                        parsed = datetime.fromisoformat(value)
+                    except ValueError:
+                        logger.warning(f"Skipping unparseable {collection_name}.{field} on {doc['_id']}: {value!r}")
+                        continue
+                    if parsed.tzinfo is None:
+                        parsed = parsed.replace(tzinfo=timezone.utc)
+                    updates[field] = parsed
+                
+                if updates:
+                    # Only convert if the string is unchanged, so concurrent writers always win
+                    guard = {"_id": doc["_id"], **{field: doc[field] for field in updates}}
+                    operations.append(UpdateOne(guard, {"$set": updates}))
+            
+            if operations:
+                result = await collection.bulk_write(operations, ordered=False)
+                converted += result.modified_count
+            
+            last_id = batch[-1]["_id"]
+            await retry_db_operation(lambda: db.migrations.update_one(
+                {"_id": checkpoint_id},
+                {"$set": {"last_id": last_id, "updated_at": datetime.now(timezone.utc)}},
+                upsert=True
+            ))
+            await asyncio.sleep(pause_seconds)
+        
+        await retry_db_operation(lambda: db.migrations.update_one(
+            {"_id": checkpoint_id},
+            {"$set": {"completed": True, "updated_at": datetime.now(timezone.utc)}, "$inc": {"converted": converted}},
+            upsert=True
+        ))
+        logger.info(f"BSON date migration finished for {collection_name}: {converted} documents converted")
+
+async def run_datetime_migration():
+    try:
+        await migrate_datetime_fields(
+            batch_size=int(os.environ.get('DATETIME_MIGRATION_BATCH_SIZE', '500'))
+        )
+    except Exception as e:
+        # Safe to retry: the next startup resumes from the last checkpoint
+        logger.error(f"BSON date migration interrupted: {e}")
+
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '0'))  # 0 disables the archiver
+ARCHIVE_INTERVAL_SECONDS = int(os.environ.get('ARCHIVE_INTERVAL_SECONDS', '3600'))
+
+GUEST_CONVERSATION_TTL_DAYS = int(os.environ.get('GUEST_CONVERSATION_TTL_DAYS', '0'))  # 0 keeps guest conversations forever
+GUEST_SWEEP_INTERVAL_SECONDS = int(os.environ.get('GUEST_SWEEP_INTERVAL_SECONDS', '3600'))
+GUEST_SWEEP_BATCH_SIZE = int(os.environ.get('GUEST_SWEEP_BATCH_SIZE', '100'))
+
+async def run_guest_sweeper():
+    """Periodically delete guest conversations idle for GUEST_CONVERSATION_TTL_DAYS, a batch at a time"""
+    while True:
+        try:
+            while True:
+                result = await expire_guest_conversations(GUEST_CONVERSATION_TTL_DAYS, limit=GUEST_SWEEP_BATCH_SIZE)
+                if result['conversations_expired']:
+                    logger.info(f"Expired {result['conversations_expired']} guest conversations ({result['messages_deleted']} messages)")
+                if result['conversations_expired'] < GUEST_SWEEP_BATCH_SIZE:
+                    break
+            guest_expiry_stats["runs"] += 1
+            guest_expiry_stats["last_run_at"] = datetime.now(timezone.utc)
+        except Exception as e:
+            logger.error(f"Guest sweeper pass failed: {e}")
+        await asyncio.sleep(GUEST_SWEEP_INTERVAL_SECONDS)
+
+async def run_archiver():
+    """Periodically move conversations inactive for ARCHIVE_AFTER_DAYS into cold storage"""
+    while True:
+        try:
+            archived = await archive_inactive_conversations(ARCHIVE_AFTER_DAYS)
+            if archived:
+                logger.info(f"Archived {archived} inactive conversations")
+        except Exception as e:
+            logger.error(f"Archiver pass failed: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+
+@app.on_event("startup")
+async def ensure_indexes():
+    """Create the indexes the handlers rely on (no-op if they already exist)"""
+    try:
+        await db.personas.create_index("sort_order")
+        await db.messages.create_index([("conversation_id", 1), ("timestamp", 1)])
+        await db.conversations.create_index("deleted_at", sparse=True)
+        await db.conversations.create_index("updated_at")
+        await db.conversations.create_index([("user_id", 1), ("updated_at", -1)])
+        await db.message_archives.create_index("conversation_id", unique=True)
+        await db.conversations.create_index("archiving_at", sparse=True)  # Stale archiving passes to recover
+        await db.message_buckets.create_index([("conversation_id", 1), ("seq", 1)], unique=True)
+        await db.users.create_index("id")  # Owner lookups of the guest sweeper
+        await db.conversations.create_index("fork_lineage.conversation_id", sparse=True)
+        if PDF_CACHE_TTL_DAYS > 0:
+            await db.pdf_extracts.create_index("created_at", expireAfterSeconds=PDF_CACHE_TTL_DAYS * 86400)
+        if IMAGE_DESCRIPTION_TTL_DAYS > 0:
+            await db.image_descriptions.create_index("created_at", expireAfterSeconds=IMAGE_DESCRIPTION_TTL_DAYS * 86400)
+        await db.conversations.create_index([("title", "text")], name="conversations_title_text", default_language="english")
+    except Exception as e:
+        logger.warning(f"Index creation failed: {e}")
+
+@app.on_event("startup")
+async def start_background_jobs():
+    if os.environ.get('DATETIME_MIGRATION_ENABLED', 'true').lower() == 'true':
+        run_in_background(run_datetime_migration())
+    run_in_background(resume_pending_deletions())
+    if os.environ.get('SEARCH_INDEX_BUILD_ON_STARTUP', 'true').lower() == 'true':
+        run_in_background(build_search_indexes())
+    if ARCHIVE_AFTER_DAYS > 0:
+        run_in_background(run_archiver())
+    if GUEST_CONVERSATION_TTL_DAYS > 0:
+        run_in_background(run_guest_sweeper())
+    if os.environ.get('PERSONA_CACHE_CHANGE_STREAM', 'false').lower() == 'true':
+        run_in_background(watch_persona_changes())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    # Don't lose generated replies that are still buffered
+    await MessageWriteBatch.flush_all()
+    if _http_client is not None:
+        await _http_client.aclose()
+    if _extraction_pool is not None:
+        _extraction_pool.shutdown(wait=False, cancel_futures=True)
+    kill_pdf_workers()
     client.close()
\ No newline at end of file
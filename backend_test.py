@@ -32,6 +32,8 @@ class MultiPersonaChatTester:
                 response = requests.post(url, json=data, headers=headers, timeout=30)
             elif method == 'PUT':
                 response = requests.put(url, json=data, headers=headers, timeout=30)
+            elif method == 'PATCH':
+                response = requests.patch(url, json=data, headers=headers, timeout=30)
             elif method == 'DELETE':
                 response = requests.delete(url, headers=headers, timeout=30)
 
@@ -90,6 +92,47 @@ class MultiPersonaChatTester:
             print(f"   Persona: {response.get('display_name', 'Unknown')}")
         return success
 
+    def test_reorder_personas(self):
+        """Test bulk persona reorder returns matched/modified counts"""
+        if not self.persona_ids:
+            print("❌ No persona IDs available for testing")
+            return False
+        
+        orders = [{"id": pid, "sort_order": idx} for idx, pid in enumerate(reversed(self.persona_ids))]
+        success, response = self.run_test("Reorder Personas", "POST", "personas/reorder", 200, {"orders": orders})
+        if success:
+            print(f"   Matched: {response.get('matched')}, Modified: {response.get('modified')}")
+            if response.get('matched') != len(orders):
+                print(f"❌ Expected {len(orders)} matched personas")
+                return False
+        
+        # Duplicate ids must be rejected before touching the database
+        duplicate_orders = [{"id": self.persona_ids[0], "sort_order": 0}, {"id": self.persona_ids[0], "sort_order": 1}]
+        rejected, _ = self.run_test("Reorder Personas (duplicate ids)", "POST", "personas/reorder", 400, {"orders": duplicate_orders})
+        return success and rejected
+
+    def test_patch_persona(self):
+        """Test partial persona update returns a slim response and bumps the version"""
+        if not self.persona_ids:
+            print("❌ No persona IDs available for testing")
+            return False
+        
+        persona_id = self.persona_ids[0]
+        success, first = self.run_test("Patch Persona Color", "PATCH", f"personas/{persona_id}", 200, {"color": "#4ADE80"})
+        if not success:
+            return False
+        if 'avatar_base64' in first or 'avatar_url' in first:
+            print("❌ PATCH response should not include the avatar blob")
+            return False
+        
+        success, second = self.run_test("Patch Persona Tags", "PATCH", f"personas/{persona_id}", 200, {"tags": ["patched"]})
+        if success and second.get('version', 0) <= first.get('version', 0):
+            print(f"❌ Expected version to increase ({first.get('version')} -> {second.get('version')})")
+            return False
+        
+        rejected, _ = self.run_test("Patch Persona (null name)", "PATCH", f"personas/{persona_id}", 400, {"display_name": None})
+        return success and rejected
+
     def test_create_custom_persona(self):
         """Test creating a custom persona"""
         persona_data = {
@@ -157,6 +200,19 @@ class MultiPersonaChatTester:
             print(f"   Found {len(response)} messages")
         return success
 
+    def test_search_messages(self):
+        """Test full-text search over messages and titles"""
+        success, response = self.run_test("Search Messages", "GET", "search?q=test%20message", 200)
+        if success:
+            messages = response.get('messages', [])
+            print(f"   Found {len(messages)} matching messages in {response.get('took_ms')}ms")
+            if messages and '<mark>' not in messages[0].get('snippet', ''):
+                print("❌ Expected highlighted snippet")
+                return False
+        
+        rejected, _ = self.run_test("Search (too short)", "GET", "search?q=a", 400)
+        return success and rejected
+
     def create_test_image(self, text="TEST IMAGE", width=200, height=200):
         """Create a simple test image with text"""
         try:
@@ -1126,11 +1182,14 @@ def main():
         ("Get Personas", tester.test_get_personas),
         ("🔍 Persona Avatar URL Validation", tester.test_persona_avatar_urls),
         ("Get Single Persona", tester.test_get_single_persona),
+        ("Reorder Personas", tester.test_reorder_personas),
+        ("Patch Persona", tester.test_patch_persona),
         ("Create Custom Persona", tester.test_create_custom_persona),
         ("Create Conversation", tester.test_create_conversation),
         ("Get Conversation", tester.test_get_conversation),
         ("Send User Message", tester.test_send_user_message),
         ("Get Messages", tester.test_get_messages),
+        ("Search Messages", tester.test_search_messages),
         
         # PRIORITY TESTS - URL Extraction Feature (NEW)
         ("🌐 Extract URL Endpoint", tester.test_extract_url_endpoint),
@@ -525,9 +525,14 @@ export default function Arena() {
   };
 
   const loadConversations = async (userId) => {
+    // Conversations are always listed per owner (user or guest session)
+    if (!userId) {
+      setConversations([]);
+      return;
+    }
     try {
       const response = await axios.get(`${API}/conversations`, {
-        params: userId ? { user_id: userId } : {}
+        params: { user_id: userId }
       });
       setConversations(response.data);
     } catch (error) {
@@ -654,33 +659,42 @@ export default function Arena() {
     const files = Array.from(event.target.files);
     
     for (const file of files) {
-      const reader = new FileReader();
-      reader.onload = async (e) => {
-        let attachment = {
-          type: file.type.startsWith('image/') ? 'image' : 'file',
-          name: file.name,
-          data: e.target.result,
-          description: file.name
-        };
-        
-        // If it's a PDF, extract text
-        if (file.type === 'application/pdf') {
-          try {
-            const response = await axios.post(`${API}/extract-pdf`, {
-              pdf_data: e.target.result
-            });
-            attachment.extractedText = response.data.text;
-            attachment.description = `PDF: ${file.name} (${response.data.pages} pages)`;
-            toast.success(`PDF text extracted: ${response.data.pages} pages`);
-          } catch (error) {
-            console.error('PDF extraction failed:', error);
-            toast.error('Could not extract PDF text, but file is attached');
-          }
-        }
-        
-        setAttachments(prev => [...prev, attachment]);
+      // Upload the raw file once; messages and PDF extraction refer to it by id
+      const form = new FormData();
+      form.append('file', file);
+      let uploaded;
+      try {
+        uploaded = (await axios.post(`${API}/attachments`, form)).data;
+      } catch (error) {
+        console.error('Upload failed:', error);
+        toast.error(error.response?.data?.detail || `Could not upload ${file.name}`);
+        continue;
+      }
+      
+      // The server's type, which is filled in when the browser sends none (e.g. HEIC photos)
+      let attachment = {
+        type: uploaded.content_type.startsWith('image/') ? 'image' : 'file',
+        name: file.name,
+        attachment_id: uploaded.id,
+        description: file.name
       };
-      reader.readAsDataURL(file);
+      
+      // If it's a PDF, extract text
+      if (uploaded.content_type === 'application/pdf') {
+        try {
+          const response = await axios.post(`${API}/extract-pdf`, {
+            attachment_id: uploaded.id
+          });
+          attachment.extractedText = response.data.text;
+          attachment.description = `PDF: ${file.name} (${response.data.pages} pages)`;
+          toast.success(`PDF text extracted: ${response.data.pages} pages`);
+        } catch (error) {
+          console.error('PDF extraction failed:', error);
+          toast.error('Could not extract PDF text, but file is attached');
+        }
+      }
+      
+      setAttachments(prev => [...prev, attachment]);
     }
   };
 
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Throughput and extracted-text parity of the HTML parser backends.
+
+Runs backend/extraction.py's extract_html_text over a directory of saved
+pages (*.html / *.htm) with html.parser and with lxml when installed,
+serially and across a process pool, and reports how closely each
+backend's text matches html.parser, the reference used before lxml.
+
+    python html_extract_benchmark.py saved_pages/
+    python html_extract_benchmark.py saved_pages/ --workers 4 --repeat 3
+
+Last recorded run (bs4 4.14.3, lxml 6.1.3, one CPU so the pool rows show
+no speedup): 442 locally saved documentation pages, 23.2 MB (Rust book,
+rustdoc API pages, npm docs, /usr/share/doc HTML). lxml 23.6 pages/s vs
+html.parser 12.0 pages/s serial; extracted text and titles identical on
+all 442 pages. Not yet measured on a crawl of arbitrary web pages.
+"""
+import argparse
+import difflib
+import multiprocessing
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+
+from extraction import extract_html_text  # noqa: E402
+
+try:
+    import lxml  # noqa: F401
+    PARSERS = ["html.parser", "lxml"]
+except ImportError:
+    PARSERS = ["html.parser"]
+
+
+def load_corpus(directory: Path):
+    pages = [path.read_bytes() for path in sorted(directory.iterdir()) if path.suffix.lower() in (".html", ".htm")]
+    if not pages:
+        sys.exit(f"No .html files in {directory}")
+    return pages
+
+
+def run_serial(pages, parser: str):
+    return [extract_html_text(page, None, parser) for page in pages]
+
+
+def run_pool(pages, parser: str, workers: int):
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        pool.submit(extract_html_text, b"<html></html>", None, parser).result()  # Warm the workers up
+        started = time.perf_counter()
+        results = list(pool.map(extract_html_text, pages, [None] * len(pages), [parser] * len(pages)))
+        return results, time.perf_counter() - started
+
+
+def parity(reference, candidate):
+    """
+    Mean similarity of extracted text, share of pages whose text is
+    identical, and share of identical titles. quick_ratio only compares
+    character counts, so the identical-text share is the stricter figure.
+    """
+    pairs = list(zip(reference, candidate))
+    text_ratios = [
+        difflib.SequenceMatcher(None, ref_text, text, autojunk=False).quick_ratio()
+        for (_, ref_text), (_, text) in pairs
+    ]
+    same_texts = sum(ref_text == text for (_, ref_text), (_, text) in pairs)
+    same_titles = sum(ref_title == title for (ref_title, _), (title, _) in pairs)
+    return statistics.mean(text_ratios), same_texts / len(pairs), same_titles / len(pairs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("corpus", type=Path, help="directory of saved HTML pages")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    pages = load_corpus(args.corpus)
+    total_mb = sum(len(page) for page in pages) / 1e6
+    print(f"{len(pages)} pages, {total_mb:.1f} MB\n")
+    print(f"{'parser':<13}{'mode':<10}{'pages/s':>9}{'MB/s':>8}{'text parity':>13}{'same text':>11}{'same title':>12}")
+
+    reference = run_serial(pages, "html.parser")
+    for name in PARSERS:
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            results = run_serial(pages, name)
+            timings.append(time.perf_counter() - started)
+        serial_s = min(timings)
+        text_parity, text_identical, title_parity = parity(reference, results)
+        print(
+            f"{name:<13}{'serial':<10}{len(pages) / serial_s:>9.1f}{total_mb / serial_s:>8.2f}"
+            f"{text_parity:>13.4f}{text_identical:>11.2%}{title_parity:>12.2%}"
+        )
+
+        _, pool_s = run_pool(pages, name, args.workers)
+        print(f"{name:<13}{f'pool x{args.workers}':<10}{len(pages) / pool_s:>9.1f}{total_mb / pool_s:>8.2f}")
+
+    if len(PARSERS) == 1:
+        print("\nlxml not installed: only html.parser measured (pip install lxml)")
+
+
+if __name__ == "__main__":
+    main()
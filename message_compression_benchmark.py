@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Compression ratio and CPU cost of message bodies, per codec and body size.
+
+Mirrors the codecs used by the backend's message compression (zlib level 6,
+zstd level 3 when the zstandard package is installed). Runs on synthetic
+persona replies by default; pass --from-db to sample the longest stored
+messages instead (reads MONGO_URL and DB_NAME from backend/.env). The
+synthetic corpus repeats a small set of sentences, so its ratios are an
+upper bound; real replies compress less.
+
+    python message_compression_benchmark.py
+    python message_compression_benchmark.py --from-db 500
+"""
+import argparse
+import os
+import random
+import statistics
+import time
+import zlib
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SENTENCES = [
+    "That's a fascinating angle, but I think we're missing the economic incentives underneath it.",
+    "Let me push back on that a little: the evidence from the last decade points the other way.",
+    "If we follow that premise to its conclusion, the whole framework starts to wobble.",
+    "Here's what the article actually says about adoption rates in the first two years.",
+    "Honestly? I'd rather we talk about what this means for the people doing the work.",
+    "The PDF you shared lists three separate studies, and only one of them controls for income.",
+    "Building on what was said earlier, there's a second-order effect nobody has mentioned yet.",
+    "Socrates would ask us what we mean by 'fair' before we go any further.",
+    "Picture a city where every streetlight is also a tiny library. Now make it sentient.",
+    "I'm not convinced the numbers hold up once you account for seasonal variation.",
+]
+
+
+def synthetic_body(size: int, rng: random.Random) -> str:
+    parts = []
+    length = 0
+    while length < size:
+        sentence = rng.choice(SENTENCES)
+        if rng.random() < 0.3:
+            sentence = f"{sentence} ({rng.randint(1, 9999)})"
+        parts.append(sentence)
+        length += len(sentence) + 1
+    return " ".join(parts)[:size]
+
+
+def codecs():
+    available = {
+        "zlib": (lambda raw: zlib.compress(raw, 6), zlib.decompress),
+    }
+    if zstandard is not None:
+        compressor = zstandard.ZstdCompressor(level=3)
+        decompressor = zstandard.ZstdDecompressor()
+        available["zstd"] = (compressor.compress, decompressor.decompress)
+    return available
+
+
+def bench(bodies, compress, decompress, repeat: int):
+    raw_bytes = stored_bytes = 0
+    compress_us = []
+    decompress_us = []
+    for body in bodies:
+        raw = body.encode("utf-8")
+        for _ in range(repeat):
+            started = time.perf_counter()
+            data = compress(raw)
+            compress_us.append((time.perf_counter() - started) * 1e6)
+            started = time.perf_counter()
+            decompress(data)
+            decompress_us.append((time.perf_counter() - started) * 1e6)
+        raw_bytes += len(raw)
+        stored_bytes += len(data)
+    return {
+        "ratio": raw_bytes / stored_bytes,
+        "compress_us": statistics.median(compress_us),
+        "decompress_us": statistics.median(decompress_us),
+        "compress_mb_s": raw_bytes * repeat / (sum(compress_us) / 1e6) / 1e6,
+        "decompress_mb_s": raw_bytes * repeat / (sum(decompress_us) / 1e6) / 1e6,
+    }
+
+
+def load_from_db(limit: int):
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    load_dotenv(Path(__file__).parent / "backend" / ".env")
+    client = MongoClient(os.environ["MONGO_URL"])
+    db = client[os.environ["DB_NAME"]]
+    pipeline = [
+        {"$match": {"content": {"$type": "string"}, "content_codec": {"$exists": False}}},
+        {"$project": {"_id": 0, "content": 1, "size": {"$strLenBytes": "$content"}}},
+        {"$sort": {"size": -1}},
+        {"$limit": limit},
+    ]
+    bodies = [doc["content"] for doc in db.messages.aggregate(pipeline)]
+    client.close()
+    return bodies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--from-db", type=int, metavar="N", help="benchmark the N longest stored messages")
+    parser.add_argument("--samples", type=int, default=50, help="synthetic bodies per size bucket")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.from_db:
+        bodies = load_from_db(args.from_db)
+        if not bodies:
+            print("No uncompressed messages found")
+            return
+        buckets = {f"db ({len(bodies)} msgs)": bodies}
+    else:
+        rng = random.Random(42)
+        buckets = {
+            f"{size // 1024}KB": [synthetic_body(size, rng) for _ in range(args.samples)]
+            for size in (1024, 4096, 16384, 65536)
+        }
+
+    print(f"{'bodies':<16}{'codec':<7}{'ratio':>7}{'comp µs':>10}{'decomp µs':>11}{'comp MB/s':>11}{'decomp MB/s':>13}")
+    for label, bodies in buckets.items():
+        for name, (compress, decompress) in codecs().items():
+            r = bench(bodies, compress, decompress, args.repeat)
+            print(f"{label:<16}{name:<7}{r['ratio']:>7.2f}{r['compress_us']:>10.1f}{r['decompress_us']:>11.1f}"
+                  f"{r['compress_mb_s']:>11.1f}{r['decompress_mb_s']:>13.1f}")
+    if zstandard is None:
+        print("\nzstandard not installed: only zlib measured (pip install zstandard)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Per-document vs bucketed message storage for one long conversation.
+
+Writes the same conversation (10k messages by default, appended in
+autorun-sized batches) in both layouts used by the backend, then reports
+write time, document and index footprint, and read latency for a
+200-message page and for the whole history. Needs a running MongoDB:
+MONGO_URL comes from backend/.env and a scratch database is dropped
+when the run finishes.
+
+No results have been recorded with it yet, so it doesn't back any claim
+about the bucket layout; MESSAGE_STORAGE_MODE stays "document" by default
+until it has been run against a deployment-sized MongoDB.
+
+    python message_storage_benchmark.py
+    python message_storage_benchmark.py --messages 10000 --bucket-size 200 --batch 4
+"""
+import argparse
+import os
+import statistics
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from dotenv import load_dotenv
+from pymongo import ASCENDING, MongoClient
+from pymongo.errors import DuplicateKeyError
+
+CONVERSATION_ID = "benchmark-conversation"
+
+
+def make_messages(count: int):
+    started = datetime.now(timezone.utc)
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "conversation_id": CONVERSATION_ID,
+            "persona_id": f"persona-{i % 4}",
+            "persona_name": f"Persona {i % 4}",
+            "content": f"Round {i // 4}: a reply of typical length that builds on what the others just said. " * 4,
+            "is_user": False,
+            "timestamp": started + timedelta(milliseconds=i),
+        }
+        for i in range(count)
+    ]
+
+
+def write_documents(db, batches):
+    for docs in batches:
+        db.messages.insert_many([dict(doc) for doc in docs], ordered=True)
+
+
+def write_buckets(db, batches, bucket_size: int):
+    # Same append protocol as append_to_bucket() in backend/server.py
+    for docs in batches:
+        while True:
+            bucket = db.message_buckets.find_one_and_update(
+                {"conversation_id": CONVERSATION_ID, "count": {"$lt": bucket_size}},
+                {"$push": {"messages": {"$each": docs}}, "$inc": {"count": len(docs)}, "$max": {"last_timestamp": docs[-1]["timestamp"]}},
+                sort=[("seq", -1)],
+                projection={"_id": 1},
+            )
+            if bucket:
+                break
+            newest = db.message_buckets.find_one({"conversation_id": CONVERSATION_ID}, {"seq": 1}, sort=[("seq", -1)])
+            try:
+                db.message_buckets.insert_one({
+                    "conversation_id": CONVERSATION_ID,
+                    "seq": newest["seq"] + 1 if newest else 0,
+                    "count": len(docs),
+                    "first_timestamp": docs[0]["timestamp"],
+                    "last_timestamp": docs[-1]["timestamp"],
+                    "messages": docs,
+                })
+                break
+            except DuplicateKeyError:
+                continue
+
+
+def read_documents(db, limit: int):
+    return list(db.messages.find({"conversation_id": CONVERSATION_ID}, {"_id": 0}).sort("timestamp", 1).limit(limit))
+
+
+def read_buckets(db, limit: int, bucket_size: int):
+    buckets_needed = -(-limit // bucket_size)
+    buckets = db.message_buckets.find({"conversation_id": CONVERSATION_ID}, {"_id": 0, "messages": 1}).sort("seq", 1).limit(buckets_needed)
+    messages = [msg for bucket in buckets for msg in bucket["messages"]]
+    messages.sort(key=lambda msg: msg["timestamp"])
+    return messages[:limit]
+
+
+def timed_reads(read, repeat: int):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        messages = read()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples), len(messages)
+
+
+def footprint(db, collection: str):
+    stats = db.command("collStats", collection)
+    return stats["count"], stats["size"], stats["totalIndexSize"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--bucket-size", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=4, help="messages appended per write (one autorun round)")
+    parser.add_argument("--page", type=int, default=200, help="messages per page read, as in GET /messages")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    load_dotenv(Path(__file__).parent / "backend" / ".env")
+    client = MongoClient(os.environ["MONGO_URL"], tz_aware=True)
+    db_name = f"{os.environ.get('DB_NAME', 'test')}_storage_benchmark"
+    client.drop_database(db_name)
+    db = client[db_name]
+    db.messages.create_index([("conversation_id", ASCENDING), ("timestamp", ASCENDING)])
+    db.message_buckets.create_index([("conversation_id", ASCENDING), ("seq", ASCENDING)], unique=True)
+
+    messages = make_messages(args.messages)
+    batches = [messages[i:i + args.batch] for i in range(0, len(messages), args.batch)]
+
+    layouts = {
+        "document": (
+            lambda: write_documents(db, batches),
+            "messages",
+            lambda limit: read_documents(db, limit),
+        ),
+        "bucket": (
+            lambda: write_buckets(db, [[dict(doc) for doc in batch] for batch in batches], args.bucket_size),
+            "message_buckets",
+            lambda limit: read_buckets(db, limit, args.bucket_size),
+        ),
+    }
+
+    print(f"{args.messages} messages, batches of {args.batch}, bucket size {args.bucket_size}\n")
+    print(f"{'layout':<10}{'write s':>9}{'docs':>8}{'data MB':>9}{'index KB':>10}{'page ms':>9}{'all ms':>9}")
+    try:
+        for name, (write, collection, read) in layouts.items():
+            started = time.perf_counter()
+            write()
+            write_s = time.perf_counter() - started
+            docs, size, index_size = footprint(db, collection)
+            page_ms, page_count = timed_reads(lambda: read(args.page), args.repeat)
+            all_ms, all_count = timed_reads(lambda: read(args.messages), max(1, args.repeat // 4))
+            assert page_count == min(args.page, args.messages) and all_count == args.messages
+            print(f"{name:<10}{write_s:>9.2f}{docs:>8}{size / 1e6:>9.2f}{index_size / 1e3:>10.1f}{page_ms:>9.2f}{all_ms:>9.2f}")
+    finally:
+        client.drop_database(db_name)
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
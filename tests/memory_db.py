@@ -0,0 +1,358 @@
+"""
+A small in-memory stand-in for the Motor database, for tests that need
+writes to be visible to later reads (claims, re-checks, cascades).
+
+Supports the query and update operators the backend uses; anything else
+raises so a test never silently passes on an unsupported filter.
+"""
+import copy
+from datetime import datetime
+from types import SimpleNamespace
+
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateMany
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+BSON_TYPES = {"string": str, "date": datetime, "object": dict, "array": list, "bool": bool}
+
+
+def _values(doc, path):
+    """Every value a dotted path reaches, descending through arrays"""
+    values = [doc]
+    for part in path.split("."):
+        reached = []
+        for value in values:
+            if isinstance(value, list):
+                value = [item for item in value if isinstance(item, dict)]
+                reached.extend(item[part] for item in value if part in item)
+            elif isinstance(value, dict) and part in value:
+                reached.append(value[part])
+        values = reached
+    expanded = []
+    for value in values:
+        expanded.append(value)
+        if isinstance(value, list):
+            expanded.extend(value)
+    return expanded
+
+
+def _compare(values, test):
+    return any(test(value) for value in values if value is not None)
+
+
+def _matches_condition(values, cond):
+    if not (isinstance(cond, dict) and cond and all(key.startswith("$") for key in cond)):
+        return any(value == cond for value in values) or (cond is None and not values)
+    for op, arg in cond.items():
+        if op == "$exists":
+            ok = bool(values) == bool(arg)
+        elif op == "$eq":
+            ok = _matches_condition(values, arg)
+        elif op == "$ne":
+            ok = not _matches_condition(values, arg)
+        elif op == "$in":
+            ok = any(_matches_condition(values, item) for item in arg)
+        elif op == "$nin":
+            ok = not any(_matches_condition(values, item) for item in arg)
+        elif op == "$lt":
+            ok = _compare(values, lambda value: value < arg)
+        elif op == "$lte":
+            ok = _compare(values, lambda value: value <= arg)
+        elif op == "$gt":
+            ok = _compare(values, lambda value: value > arg)
+        elif op == "$gte":
+            ok = _compare(values, lambda value: value >= arg)
+        elif op == "$not":
+            ok = not _matches_condition(values, arg)
+        elif op == "$size":
+            ok = any(isinstance(value, list) and len(value) == arg for value in values)
+        elif op == "$type":
+            ok = any(isinstance(value, BSON_TYPES[arg]) for value in values)
+        else:
+            raise NotImplementedError(f"MemoryDB does not support {op}")
+        if not ok:
+            return False
+    return True
+
+
+def matches(doc, query):
+    for key, cond in (query or {}).items():
+        if key == "$and":
+            ok = all(matches(doc, sub) for sub in cond)
+        elif key == "$or":
+            ok = any(matches(doc, sub) for sub in cond)
+        elif key.startswith("$"):
+            raise NotImplementedError(f"MemoryDB does not support {key}")
+        else:
+            ok = _matches_condition(_values(doc, key), cond)
+        if not ok:
+            return False
+    return True
+
+
+def project(doc, projection):
+    doc = copy.deepcopy(doc)
+    if not projection:
+        return doc
+    include = {key for key, on in projection.items() if on and key != "_id"}
+    if include:
+        kept = {key: doc[key] for key in include if key in doc}
+        if projection.get("_id", 1) and "_id" in doc:
+            kept["_id"] = doc["_id"]
+        return kept
+    for key, on in projection.items():
+        if not on:
+            doc.pop(key, None)
+    return doc
+
+
+def _set_path(doc, path, value):
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.setdefault(part, {})
+    doc[last] = value
+
+
+def _unset_path(doc, path):
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.get(part, {})
+    doc.pop(last, None)
+
+
+def apply_update(doc, update, inserting=False):
+    for op, fields in update.items():
+        if op == "$setOnInsert":
+            if inserting:
+                for path, value in fields.items():
+                    _set_path(doc, path, copy.deepcopy(value))
+        elif op == "$set":
+            for path, value in fields.items():
+                _set_path(doc, path, copy.deepcopy(value))
+        elif op == "$unset":
+            for path in fields:
+                _unset_path(doc, path)
+        elif op == "$inc":
+            for path, value in fields.items():
+                doc[path] = doc.get(path, 0) + value
+        elif op == "$push":
+            for path, value in fields.items():
+                items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                doc.setdefault(path, []).extend(copy.deepcopy(items))
+        elif op == "$pull":
+            for path, cond in fields.items():
+                doc[path] = [
+                    item for item in doc.get(path, [])
+                    if not (matches(item, cond) if isinstance(item, dict) else _matches_condition([item], cond))
+                ]
+        else:
+            raise NotImplementedError(f"MemoryDB does not support {op}")
+
+
+class MemoryCursor:
+    def __init__(self, docs, projection):
+        self.docs = docs
+        self.projection = projection
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key, direction=1):
+        keys = key if isinstance(key, list) else [(key, direction)]
+        for field, order in reversed(keys):
+            self.docs.sort(key=lambda doc: (doc.get(field) is not None, doc.get(field)), reverse=order == -1)
+        return self
+
+    def skip(self, count):
+        self._skip = count
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+    def _result(self, length=None):
+        docs = self.docs[self._skip:]
+        for cap in (self._limit, length):
+            if cap:
+                docs = docs[:cap]
+        return [project(doc, self.projection) for doc in docs]
+
+    async def to_list(self, length=None):
+        return self._result(length)
+
+    def __aiter__(self):
+        async def iterate():
+            for doc in self._result():
+                yield doc
+        return iterate()
+
+
+def _evaluate(doc, expression):
+    if isinstance(expression, str) and expression.startswith("$"):
+        values = _values(doc, expression[1:])
+        return values[0] if values else None
+    if isinstance(expression, dict) and set(expression) == {"$size"}:
+        return len(_evaluate(doc, expression["$size"]) or [])
+    if isinstance(expression, (int, float)):
+        return expression
+    raise NotImplementedError(f"MemoryDB does not support the expression {expression!r}")
+
+
+def aggregate(docs, pipeline, db=None):
+    """$match, $lookup (on localField / foreignField), $group (with $sum), $limit and $project stages"""
+    docs = [copy.deepcopy(doc) for doc in docs]
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        if name == "$match":
+            docs = [doc for doc in docs if matches(doc, spec)]
+        elif name == "$limit":
+            docs = docs[:spec]
+        elif name == "$project":
+            docs = [project(doc, spec) for doc in docs]
+        elif name == "$lookup":
+            foreign = db[spec["from"]].docs
+            for doc in docs:
+                local = _values(doc, spec["localField"])
+                joined = [other for other in foreign if _matches_condition(_values(other, spec["foreignField"]), {"$in": local})]
+                doc[spec["as"]] = aggregate(joined, spec.get("pipeline", []), db)
+        elif name == "$group":
+            groups = {}
+            for doc in docs:
+                key = _evaluate(doc, spec["_id"]) if spec["_id"] is not None else None
+                group = groups.setdefault(key, {"_id": key})
+                for field, accumulator in spec.items():
+                    if field == "_id":
+                        continue
+                    (op, expression), = accumulator.items()
+                    if op != "$sum":
+                        raise NotImplementedError(f"MemoryDB does not support {op}")
+                    group[field] = group.get(field, 0) + (_evaluate(doc, expression) or 0)
+            docs = list(groups.values())
+        else:
+            raise NotImplementedError(f"MemoryDB does not support the {name} stage")
+    return docs
+
+
+class MemoryCollection:
+    def __init__(self, name, db=None):
+        self.name = name
+        self.db = db
+        self.docs = []
+
+    def with_options(self, **kwargs):
+        return self
+
+    def _matching(self, query):
+        return [doc for doc in self.docs if matches(doc, query)]
+
+    def _insert(self, doc):
+        doc = copy.deepcopy(doc)
+        doc.setdefault("_id", ObjectId())
+        if any(existing["_id"] == doc["_id"] for existing in self.docs):
+            raise DuplicateKeyError(f"Duplicate _id {doc['_id']}", 11000)
+        self.docs.append(doc)
+        return doc
+
+    def find(self, query=None, projection=None, **kwargs):
+        return MemoryCursor(self._matching(query), projection)
+
+    async def find_one(self, query=None, projection=None, **kwargs):
+        found = self._matching(query)
+        return project(found[0], projection) if found else None
+
+    def aggregate(self, pipeline, **kwargs):
+        return MemoryCursor(aggregate(self.docs, pipeline, self.db), None)
+
+    async def count_documents(self, query, **kwargs):
+        return len(self._matching(query))
+
+    async def insert_one(self, doc, **kwargs):
+        inserted = self._insert(doc)
+        doc.setdefault("_id", inserted["_id"])
+        return SimpleNamespace(inserted_id=inserted["_id"])
+
+    async def insert_many(self, docs, ordered=True, **kwargs):
+        errors = []
+        for index, doc in enumerate(docs):
+            try:
+                self._insert(doc)
+            except DuplicateKeyError:
+                errors.append({"index": index, "code": 11000})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors})
+        return SimpleNamespace(inserted_ids=[doc.get("_id") for doc in docs])
+
+    async def update_one(self, query, update, upsert=False, **kwargs):
+        return self._update(query, update, upsert, many=False)
+
+    async def update_many(self, query, update, upsert=False, **kwargs):
+        return self._update(query, update, upsert, many=True)
+
+    def _update(self, query, update, upsert, many):
+        found = self._matching(query)
+        if not many:
+            found = found[:1]
+        for doc in found:
+            apply_update(doc, update)
+        upserted_id = None
+        if not found and upsert:
+            doc = {key: value for key, value in query.items() if not key.startswith("$") and not isinstance(value, dict)}
+            apply_update(doc, update, inserting=True)
+            upserted_id = self._insert(doc)["_id"]
+        return SimpleNamespace(matched_count=len(found), modified_count=len(found), upserted_id=upserted_id)
+
+    async def find_one_and_update(self, query, update, projection=None, upsert=False,
+                                  return_document=ReturnDocument.BEFORE, **kwargs):
+        found = self._matching(query)[:1]
+        if not found:
+            if not upsert:
+                return None
+            self._update(query, update, True, many=False)
+            return project(self.docs[-1], projection) if return_document == ReturnDocument.AFTER else None
+        before = project(found[0], projection)
+        apply_update(found[0], update)
+        return project(found[0], projection) if return_document == ReturnDocument.AFTER else before
+
+    async def replace_one(self, query, replacement, upsert=False, **kwargs):
+        found = self._matching(query)[:1]
+        if found:
+            replacement = dict(copy.deepcopy(replacement), _id=found[0]["_id"])
+            self.docs[self.docs.index(found[0])] = replacement
+        elif upsert:
+            self._insert(replacement)
+        return SimpleNamespace(matched_count=len(found), modified_count=len(found))
+
+    async def bulk_write(self, operations, ordered=True, **kwargs):
+        results = [self._update(op._filter, op._doc, op._upsert, many=isinstance(op, UpdateMany)) for op in operations]
+        return SimpleNamespace(
+            matched_count=sum(result.matched_count for result in results),
+            modified_count=sum(result.modified_count for result in results),
+        )
+
+    async def delete_one(self, query, **kwargs):
+        found = self._matching(query)[:1]
+        self.docs = [doc for doc in self.docs if not (found and doc is found[0])]
+        return SimpleNamespace(deleted_count=len(found))
+
+    async def delete_many(self, query, **kwargs):
+        found = self._matching(query)
+        removed = {id(doc) for doc in found}
+        self.docs = [doc for doc in self.docs if id(doc) not in removed]
+        return SimpleNamespace(deleted_count=len(found))
+
+
+class MemoryDB:
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(name, self)
+        return self.collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return self[name]
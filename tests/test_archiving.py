@@ -0,0 +1,177 @@
+"""
+The archive claim protocol: a pass claims the conversation, writes the
+archive, re-checks the claim and only then deletes the messages. Readers
+wait for a running pass and restore from the archive afterwards.
+
+Runs against the in-memory database in memory_db.py. Needs the backend's
+dependencies installed (fastapi, motor, emergentintegrations).
+"""
+import asyncio
+import os
+import sys
+import threading
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+from bson import ObjectId
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "archiving_tests")
+
+import server  # noqa: E402
+from tests.memory_db import MemoryDB  # noqa: E402
+
+LONG_AGO = datetime(2025, 1, 1, tzinfo=timezone.utc)
+CUTOFF = datetime(2025, 6, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def memory_db(monkeypatch):
+    fake = MemoryDB()
+    monkeypatch.setattr(server, "db", fake)
+    server._rehydrations.clear()
+    fake.conversations.docs.append({"id": "conv-1", "title": "Old", "updated_at": LONG_AGO})
+    fake.messages.docs.extend(
+        {"_id": ObjectId(), "id": f"m-{i}", "conversation_id": "conv-1", "content": f"message {i}",
+         "timestamp": LONG_AGO + timedelta(seconds=i)}
+        for i in range(3)
+    )
+    return fake
+
+
+def conversation(fake):
+    return fake.conversations.docs[0]
+
+
+def during_compression(monkeypatch, interfere):
+    """Run interfere() while the archiving pass is compressing"""
+    compress = server.compress_archive
+
+    def compress_then_interfere(messages, codec):
+        result = compress(messages, codec)
+        interfere()
+        return result
+
+    monkeypatch.setattr(server, "compress_archive", compress_then_interfere)
+
+
+def test_archiving_moves_messages_into_one_archive(memory_db):
+    assert asyncio.run(server.archive_conversation("conv-1", CUTOFF))
+
+    conv = conversation(memory_db)
+    assert conv["archived_at"] and "archiving_at" not in conv
+    assert memory_db.messages.docs == []
+    assert memory_db.message_archives.docs[0]["message_count"] == 3
+
+
+def test_claim_lost_mid_pass_removes_the_archive_and_keeps_messages(memory_db, monkeypatch):
+    # A restore that cleared the claim while we were compressing
+    during_compression(monkeypatch, lambda: conversation(memory_db).pop("archiving_at"))
+
+    assert not asyncio.run(server.archive_conversation("conv-1", CUTOFF))
+
+    assert "archived_at" not in conversation(memory_db)
+    assert memory_db.message_archives.docs == []
+    assert len(memory_db.messages.docs) == 3
+
+
+def test_claim_taken_over_is_left_to_its_new_owner(memory_db, monkeypatch):
+    other_claim = datetime.now(timezone.utc) + timedelta(seconds=1)
+    during_compression(monkeypatch, lambda: conversation(memory_db).update(archiving_at=other_claim))
+
+    assert not asyncio.run(server.archive_conversation("conv-1", CUTOFF))
+
+    assert conversation(memory_db)["archiving_at"] == other_claim
+    assert len(memory_db.messages.docs) == 3
+
+
+def test_write_during_archiving_backs_off(memory_db, monkeypatch):
+    during_compression(monkeypatch, lambda: conversation(memory_db).update(updated_at=datetime.now(timezone.utc)))
+
+    assert not asyncio.run(server.archive_conversation("conv-1", CUTOFF))
+
+    conv = conversation(memory_db)
+    assert "archived_at" not in conv and "archiving_at" not in conv
+    assert memory_db.message_archives.docs == []
+    assert len(memory_db.messages.docs) == 3
+
+
+def test_recently_restored_conversations_are_not_archived_again(memory_db):
+    conversation(memory_db)["rehydrated_at"] = datetime.now(timezone.utc)
+
+    assert not asyncio.run(server.archive_conversation("conv-1", CUTOFF))
+    assert len(memory_db.messages.docs) == 3
+
+
+def test_stale_claim_is_restored_from_the_archive(memory_db, monkeypatch):
+    # A pass that died after deleting the messages but before marking the conversation archived
+    async def die_after_delete(*args, **kwargs):
+        raise RuntimeError("worker killed")
+
+    original_update = memory_db.conversations.update_one
+
+    async def update_one(query, update, **kwargs):
+        if "archived_at" in update.get("$set", {}):
+            await die_after_delete()
+        return await original_update(query, update, **kwargs)
+
+    monkeypatch.setattr(memory_db.conversations, "update_one", update_one)
+    with pytest.raises(RuntimeError):
+        asyncio.run(server.archive_conversation("conv-1", CUTOFF))
+    monkeypatch.setattr(memory_db.conversations, "update_one", original_update)
+    assert memory_db.messages.docs == []
+
+    conversation(memory_db)["archiving_at"] -= timedelta(seconds=server.ARCHIVE_CLAIM_TIMEOUT_SECONDS + 1)
+    assert asyncio.run(server.resume_stale_archives()) == 1
+
+    conv = conversation(memory_db)
+    assert "archiving_at" not in conv and "archived_at" not in conv
+    assert conv["rehydrated_at"]
+    assert sorted(msg["id"] for msg in memory_db.messages.docs) == ["m-0", "m-1", "m-2"]
+    assert memory_db.message_archives.docs == []
+
+
+def test_read_during_archiving_waits_for_the_pass_then_restores(memory_db, monkeypatch):
+    compressing, finish = threading.Event(), threading.Event()
+    compress = server.compress_archive
+
+    def slow_compress(messages, codec):
+        compressing.set()
+        finish.wait(5)
+        return compress(messages, codec)
+
+    monkeypatch.setattr(server, "compress_archive", slow_compress)
+
+    async def scenario():
+        archiving = asyncio.create_task(server.archive_conversation("conv-1", CUTOFF))
+        await asyncio.to_thread(compressing.wait, 5)
+        assert conversation(memory_db)["archiving_at"]
+
+        reading = asyncio.create_task(server.fetch_messages("conv-1", 50))
+        await asyncio.sleep(0.1)
+        assert not reading.done()  # Waits instead of restoring messages the pass is about to delete
+
+        finish.set()
+        return await archiving, await reading
+
+    archived, messages = asyncio.run(scenario())
+
+    assert archived
+    assert [msg["id"] for msg in messages] == ["m-0", "m-1", "m-2"]
+    conv = conversation(memory_db)
+    assert "archived_at" not in conv and "archiving_at" not in conv
+    assert len(memory_db.messages.docs) == 3
+    assert memory_db.message_archives.docs == []
+
+
+def test_read_gives_up_on_a_pass_that_does_not_finish(memory_db, monkeypatch):
+    monkeypatch.setattr(server, "ARCHIVE_RESTORE_WAIT_SECONDS", 0)
+    conversation(memory_db)["archiving_at"] = datetime.now(timezone.utc)
+
+    with pytest.raises(server.HTTPException) as exc:
+        asyncio.run(server.rehydrate_conversation("conv-1"))
+
+    assert exc.value.status_code == 503
+    assert len(memory_db.messages.docs) == 3
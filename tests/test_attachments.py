@@ -0,0 +1,109 @@
+"""
+Streaming attachment uploads: hashing, spooling and the size limit.
+
+Needs the backend's dependencies installed (fastapi, motor,
+emergentintegrations); no database is touched.
+"""
+import asyncio
+import hashlib
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "attachment_tests")
+
+import server  # noqa: E402
+
+
+async def body(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def test_spool_upload_hashes_while_copying():
+    chunks = [b"%PDF-1.4 ", b"x" * 1000, b" %%EOF"]
+
+    spool, sha256, size = asyncio.run(server.spool_upload(body(*chunks)))
+
+    assert sha256 == hashlib.sha256(b"".join(chunks)).hexdigest()
+    assert size == sum(len(chunk) for chunk in chunks)
+    assert spool.read() == b"".join(chunks)
+
+
+def test_spool_upload_moves_large_bodies_to_disk(monkeypatch):
+    monkeypatch.setattr(server, "ATTACHMENT_SPOOL_BYTES", 1024)
+    before = server.attachment_stats["spooled_to_disk"]
+
+    spool, _, size = asyncio.run(server.spool_upload(body(b"a" * 800, b"b" * 800)))
+
+    assert size == 1600
+    assert spool._rolled
+    assert server.attachment_stats["spooled_to_disk"] == before + 1
+
+
+def test_spool_upload_stops_at_the_size_limit(monkeypatch):
+    monkeypatch.setattr(server, "ATTACHMENT_MAX_BYTES", 1000)
+    received = []
+
+    async def stream():
+        for chunk in (b"a" * 600, b"b" * 600, b"c" * 600):
+            received.append(chunk)
+            yield chunk
+
+    with pytest.raises(server.HTTPException) as exc:
+        asyncio.run(server.spool_upload(stream()))
+
+    assert exc.value.status_code == 413
+    assert len(received) == 2  # The rest of the body is never read
+
+
+def test_attachment_ids_are_validated_before_any_lookup():
+    with pytest.raises(server.HTTPException) as exc:
+        asyncio.run(server.open_attachment("../../etc/passwd"))
+
+    assert exc.value.status_code == 400
+
+
+def test_capped_stream_rejects_oversized_multipart_bodies():
+    received = []
+
+    async def stream():
+        for chunk in (b"a" * 600, b"b" * 600, b"c" * 600):
+            received.append(chunk)
+            yield chunk
+
+    async def drain():
+        return [chunk async for chunk in server.capped_stream(stream(), 1000)]
+
+    with pytest.raises(server.HTTPException) as exc:
+        asyncio.run(drain())
+
+    assert exc.value.status_code == 413
+    assert len(received) == 2  # Rejected before the parser sees the rest
+
+
+@pytest.mark.parametrize("declared, filename, expected", [
+    ("image/png", "photo.png", "image/png"),
+    ("", "IMG_0001.HEIC", "image/heic"),
+    ("application/octet-stream", "scan.tiff", "image/tiff"),
+    ("image/jpeg; charset=binary", None, "image/jpeg"),
+])
+def test_attachment_type_falls_back_to_the_file_name(declared, filename, expected):
+    assert server.resolve_attachment_type(declared, filename) == expected
+
+
+@pytest.mark.parametrize("content_type, allowed", [
+    ("image/heic", True),
+    ("image/bmp", True),
+    ("image/tiff", True),
+    ("application/pdf", True),
+    ("image/svg+xml", False),
+    ("application/x-msdownload", False),
+    ("", False),
+])
+def test_any_image_but_svg_is_accepted(content_type, allowed):
+    assert server.attachment_type_allowed(content_type) == allowed
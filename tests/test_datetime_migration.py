@@ -0,0 +1,122 @@
+"""
+ISO-string to BSON date migration: conversion rules and checkpointing, so
+an interrupted run resumes after the last finished batch.
+
+Runs against the in-memory database in memory_db.py. Needs the backend's
+dependencies installed (fastapi, motor, emergentintegrations).
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pytest
+from pymongo.errors import AutoReconnect
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "datetime_migration_tests")
+
+import server  # noqa: E402
+from tests.memory_db import MemoryDB  # noqa: E402
+
+
+@pytest.fixture
+def memory_db(monkeypatch):
+    fake = MemoryDB()
+    monkeypatch.setattr(server, "db", fake)
+    return fake
+
+
+def add_messages(fake, count):
+    fake.messages.docs.extend(
+        {"_id": i, "id": f"m-{i}", "timestamp": f"2026-01-01T00:00:{i:02d}+00:00"} for i in range(1, count + 1)
+    )
+
+
+def migrate(batch_size=2):
+    asyncio.run(server.migrate_datetime_fields(batch_size=batch_size, pause_seconds=0))
+
+
+def checkpoint(fake, collection):
+    return next(doc for doc in fake.migrations.docs if doc["_id"] == f"bson_datetimes:{collection}")
+
+
+def test_strings_become_utc_datetimes(memory_db):
+    memory_db.conversations.docs.extend([
+        {"_id": 1, "created_at": "2026-01-01T10:00:00+02:00", "updated_at": "2026-01-02T00:00:00"},
+        {"_id": 2, "created_at": "not a date", "updated_at": datetime(2026, 1, 3, tzinfo=timezone.utc)},
+    ])
+
+    migrate()
+
+    converted, skipped = memory_db.conversations.docs
+    assert converted["created_at"] == datetime(2026, 1, 1, 8, tzinfo=timezone.utc)
+    assert converted["updated_at"] == datetime(2026, 1, 2, tzinfo=timezone.utc)  # Naive strings are UTC
+    assert skipped["created_at"] == "not a date"
+    assert checkpoint(memory_db, "conversations")["completed"]
+    assert checkpoint(memory_db, "conversations")["converted"] == 1
+
+
+def test_every_batch_is_checkpointed(memory_db):
+    add_messages(memory_db, 5)
+
+    migrate(batch_size=2)
+
+    assert all(isinstance(doc["timestamp"], datetime) for doc in memory_db.messages.docs)
+    assert checkpoint(memory_db, "messages")["last_id"] == 5
+    assert checkpoint(memory_db, "messages")["converted"] == 5
+
+
+def test_interrupted_run_resumes_after_the_last_batch(memory_db):
+    add_messages(memory_db, 5)
+    bulk_write = memory_db.messages.bulk_write
+    batches = []
+
+    async def fail_on_second_batch(operations, **kwargs):
+        batches.append([op._filter["_id"] for op in operations])
+        if len(batches) == 2:
+            raise AutoReconnect("primary went away")
+        return await bulk_write(operations, **kwargs)
+
+    memory_db.messages.bulk_write = fail_on_second_batch
+    with pytest.raises(AutoReconnect):
+        migrate(batch_size=2)
+
+    assert checkpoint(memory_db, "messages")["last_id"] == 2
+    assert "completed" not in checkpoint(memory_db, "messages")
+
+    # A document before the checkpoint that still has a string is not rescanned
+    memory_db.messages.docs[0]["timestamp"] = "2026-02-01T00:00:00+00:00"
+    migrate(batch_size=2)
+
+    assert batches[2:] == [[3, 4], [5]]
+    assert memory_db.messages.docs[0]["timestamp"] == "2026-02-01T00:00:00+00:00"
+    assert all(isinstance(doc["timestamp"], datetime) for doc in memory_db.messages.docs[1:])
+    assert checkpoint(memory_db, "messages")["completed"]
+
+
+def test_completed_collections_are_skipped(memory_db):
+    memory_db.migrations.docs.append({"_id": "bson_datetimes:messages", "completed": True})
+    add_messages(memory_db, 2)
+
+    migrate()
+
+    assert all(isinstance(doc["timestamp"], str) for doc in memory_db.messages.docs)
+
+
+def test_concurrent_writer_wins_over_the_migration(memory_db):
+    add_messages(memory_db, 1)
+    bulk_write = memory_db.messages.bulk_write
+
+    async def writer_gets_there_first(operations, **kwargs):
+        memory_db.messages.docs[0]["timestamp"] = "2026-03-01T00:00:00+00:00"
+        return await bulk_write(operations, **kwargs)
+
+    memory_db.messages.bulk_write = writer_gets_there_first
+    migrate()
+
+    # The guard on the old string makes the conversion a no-op instead of overwriting the new value
+    assert memory_db.messages.docs[0]["timestamp"] == "2026-03-01T00:00:00+00:00"
+    assert checkpoint(memory_db, "messages")["converted"] == 0
@@ -0,0 +1,116 @@
+"""
+Which database errors retry_db_operation retries, and that it never
+sleeps past the request deadline. No database needed.
+"""
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+import pytest
+from pymongo.errors import AutoReconnect, DuplicateKeyError, OperationFailure, WriteError
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "db_retry_tests")
+
+import server  # noqa: E402
+
+
+def flaky(*errors, result="ok"):
+    """An operation that raises each error in turn, then returns result"""
+    calls = []
+
+    async def operation():
+        calls.append(time.monotonic())
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+
+    return operation, calls
+
+
+def retryable_write_error():
+    error = WriteError("not primary", 10107)
+    error._error_labels = {"RetryableWriteError"}
+    return error
+
+
+@pytest.mark.parametrize("error", [
+    AutoReconnect("connection reset"),
+    OperationFailure("primary stepped down", 189),
+    OperationFailure("operation exceeded time limit", 262),
+    retryable_write_error(),
+])
+def test_transient_errors_are_retried(error):
+    assert server.is_retryable_db_error(error)
+    operation, calls = flaky(error)
+
+    assert asyncio.run(server.retry_db_operation(operation, max_retries=3, initial_delay=0.001)) == "ok"
+    assert len(calls) == 2
+
+
+@pytest.mark.parametrize("error", [
+    DuplicateKeyError("E11000 duplicate key", 11000),
+    OperationFailure("unknown operator: $foo", 2),
+    OperationFailure("Authentication failed", 18),
+    ValueError("not a database error"),
+])
+def test_permanent_errors_fail_on_the_first_attempt(error):
+    assert not server.is_retryable_db_error(error)
+    operation, calls = flaky(error)
+
+    with pytest.raises(type(error)):
+        asyncio.run(server.retry_db_operation(operation, max_retries=3, initial_delay=0.001))
+    assert len(calls) == 1
+
+
+def test_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setitem(server.db_retry_stats, "exhausted", 0)
+    operation, calls = flaky(*[AutoReconnect("down")] * 5)
+
+    with pytest.raises(AutoReconnect):
+        asyncio.run(server.retry_db_operation(operation, max_retries=3, initial_delay=0.001))
+    assert len(calls) == 3
+    assert server.db_retry_stats["exhausted"] == 1
+
+
+def test_backoff_is_capped_by_the_max_delay(monkeypatch):
+    monkeypatch.setattr(server, "DB_RETRY_MAX_DELAY", 0.01)
+    monkeypatch.setattr(server.random, "uniform", lambda low, high: high)
+    operation, calls = flaky(AutoReconnect("down"), AutoReconnect("down"))
+
+    asyncio.run(server.retry_db_operation(operation, max_retries=3, initial_delay=10))
+
+    assert calls[-1] - calls[0] < 1
+
+
+def test_never_sleeps_past_the_request_deadline(monkeypatch):
+    monkeypatch.setitem(server.db_retry_stats, "deadline_exceeded", 0)
+    monkeypatch.setattr(server.random, "uniform", lambda low, high: high)
+    operation, calls = flaky(AutoReconnect("down"))
+
+    async def within_request():
+        server.request_deadline.set(time.monotonic() + 0.05)
+        return await server.retry_db_operation(operation, max_retries=3, initial_delay=1)
+
+    started = time.monotonic()
+    with pytest.raises(AutoReconnect):
+        asyncio.run(within_request())
+
+    # The 1s backoff would overrun the 50ms deadline: fail now instead of sleeping
+    assert len(calls) == 1
+    assert time.monotonic() - started < 0.5
+    assert server.db_retry_stats["deadline_exceeded"] == 1
+
+
+def test_background_jobs_have_no_deadline():
+    operation, calls = flaky(AutoReconnect("down"))
+
+    async def outside_request():
+        assert server.request_deadline.get() is None
+        return await server.retry_db_operation(operation, max_retries=2, initial_delay=0.001)
+
+    assert asyncio.run(outside_request()) == "ok"
+    assert len(calls) == 2
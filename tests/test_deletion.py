@@ -0,0 +1,156 @@
+"""
+Cascade deletes: batched message removal, forks keeping their ancestors'
+history, progress reporting across both message layouts, and generated
+messages that land after the conversation was deleted.
+
+Runs against the in-memory database in memory_db.py. Needs the backend's
+dependencies installed (fastapi, motor, emergentintegrations).
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pytest
+from bson import ObjectId
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "deletion_tests")
+
+import server  # noqa: E402
+from tests.memory_db import MemoryDB  # noqa: E402
+
+DELETED_AT = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def memory_db(monkeypatch):
+    fake = MemoryDB()
+    monkeypatch.setattr(server, "db", fake)
+    monkeypatch.setenv("CASCADE_DELETE_PAUSE_SECONDS", "0")
+    server.deletion_jobs.clear()
+    return fake
+
+
+def add_messages(fake, conversation_id, count):
+    fake.messages.docs.extend(
+        {"_id": ObjectId(), "id": f"{conversation_id}-m-{i}", "conversation_id": conversation_id} for i in range(count)
+    )
+
+
+def add_bucket(fake, conversation_id, seq, count):
+    fake.message_buckets.docs.append({
+        "conversation_id": conversation_id, "seq": seq, "count": count,
+        "messages": [{"id": f"{conversation_id}-b{seq}-{i}"} for i in range(count)],
+    })
+
+
+def test_deletion_progress_counts_bucketed_messages(memory_db):
+    memory_db.conversations.docs.append({"id": "conv-1", "storage": "bucket", "deleted_at": DELETED_AT})
+    add_bucket(memory_db, "conv-1", 0, 200)
+    add_bucket(memory_db, "conv-1", 1, 12)
+
+    progress = asyncio.run(server.get_conversation_deletion("conv-1"))
+
+    assert progress["messages_remaining"] == 212
+
+
+def test_cascade_counts_bucketed_messages_it_deletes(memory_db):
+    memory_db.conversations.docs.append({"id": "conv-1", "storage": "bucket", "deleted_at": DELETED_AT})
+    add_bucket(memory_db, "conv-1", 0, 200)
+    add_bucket(memory_db, "conv-1", 1, 12)
+
+    asyncio.run(server.cascade_delete_conversation("conv-1"))
+
+    assert server.deletion_jobs["conv-1"]["messages_deleted"] == 212
+    assert memory_db.message_buckets.docs == []
+    assert memory_db.conversations.docs == []
+
+
+def test_cascade_removes_messages_in_batches(memory_db, monkeypatch):
+    monkeypatch.setenv("CASCADE_DELETE_BATCH_SIZE", "2")
+    memory_db.conversations.docs.append({"id": "conv-1", "deleted_at": DELETED_AT})
+    add_messages(memory_db, "conv-1", 5)
+    add_messages(memory_db, "conv-2", 1)
+
+    asyncio.run(server.cascade_delete_conversation("conv-1"))
+
+    assert server.deletion_jobs["conv-1"]["status"] == "completed"
+    assert server.deletion_jobs["conv-1"]["messages_deleted"] == 5
+    assert [msg["conversation_id"] for msg in memory_db.messages.docs] == ["conv-2"]
+    assert memory_db.conversations.docs == []
+
+
+def test_parent_keeps_its_messages_while_a_fork_exists(memory_db, monkeypatch):
+    scheduled = []
+    monkeypatch.setattr(server, "run_in_background", scheduled.append)
+    memory_db.conversations.docs.extend([
+        {"id": "parent", "deleted_at": DELETED_AT},
+        {"id": "fork", "fork_lineage": [{"conversation_id": "parent", "until": DELETED_AT}]},
+    ])
+    add_messages(memory_db, "parent", 3)
+    add_messages(memory_db, "fork", 2)
+
+    asyncio.run(server.cascade_delete_conversation("parent"))
+
+    # The fork still reads the parent's prefix, so nothing of the parent may go yet
+    assert server.deletion_jobs["parent"]["status"] == "retained_for_forks"
+    assert len(memory_db.messages.docs) == 5
+    parent = next(conv for conv in memory_db.conversations.docs if conv["id"] == "parent")
+    assert parent["deletion"]["status"] == "retained_for_forks"
+
+    # Deleting the last fork finishes the fork and then schedules the parent
+    memory_db.conversations.docs[1]["deleted_at"] = DELETED_AT
+
+    async def delete_fork_then_parent():
+        await server.cascade_delete_conversation("fork")
+        assert len(scheduled) == 1
+        await scheduled.pop()
+
+    asyncio.run(delete_fork_then_parent())
+
+    assert server.deletion_jobs["fork"]["messages_deleted"] == 2
+    assert server.deletion_jobs["parent"]["messages_deleted"] == 3
+    assert memory_db.messages.docs == [] and memory_db.conversations.docs == []
+
+
+def generated(content):
+    return server.Message(conversation_id="conv-1", persona_name="Ada", content=content)
+
+
+def test_flush_into_a_deleted_conversation_discards_what_it_wrote(memory_db):
+    memory_db.conversations.docs.append({"id": "conv-1", "user_id": "user-1"})
+    add_messages(memory_db, "conv-1", 1)
+
+    async def generate_while_deleted():
+        async with server.MessageWriteBatch("conv-1", owner_id="user-1") as batch:
+            batch.add(generated("first"))
+            batch.add(generated("second"))
+            memory_db.conversations.docs[0]["deleted_at"] = DELETED_AT  # Deleted mid-generation
+            await batch.flush()
+            assert batch.conversation_deleted
+            batch.add(generated("third"))  # Later rounds are dropped without writing
+        return batch
+
+    asyncio.run(generate_while_deleted())
+
+    assert [msg["id"] for msg in memory_db.messages.docs] == ["conv-1-m-0"]
+    assert "updated_at" not in memory_db.conversations.docs[0]
+
+
+def test_flush_into_a_live_conversation_keeps_its_messages(memory_db):
+    memory_db.conversations.docs.append({"id": "conv-1", "user_id": "user-1"})
+
+    async def generate():
+        async with server.MessageWriteBatch("conv-1", owner_id="user-1") as batch:
+            batch.add(generated("first"))
+            batch.add(generated("second"))
+        return batch
+
+    batch = asyncio.run(generate())
+
+    assert not batch.conversation_deleted
+    assert [msg["content"] for msg in memory_db.messages.docs] == ["first", "second"]
+    assert "updated_at" in memory_db.conversations.docs[0]
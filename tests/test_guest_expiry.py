@@ -0,0 +1,141 @@
+"""
+Guest conversation expiry and the admin maintenance endpoints that can
+trigger it by hand.
+
+Runs against the in-memory database in memory_db.py. Needs the backend's
+dependencies installed (fastapi, motor, emergentintegrations).
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+from bson import ObjectId
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "guest_expiry_tests")
+
+import server  # noqa: E402
+from tests.memory_db import MemoryDB  # noqa: E402
+
+NOW = datetime.now(timezone.utc)
+
+
+@pytest.fixture
+def memory_db(monkeypatch):
+    fake = MemoryDB()
+    monkeypatch.setattr(server, "db", fake)
+    monkeypatch.setenv("CASCADE_DELETE_PAUSE_SECONDS", "0")
+    server.deletion_jobs.clear()
+    fake.users.docs.append({"id": "registered"})
+    return fake
+
+
+def add_conversation(fake, conversation_id, user_id, idle_days, messages=2):
+    fake.conversations.docs.append({
+        "_id": ObjectId(), "id": conversation_id, "user_id": user_id, "updated_at": NOW - timedelta(days=idle_days),
+    })
+    fake.messages.docs.extend(
+        {"_id": ObjectId(), "id": f"{conversation_id}-m-{i}", "conversation_id": conversation_id} for i in range(messages)
+    )
+
+
+def remaining(fake):
+    return sorted(conv["id"] for conv in fake.conversations.docs)
+
+
+def test_only_idle_guest_conversations_expire(memory_db):
+    add_conversation(memory_db, "idle-guest", "guest-1", idle_days=40, messages=3)
+    add_conversation(memory_db, "active-guest", "guest-2", idle_days=1)
+    add_conversation(memory_db, "idle-user", "registered", idle_days=400)
+
+    result = asyncio.run(server.expire_guest_conversations(ttl_days=30))
+
+    assert result == {"conversations_expired": 1, "messages_deleted": 3}
+    assert remaining(memory_db) == ["active-guest", "idle-user"]
+    assert {msg["conversation_id"] for msg in memory_db.messages.docs} == {"active-guest", "idle-user"}
+
+
+def test_expiry_is_batched(memory_db):
+    for i in range(5):
+        add_conversation(memory_db, f"guest-{i}", f"guest-{i}", idle_days=40)
+
+    first = asyncio.run(server.expire_guest_conversations(ttl_days=30, limit=2))
+
+    assert first["conversations_expired"] == 2
+    assert len(memory_db.conversations.docs) == 3
+
+
+def test_guest_who_came_back_is_not_expired(memory_db):
+    add_conversation(memory_db, "returning", "guest-1", idle_days=40)
+    update_many = memory_db.conversations.update_many
+
+    async def guest_writes_first(query, update, **kwargs):
+        memory_db.conversations.docs[0]["updated_at"] = NOW
+        return await update_many(query, update, **kwargs)
+
+    memory_db.conversations.update_many = guest_writes_first
+
+    result = asyncio.run(server.expire_guest_conversations(ttl_days=30))
+
+    assert result["conversations_expired"] == 0
+    assert remaining(memory_db) == ["returning"]
+    assert "deleted_at" not in memory_db.conversations.docs[0]
+
+
+@pytest.fixture
+def admin_client(memory_db, monkeypatch):
+    monkeypatch.setattr(server, "ADMIN_API_KEY", "secret")
+    monkeypatch.setattr(server, "GUEST_CONVERSATION_TTL_DAYS", 30)
+    return TestClient(server.app)
+
+
+def test_admin_endpoints_are_hidden_without_a_configured_key(admin_client, monkeypatch):
+    monkeypatch.setattr(server, "ADMIN_API_KEY", None)
+
+    response = admin_client.post("/api/admin/expire-guests", json={}, headers={"X-Admin-Key": "secret"})
+
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize("headers", [{}, {"X-Admin-Key": "wrong"}])
+def test_admin_endpoints_need_the_key(admin_client, headers):
+    for path in ("/api/admin/expire-guests", "/api/admin/archive-inactive", "/api/admin/build-search-indexes"):
+        assert admin_client.post(path, json={}, headers=headers).status_code == 403
+
+
+def test_manual_expiry_runs_with_the_key(admin_client, memory_db):
+    add_conversation(memory_db, "idle-guest", "guest-1", idle_days=40)
+
+    response = admin_client.post("/api/admin/expire-guests", json={"limit": 10}, headers={"X-Admin-Key": "secret"})
+
+    assert response.status_code == 200
+    assert response.json() == {"conversations_expired": 1, "messages_deleted": 2, "ttl_days": 30}
+
+
+def test_manual_expiry_cannot_tighten_the_policy(admin_client, memory_db):
+    add_conversation(memory_db, "idle-guest", "guest-1", idle_days=10)
+
+    response = admin_client.post("/api/admin/expire-guests", json={"ttl_days": 7}, headers={"X-Admin-Key": "secret"})
+
+    assert response.status_code == 400
+    assert remaining(memory_db) == ["idle-guest"]
+
+
+def test_manual_expiry_is_refused_while_expiry_is_disabled(admin_client, monkeypatch):
+    monkeypatch.setattr(server, "GUEST_CONVERSATION_TTL_DAYS", 0)
+
+    response = admin_client.post("/api/admin/expire-guests", json={"ttl_days": 30}, headers={"X-Admin-Key": "secret"})
+
+    assert response.status_code == 409
+
+
+@pytest.mark.parametrize("body", [{"limit": server.ADMIN_MAX_BATCH + 1}, {"limit": 0}, {"ttl_days": 0}])
+def test_admin_batches_are_bounded(admin_client, body):
+    response = admin_client.post("/api/admin/expire-guests", json=body, headers={"X-Admin-Key": "secret"})
+
+    assert response.status_code == 422
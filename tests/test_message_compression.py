@@ -0,0 +1,35 @@
+"""Storage round trip of compressed message bodies (needs the backend's dependencies)"""
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "round_trip_tests")
+
+import server  # noqa: E402
+
+
+def test_long_bodies_round_trip(monkeypatch):
+    monkeypatch.setattr(server, "MESSAGE_COMPRESSION_ENABLED", True)
+    body = "Let me push back on that a little. " * 400
+    doc = {"id": "m-1", "content": body}
+
+    stored = server.deflate_message(doc)
+
+    assert stored["content_codec"] == server.MESSAGE_CODEC
+    assert len(stored["content"]) == server.MESSAGE_COMPRESSION_PREVIEW_CHARS
+    assert len(stored["content_compressed"]) < len(body)
+    assert doc["content"] == body  # The caller's document is left alone
+    assert server.inflate_message(stored) == {"id": "m-1", "content": body}
+
+
+def test_short_bodies_and_disabled_compression_are_untouched(monkeypatch):
+    monkeypatch.setattr(server, "MESSAGE_COMPRESSION_ENABLED", True)
+    short = {"id": "m-1", "content": "hi"}
+    assert server.deflate_message(short) is short
+
+    monkeypatch.setattr(server, "MESSAGE_COMPRESSION_ENABLED", False)
+    long = {"id": "m-2", "content": "x" * 100000}
+    assert server.deflate_message(long) is long
+    assert server.inflate_message(dict(long)) == long
@@ -0,0 +1,80 @@
+"""
+Message documents carry their conversation owner's user_id: stamped by
+store_messages on write and backfilled for older messages.
+
+Runs against the in-memory database in memory_db.py. Needs the backend's
+dependencies installed (fastapi, motor, emergentintegrations).
+"""
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "message_owner_tests")
+
+import server  # noqa: E402
+from tests.memory_db import MemoryDB  # noqa: E402
+
+
+@pytest.fixture
+def memory_db(monkeypatch):
+    fake = MemoryDB()
+    monkeypatch.setattr(server, "db", fake)
+    return fake
+
+
+def test_new_messages_carry_the_owner(memory_db):
+    asyncio.run(server.store_messages("conv-1", [{"id": "m-1", "conversation_id": "conv-1"}], None, "user-1"))
+
+    assert memory_db.messages.docs[0]["user_id"] == "user-1"
+
+
+def test_backfill_stamps_older_messages_and_resumes_from_its_checkpoint(memory_db):
+    memory_db.conversations.docs.extend([
+        {"_id": 1, "id": "conv-1", "user_id": "user-1"},
+        {"_id": 2, "id": "conv-2", "user_id": "guest-2"},
+        {"_id": 3, "id": "conv-3", "user_id": "user-3", "storage": "bucket"},
+    ])
+    memory_db.messages.docs.extend([
+        {"id": "m-1", "conversation_id": "conv-1"},
+        {"id": "m-2", "conversation_id": "conv-2"},
+        {"id": "m-3", "conversation_id": "conv-2", "user_id": "guest-2"},
+    ])
+
+    asyncio.run(server.backfill_message_owners(batch_size=1, pause_seconds=0))
+
+    assert [msg.get("user_id") for msg in memory_db.messages.docs] == ["user-1", "guest-2", "guest-2"]
+    checkpoint = memory_db.migrations.docs[0]
+    assert checkpoint["completed"]
+
+    # A finished backfill is not repeated
+    memory_db.messages.docs.append({"id": "m-4", "conversation_id": "conv-1"})
+    asyncio.run(server.backfill_message_owners(batch_size=1, pause_seconds=0))
+    assert "user_id" not in memory_db.messages.docs[-1]
+
+
+def test_message_reads_do_not_expose_the_owner(memory_db):
+    asyncio.run(server.store_messages("conv-1", [{"id": "m-1", "conversation_id": "conv-1", "timestamp": 1}], None, "user-1"))
+
+    messages = asyncio.run(server._read_messages("conv-1", 10, None, False, False))
+
+    assert "user_id" not in messages[0]
+
+
+def test_startup_builds_the_search_index_without_waiting_for_it(monkeypatch):
+    started = []
+
+    def run_in_background(coro):
+        started.append(coro.__name__)
+        coro.close()
+
+    monkeypatch.setattr(server, "run_in_background", run_in_background)
+    monkeypatch.delenv("SEARCH_INDEX_BUILD_ON_STARTUP", raising=False)
+
+    asyncio.run(server.start_background_jobs())
+
+    assert "build_search_indexes" in started
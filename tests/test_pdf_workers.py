@@ -0,0 +1,110 @@
+"""
+PDF worker processes: a document that hangs is killed on its own deadline
+without failing or slowing down the documents extracted next to it.
+Starts real worker processes; no database needed.
+"""
+import asyncio
+import os
+import sys
+import time
+from io import BytesIO
+from pathlib import Path
+
+import PyPDF2
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "pdf_worker_tests")
+
+import server  # noqa: E402
+
+STALL = b"stall"
+
+
+def stalling_worker_main(conn):
+    """Stands in for pdf_worker_main: hangs after the page count on STALL, answers one page otherwise"""
+    while True:
+        try:
+            pdf_bytes, max_pages = conn.recv()
+        except EOFError:
+            return
+        conn.send(("count", 1))
+        if pdf_bytes == STALL:
+            time.sleep(3600)
+        conn.send(("page", pdf_bytes.decode()))
+        conn.send(("done", None))
+
+
+def blank_pdf(pages):
+    writer = PyPDF2.PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=72, height=72)
+    out = BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+async def extract(pdf_bytes):
+    return [item async for item in server.stream_pdf_pages(pdf_bytes)]
+
+
+@pytest.fixture
+def pdf_workers(monkeypatch):
+    monkeypatch.setattr(server, "_pdf_worker_slots", None)
+    monkeypatch.setattr(server, "PDF_EXTRACT_WORKERS", 2)
+    monkeypatch.setitem(server.pdf_extract_stats, "timeouts", 0)
+    server.kill_pdf_workers()
+    yield server._idle_pdf_workers
+    server.kill_pdf_workers()
+
+
+def test_real_worker_extracts_and_is_reused(pdf_workers, monkeypatch):
+    monkeypatch.setattr(server, "PDF_MAX_PAGES", 2)
+
+    async def two_documents():
+        first = await extract(blank_pdf(3))
+        worker = pdf_workers[0]
+        second = await extract(blank_pdf(1))
+        return first, second, worker
+
+    first, second, worker = asyncio.run(two_documents())
+
+    assert first == [("count", 3), ("page", ""), ("page", "")]  # Capped at PDF_MAX_PAGES
+    assert second == [("count", 1), ("page", "")]
+    assert pdf_workers == [worker] and worker.process.is_alive()
+
+
+def test_bad_document_keeps_its_worker(pdf_workers):
+    with pytest.raises(ValueError):
+        asyncio.run(extract(b"not a pdf"))
+
+    assert len(pdf_workers) == 1 and pdf_workers[0].process.is_alive()
+
+
+def test_hung_document_times_out_alone(pdf_workers, monkeypatch):
+    monkeypatch.setattr(server, "pdf_worker_main", stalling_worker_main)
+    monkeypatch.setattr(server, "PDF_EXTRACT_TIMEOUT_SECONDS", 5)
+    started = []
+
+    def track(worker_class):
+        def create():
+            worker = worker_class()
+            started.append(worker)
+            return worker
+        return create
+
+    monkeypatch.setattr(server, "PdfWorker", track(server.PdfWorker))
+
+    async def side_by_side():
+        return await asyncio.gather(extract(STALL), extract(b"fine"), return_exceptions=True)
+
+    stalled, fine = asyncio.run(side_by_side())
+
+    assert isinstance(stalled, asyncio.TimeoutError)
+    assert fine == [("count", 1), ("page", "fine")]
+    assert server.pdf_extract_stats["timeouts"] == 1
+    # Only the stuck process was killed; the healthy one went back to the idle list
+    stuck = next(worker for worker in started if worker not in pdf_workers)
+    assert not stuck.process.is_alive()
+    assert len(pdf_workers) == 1 and pdf_workers[0].process.is_alive()
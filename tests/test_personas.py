@@ -0,0 +1,134 @@
+"""
+Persona writes and the in-process persona cache.
+
+Runs against the in-memory database in memory_db.py. Needs the backend's
+dependencies installed (fastapi, motor, emergentintegrations).
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "persona_tests")
+
+import server  # noqa: E402
+from tests.memory_db import MemoryDB  # noqa: E402
+
+CREATED_AT = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def memory_db(monkeypatch):
+    fake = MemoryDB()
+    monkeypatch.setattr(server, "db", fake)
+    server.persona_cache.invalidate()
+    fake.personas.docs.append({
+        "id": "p-1", "display_name": "Ada", "type": "historical", "bio": "Mathematician",
+        "quirks": [], "voice": {"tone": "precise", "pacing": "measured"},
+        "created_at": CREATED_AT, "version": 1,
+    })
+    return fake
+
+
+def test_put_and_patch_both_stamp_updated_at(memory_db):
+    asyncio.run(server.update_persona("p-1", server.PersonaCreate(display_name="Ada Lovelace")))
+    stored = memory_db.personas.docs[0]
+    assert (stored["version"], stored["created_at"]) == (2, CREATED_AT)
+    put_at = stored["updated_at"]
+
+    asyncio.run(server.patch_persona("p-1", server.PersonaPatch(bio="Analyst")))
+    stored = memory_db.personas.docs[0]
+    assert stored["version"] == 3
+    assert stored["updated_at"] >= put_at
+
+
+def count_reads(fake, before_read=None):
+    """Count persona reads, optionally running before_read while each one is in flight"""
+    reads = []
+    find = fake.personas.find
+
+    def counting_find(*args, **kwargs):
+        cursor = find(*args, **kwargs)
+        to_list = cursor.to_list
+
+        async def read(length=None):
+            reads.append(args[0])
+            docs = await to_list(length)
+            if before_read:
+                before_read()
+            return docs
+
+        cursor.to_list = read
+        return cursor
+
+    fake.personas.find = counting_find
+    return reads
+
+
+def test_cache_serves_repeat_reads_without_the_database(memory_db):
+    cache = server.PersonaCache()
+    reads = count_reads(memory_db)
+
+    first = asyncio.run(cache.get("p-1"))
+    first["bio"] = "mutated by a caller"
+    second = asyncio.run(cache.get("p-1"))
+
+    assert len(reads) == 1
+    assert second["bio"] == "Mathematician"  # Callers get copies, not the cached document
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_invalidation_drops_the_cached_persona(memory_db):
+    cache = server.PersonaCache()
+    reads = count_reads(memory_db)
+    asyncio.run(cache.get("p-1"))
+
+    memory_db.personas.docs[0]["bio"] = "Analyst"
+    cache.invalidate("p-1")
+
+    assert asyncio.run(cache.get("p-1"))["bio"] == "Analyst"
+    assert len(reads) == 2
+
+
+def test_read_racing_an_invalidation_is_served_but_not_cached(memory_db):
+    cache = server.PersonaCache()
+
+    def edit_during_read():
+        memory_db.personas.docs[0]["bio"] = "Analyst"
+        cache.invalidate("p-1")
+
+    reads = count_reads(memory_db, before_read=edit_during_read)
+    assert asyncio.run(cache.get("p-1"))["bio"] == "Mathematician"
+
+    # The version moved while the read was in flight, so the old document was not kept
+    assert cache.stats()["entries"] == 0
+    assert asyncio.run(cache.get("p-1"))["bio"] == "Analyst"
+    assert len(reads) == 2
+
+
+def test_entries_expire_after_the_ttl(memory_db, monkeypatch):
+    cache = server.PersonaCache(ttl_seconds=60)
+    reads = count_reads(memory_db)
+    now = server.time.monotonic()
+    monkeypatch.setattr(server.time, "monotonic", lambda: now)
+    asyncio.run(cache.get("p-1"))
+
+    monkeypatch.setattr(server.time, "monotonic", lambda: now + 61)
+    asyncio.run(cache.get("p-1"))
+
+    assert len(reads) == 2
+
+
+def test_patch_invalidates_the_shared_cache(memory_db):
+    asyncio.run(server.persona_cache.get("p-1"))
+    version = server.persona_cache.version
+
+    asyncio.run(server.patch_persona("p-1", server.PersonaPatch(bio="Analyst")))
+
+    assert server.persona_cache.version > version
+    assert asyncio.run(server.persona_cache.get("p-1"))["bio"] == "Analyst"
@@ -0,0 +1,409 @@
+"""
+Round-trip budgets for the hot message and conversation handlers.
+
+The handlers run against a recording stand-in for the Motor database so
+every call that would hit Mongo is counted. Needs the backend's
+dependencies installed (fastapi, motor, emergentintegrations).
+"""
+import asyncio
+import json
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "round_trip_tests")
+
+import server  # noqa: E402
+
+
+class RecordingCursor:
+    def __init__(self, log, name, result):
+        self.log = log
+        self.name = name
+        self.result = result
+
+    def sort(self, *args, **kwargs):
+        return self
+
+    def skip(self, *args, **kwargs):
+        return self
+
+    def limit(self, *args, **kwargs):
+        return self
+
+    def max_time_ms(self, *args, **kwargs):
+        return self
+
+    async def to_list(self, length=None):
+        self.log.append((self.name, "find"))
+        return list(self.result or [])
+
+
+class RecordingCollection:
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def with_options(self, **kwargs):
+        return self
+
+    def find(self, *args, **kwargs):
+        return RecordingCursor(self.db.log, self.name, self.db.results.get((self.name, "find")))
+
+    def __getattr__(self, method):
+        async def call(*args, **kwargs):
+            self.db.log.append((self.name, method))
+            return self.db.results.get((self.name, method))
+        return call
+
+
+class RecordingDB:
+    """Counts every database call a handler makes, keyed by (collection, method)"""
+
+    def __init__(self, results=None):
+        self.log = []
+        self.results = results or {}
+
+    def __getitem__(self, name):
+        return RecordingCollection(self, name)
+
+    def __getattr__(self, name):
+        return RecordingCollection(self, name)
+
+
+class BulkResult:
+    matched_count = 2
+    modified_count = 2
+
+
+CONVERSATION = {
+    "id": "conv-1",
+    "user_id": "user-1",
+    "title": "New Conversation",
+    "mode": "Creativity Collaboration",
+    "active_personas": [],
+}
+
+
+def message(message_id, second):
+    return {
+        "id": message_id,
+        "conversation_id": "conv-1",
+        "persona_name": "User",
+        "content": "hello",
+        "timestamp": datetime(2026, 1, 1, 0, 0, second, tzinfo=timezone.utc),
+    }
+
+
+@pytest.fixture
+def recording_db(monkeypatch):
+    def install(results=None):
+        fake = RecordingDB(results)
+        monkeypatch.setattr(server, "db", fake)
+        server.persona_cache.invalidate()
+        return fake
+    return install
+
+
+def test_create_user_message_takes_two_round_trips(recording_db):
+    fake = recording_db({("conversations", "find_one_and_update"): dict(CONVERSATION)})
+
+    asyncio.run(server.create_message("conv-1", server.MessageCreate(content="hello", is_user=True)))
+
+    assert fake.log == [("conversations", "find_one_and_update"), ("messages", "insert_one")]
+
+
+def test_create_persona_message_looks_up_persona_alongside_conversation(recording_db):
+    fake = recording_db({
+        ("conversations", "find_one_and_update"): dict(CONVERSATION),
+        ("personas", "find"): [{"id": "p-1", "display_name": "Ada"}],
+    })
+
+    msg = asyncio.run(server.create_message("conv-1", server.MessageCreate(content="hi", persona_id="p-1")))
+
+    assert msg.persona_name == "Ada"
+    assert sorted(fake.log[:2]) == [("conversations", "find_one_and_update"), ("personas", "find")]
+    assert fake.log[2:] == [("messages", "insert_one")]
+
+
+def test_create_message_missing_conversation_skips_insert(recording_db):
+    fake = recording_db()
+
+    with pytest.raises(server.HTTPException) as exc:
+        asyncio.run(server.create_message("missing", server.MessageCreate(content="hello", is_user=True)))
+
+    assert exc.value.status_code == 404
+    assert fake.log == [("conversations", "find_one_and_update")]
+
+
+def test_update_conversation_takes_one_round_trip(recording_db):
+    fake = recording_db({("conversations", "find_one_and_update"): dict(CONVERSATION, mode="Unhinged")})
+
+    conv = asyncio.run(server.update_conversation("conv-1", {"mode": "Unhinged"}))
+
+    assert conv["mode"] == "Unhinged"
+    assert fake.log == [("conversations", "find_one_and_update")]
+
+
+def test_get_messages_reads_conversation_and_messages_concurrently(recording_db):
+    fake = recording_db({
+        ("conversations", "find_one"): {"id": "conv-1"},
+        ("messages", "find"): [message("m-1", 1)],
+    })
+
+    asyncio.run(server.get_messages("conv-1"))
+
+    assert sorted(fake.log) == [("conversations", "find_one"), ("messages", "find")]
+
+
+def test_bucketed_page_is_one_document_read(recording_db, monkeypatch):
+    monkeypatch.setattr(server, "MESSAGE_STORAGE_MODE", "bucket")
+    fake = recording_db({
+        ("conversations", "find_one"): {"id": "conv-1", "storage": "bucket"},
+        ("message_buckets", "find"): [
+            {"messages": [message("m-2", 2), message("m-1", 1)]},
+        ],
+    })
+
+    messages = json.loads(asyncio.run(server.get_messages("conv-1")).body)
+
+    assert [msg["id"] for msg in messages] == ["m-1", "m-2"]
+    assert sorted(fake.log) == [("conversations", "find_one"), ("message_buckets", "find")]
+
+
+def test_fork_is_a_single_insert(recording_db):
+    fake = recording_db({
+        ("conversations", "find_one"): dict(CONVERSATION, title="Autorun"),
+        ("messages", "find_one"): {"conversation_id": "conv-1", "timestamp": server.datetime.now(server.timezone.utc)},
+    })
+
+    fork = asyncio.run(server.fork_conversation("conv-1", server.ConversationFork(message_id="m-42", mode="Unhinged")))
+
+    assert (fork.parent_id, fork.mode) == ("conv-1", "Unhinged")
+    assert sorted(fake.log) == [
+        ("conversations", "find_one"),
+        ("conversations", "insert_one"),
+        ("message_buckets", "find_one"),
+        ("messages", "find_one"),
+    ]
+
+
+def test_fork_reads_inherited_prefix_then_own_messages(recording_db):
+    fake = recording_db({
+        ("conversations", "find_one"): {"id": "fork-1", "fork_lineage": [{"conversation_id": "conv-1", "until": 5}]},
+        ("conversations", "find"): [{"id": "conv-1"}],
+        ("messages", "find"): [message("m-1", 1)],
+    })
+
+    messages = json.loads(asyncio.run(server.get_messages("fork-1")).body)
+
+    assert len(messages) == 2  # Parent prefix followed by the fork's own page
+    assert sorted(fake.log) == [
+        ("conversations", "find"),
+        ("conversations", "find_one"),
+        ("messages", "find"),
+        ("messages", "find"),
+    ]
+
+
+def test_fork_reads_keep_the_newest_messages(recording_db, monkeypatch):
+    recording_db({
+        ("conversations", "find_one"): {"id": "fork-1", "fork_lineage": [{"conversation_id": "conv-1", "until": 5}]},
+        ("conversations", "find"): [{"id": "conv-1"}],
+    })
+    segments = {
+        "conv-1": [message(f"p-{second}", second) for second in range(1, 6)],
+        "fork-1": [message(f"f-{second}", second) for second in range(10, 13)],
+    }
+
+    async def read(conversation_id, limit, endpoint, fresh, bucketed, until=None, newest=False):
+        segment = segments[conversation_id]
+        return segment[-limit:] if newest else segment[:limit]
+
+    monkeypatch.setattr(server, "_read_messages", read)
+
+    messages = asyncio.run(server.fetch_messages("fork-1", 4))
+
+    assert [msg["id"] for msg in messages] == ["p-5", "f-10", "f-11", "f-12"]
+
+
+def test_create_message_in_bucketed_conversation_pushes_once(recording_db):
+    fake = recording_db({
+        ("conversations", "find_one_and_update"): dict(CONVERSATION, storage="bucket"),
+        ("message_buckets", "find_one_and_update"): {"_id": 1},
+    })
+
+    asyncio.run(server.create_message("conv-1", server.MessageCreate(content="hello", is_user=True)))
+
+    assert fake.log == [("conversations", "find_one_and_update"), ("message_buckets", "find_one_and_update")]
+
+
+def test_concurrent_identical_reads_share_one_query(recording_db):
+    fake = recording_db({
+        ("conversations", "find_one"): {"id": "conv-1"},
+        ("messages", "find"): [message("m-1", 1)],
+    })
+
+    async def reload_together():
+        return await asyncio.gather(*[server.get_messages("conv-1") for _ in range(5)])
+
+    responses = asyncio.run(reload_together())
+
+    assert len({response.body for response in responses}) == 1
+    assert sorted(fake.log) == [("conversations", "find_one"), ("messages", "find")]
+
+
+def test_patch_persona_takes_one_round_trip(recording_db):
+    fake = recording_db({("personas", "find_one_and_update"): {"id": "p-1", "display_name": "Ada"}})
+
+    asyncio.run(server.patch_persona("p-1", server.PersonaPatch(bio="Mathematician")))
+
+    assert fake.log == [("personas", "find_one_and_update")]
+
+
+def test_reorder_personas_takes_one_round_trip(recording_db):
+    fake = recording_db({("personas", "bulk_write"): BulkResult()})
+
+    orders = [server.PersonaOrder(id="p-1", sort_order=0), server.PersonaOrder(id="p-2", sort_order=1)]
+    asyncio.run(server.reorder_personas(server.PersonaReorderRequest(orders=orders)))
+
+    assert fake.log == [("personas", "bulk_write")]
+
+
+def test_search_without_owner_is_refused_before_any_query(recording_db, monkeypatch):
+    monkeypatch.delenv("ALLOW_UNSCOPED_CONVERSATION_LISTING", raising=False)
+    fake = recording_db()
+
+    with pytest.raises(server.HTTPException) as exc:
+        asyncio.run(server.search_conversations(q="dragons", user_id="undefined"))
+
+    assert exc.value.status_code == 400
+    assert fake.log == []
+
+
+def test_scoped_search_checks_only_the_page_for_tombstones(recording_db, monkeypatch):
+    monkeypatch.setitem(server.search_index_build, "status", "ready")
+    fake = recording_db({
+        ("messages", "find"): [
+            dict(message("m-1", 1), score=2.0),
+            dict(message("m-2", 2), conversation_id="conv-gone", score=1.0),
+        ],
+        ("conversations", "find"): [{"id": "conv-gone"}],
+    })
+
+    result = asyncio.run(server.search_conversations(q="hello", user_id="user-1", page=2))
+
+    assert [hit["message_id"] for hit in result["messages"]] == ["m-1"]
+    # No listing of the owner's conversations or of every tombstone before the search
+    assert fake.log == [("messages", "find"), ("conversations", "find")]
+
+
+def test_search_waits_for_the_index_build(recording_db, monkeypatch):
+    monkeypatch.setitem(server.search_index_build, "status", "building")
+    fake = recording_db()
+
+    with pytest.raises(server.HTTPException) as exc:
+        asyncio.run(server.search_conversations(q="hello", user_id="user-1"))
+
+    assert exc.value.status_code == 503
+    assert fake.log == []
+
+
+def test_first_search_page_reports_conversations_outside_the_index(recording_db, monkeypatch):
+    monkeypatch.setitem(server.search_index_build, "status", "ready")
+    recording_db({
+        ("messages", "find"): [dict(message("m-1", 1), score=1.0)],
+        ("conversations", "count_documents"): 2,
+    })
+
+    result = asyncio.run(server.search_conversations(q="hello", user_id="user-1"))
+
+    assert result["not_searched"] == {"bucketed_conversations": 2, "archived_conversations": 2}
+
+
+def test_reorder_reports_unknown_persona_ids(recording_db):
+    fake = recording_db({
+        ("personas", "bulk_write"): BulkResult(),
+        ("personas", "find"): [{"id": "p-1"}, {"id": "p-2"}],
+    })
+
+    orders = [server.PersonaOrder(id=f"p-{i}", sort_order=i) for i in (1, 2, 3)]
+    result = asyncio.run(server.reorder_personas(server.PersonaReorderRequest(orders=orders)))
+
+    assert (result["success"], result["missing"]) == (False, ["p-3"])
+    assert fake.log == [("personas", "bulk_write"), ("personas", "find")]
+
+
+def test_atomic_reorder_without_a_replica_set_is_a_clear_error(recording_db, monkeypatch):
+    recording_db()
+
+    class StandaloneClient:
+        async def start_session(self):
+            raise server.OperationFailure("Transaction numbers are only allowed on a replica set member or mongos", 20)
+
+    monkeypatch.setattr(server, "client", StandaloneClient())
+
+    orders = [server.PersonaOrder(id="p-1", sort_order=0)]
+    with pytest.raises(server.HTTPException) as exc:
+        asyncio.run(server.reorder_personas(server.PersonaReorderRequest(orders=orders, atomic=True)))
+
+    assert exc.value.status_code == 501
+
+
+def generated(content):
+    return server.Message(conversation_id="conv-1", persona_name="Ada", content=content)
+
+
+def test_generated_messages_are_one_insert_and_one_touch(recording_db):
+    fake = recording_db({("conversations", "find_one"): {"_id": 1}})
+
+    async def generate():
+        async with server.MessageWriteBatch("conv-1", owner_id="user-1") as batch:
+            for content in ("one", "two", "three"):
+                batch.add(generated(content))
+            batch.touch(title="Dragons")
+            batch.touch(mode="Unhinged")
+
+    asyncio.run(generate())
+
+    # The find_one is the tombstone re-check after the insert
+    assert fake.log == [("messages", "insert_many"), ("conversations", "find_one"), ("conversations", "update_one")]
+
+
+def test_flush_between_rounds_writes_each_round_once(recording_db):
+    fake = recording_db({("conversations", "find_one"): {"_id": 1}})
+
+    async def two_rounds():
+        async with server.MessageWriteBatch("conv-1") as batch:
+            batch.add(generated("round one"))
+            await batch.flush()
+            await batch.flush()  # Nothing new buffered: no round trip
+            batch.add(generated("round two"))
+
+    asyncio.run(two_rounds())
+
+    assert fake.log == [
+        ("messages", "insert_one"), ("conversations", "find_one"),
+        ("messages", "insert_one"), ("conversations", "find_one"),
+        ("conversations", "update_one"),
+    ]
+
+
+def test_shutdown_flushes_open_batches_once(recording_db):
+    fake = recording_db({("conversations", "find_one"): {"_id": 1}})
+
+    async def interrupted():
+        batch = await server.MessageWriteBatch("conv-1").__aenter__()
+        batch.add(generated("unsaved"))
+        await server.MessageWriteBatch.flush_all()
+        await batch.__aexit__(None, None, None)  # The handler's own exit finds it already closed
+
+    asyncio.run(interrupted())
+
+    assert fake.log == [("messages", "insert_one"), ("conversations", "find_one"), ("conversations", "update_one")]
+    assert not server.MessageWriteBatch.open_batches
@@ -0,0 +1,65 @@
+"""URL extraction cache: key normalisation, in-flight dedupe and conditional revalidation"""
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "round_trip_tests")
+
+import server  # noqa: E402
+
+PAGE = b"<html><head><title>Hello</title></head><body><p>Some  article text</p><script>x()</script></body></html>"
+
+
+@pytest.fixture
+def fake_fetch(monkeypatch):
+    server.url_cache.clear()
+    calls = []
+
+    async def fetch(url, max_bytes=server.URL_FETCH_MAX_BYTES, headers=None):
+        calls.append(headers)
+        await asyncio.sleep(0.01)
+        not_modified = bool(headers and headers.get("If-None-Match") == '"v1"')
+        return {
+            "url": url,
+            "content": b"" if not_modified else PAGE,
+            "content_type": "text/html",
+            "encoding": "utf-8",
+            "truncated": False,
+            "etag": '"v1"',
+            "last_modified": None,
+            "not_modified": not_modified,
+        }
+
+    monkeypatch.setattr(server, "fetch_url", fetch)
+    return calls
+
+
+def test_normalize_url_drops_noise():
+    assert server.normalize_url("HTTPS://Example.COM:443/a?utm_source=x&b=2#top") == "https://example.com/a?b=2"
+    assert server.normalize_url("http://example.com") == "http://example.com/"
+
+
+def test_concurrent_requests_share_one_fetch(fake_fetch):
+    async def attach_everywhere():
+        return await asyncio.gather(*[server.get_url_extract("https://example.com/a#x") for _ in range(5)])
+
+    pages = asyncio.run(attach_everywhere())
+
+    assert len(fake_fetch) == 1
+    assert {page["title"] for page in pages} == {"Hello"}
+    assert "x()" not in pages[0]["text"]
+
+
+def test_expired_entry_is_revalidated_conditionally(fake_fetch, monkeypatch):
+    asyncio.run(server.get_url_extract("https://example.com/a"))
+    monkeypatch.setattr(server, "URL_CACHE_TTL_SECONDS", 0)
+
+    page = asyncio.run(server.get_url_extract("https://example.com/a"))
+
+    assert fake_fetch[1] == {"If-None-Match": '"v1"'}
+    assert page["title"] == "Hello"
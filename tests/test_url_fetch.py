@@ -0,0 +1,96 @@
+"""Streaming URL fetch: byte cap, content-type rejection and conditional requests"""
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import httpx
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "round_trip_tests")
+
+import server  # noqa: E402
+
+
+class CountingBody(httpx.AsyncByteStream):
+    """A response body that records how many chunks the client pulled"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.sent = 0
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            self.sent += 1
+            yield chunk
+
+
+@pytest.fixture
+def serve(monkeypatch):
+    """Point the shared client at a handler instead of the network"""
+    def install(handler):
+        monkeypatch.setattr(server, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return install
+
+
+def test_body_is_cut_at_max_bytes(serve):
+    body = CountingBody([b"x" * 1000] * 100)
+    serve(lambda request: httpx.Response(200, headers={"content-type": "text/html"}, stream=body))
+
+    page = asyncio.run(server.fetch_url("https://example.com/big", max_bytes=2500))
+
+    assert len(page["content"]) == 2500
+    assert page["truncated"]
+    assert body.sent == 3  # Stopped reading instead of downloading the whole body
+
+
+def test_short_body_is_not_truncated(serve):
+    serve(lambda request: httpx.Response(200, headers={"content-type": "text/html; charset=utf-8"}, content=b"<p>hi</p>"))
+
+    page = asyncio.run(server.fetch_url("https://example.com/small", max_bytes=2500))
+
+    assert (page["content"], page["truncated"]) == (b"<p>hi</p>", False)
+    assert (page["content_type"], page["encoding"]) == ("text/html", "utf-8")
+
+
+@pytest.mark.parametrize("content_type", ["application/pdf", "image/png", "application/octet-stream"])
+def test_non_text_responses_are_rejected_before_the_body_is_read(serve, monkeypatch, content_type):
+    monkeypatch.setitem(server.url_fetch_stats, "rejected_content_type", 0)
+    body = CountingBody([b"%PDF-1.7"] * 10)
+    serve(lambda request: httpx.Response(200, headers={"content-type": content_type}, stream=body))
+
+    with pytest.raises(server.UnsupportedContentType):
+        asyncio.run(server.fetch_url("https://example.com/file"))
+
+    assert body.sent == 0
+    assert server.url_fetch_stats["rejected_content_type"] == 1
+
+
+@pytest.mark.parametrize("content_type", ["text/plain", "application/xhtml+xml", ""])
+def test_text_and_unlabelled_responses_are_read(serve, content_type):
+    headers = {"content-type": content_type} if content_type else {}
+    serve(lambda request: httpx.Response(200, headers=headers, content=b"hello"))
+
+    assert asyncio.run(server.fetch_url("https://example.com/page"))["content"] == b"hello"
+
+
+def test_not_modified_returns_validators_without_content(serve):
+    def handler(request):
+        assert request.headers["if-none-match"] == '"v1"'
+        return httpx.Response(304, headers={"etag": '"v1"'})
+
+    serve(handler)
+
+    page = asyncio.run(server.fetch_url("https://example.com/page", headers={"If-None-Match": '"v1"'}))
+
+    assert page["not_modified"] and page["content"] == b""
+    assert page["etag"] == '"v1"'
+
+
+def test_error_status_raises(serve):
+    serve(lambda request: httpx.Response(404, headers={"content-type": "text/html"}))
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(server.fetch_url("https://example.com/missing"))
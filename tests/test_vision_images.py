@@ -0,0 +1,159 @@
+"""
+Image normalisation before vision calls: downscaling, metadata stripping
+and the content-hash cache.
+
+Needs the backend's dependencies installed (fastapi, motor, Pillow,
+emergentintegrations); no database is touched.
+"""
+import asyncio
+import base64
+import os
+import sys
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "vision_image_tests")
+
+import server  # noqa: E402
+
+
+def photo(size=(4000, 3000), orientation=None) -> str:
+    exif = Image.Exif()
+    exif[0x010F] = "Camera Maker"
+    if orientation:
+        exif[0x0112] = orientation
+    out = BytesIO()
+    Image.new("RGB", size, (120, 40, 200)).save(out, "JPEG", quality=95, exif=exif.tobytes())
+    return "data:image/jpeg;base64," + base64.b64encode(out.getvalue()).decode()
+
+
+@pytest.fixture(autouse=True)
+def in_thread(monkeypatch):
+    # Same code path without spawning worker processes
+    monkeypatch.setattr(server, "EXTRACTION_WORKERS", 0)
+    server.vision_image_cache.clear()
+    server.vision_image_stats["cache_bytes"] = 0
+
+
+def decoded(encoded: str) -> Image.Image:
+    return Image.open(BytesIO(base64.b64decode(encoded)))
+
+
+def test_large_photo_is_downscaled_and_stripped():
+    image = decoded(asyncio.run(server.vision_image_base64({"type": "image", "data": photo()})))
+
+    assert (image.format, image.size) == ("JPEG", (1024, 768))
+    assert not image.getexif()
+
+
+def test_orientation_is_applied_before_exif_is_dropped():
+    image = decoded(asyncio.run(server.vision_image_base64({"type": "image", "data": photo(orientation=6)})))
+
+    assert image.size == (768, 1024)
+
+
+def test_same_image_is_normalised_once():
+    before = dict(server.vision_image_stats)
+    data = photo()
+
+    async def twice():
+        first = await server.vision_image_base64({"type": "image", "data": data})
+        return first, await server.vision_image_base64({"type": "image", "data": data})
+
+    first, second = asyncio.run(twice())
+
+    assert first == second
+    assert server.vision_image_stats["normalized"] == before["normalized"] + 1
+    assert server.vision_image_stats["cache_hits"] == before["cache_hits"] + 1
+
+
+def test_unreadable_image_is_passed_through():
+    raw = base64.b64encode(b"not really an image").decode()
+
+    assert asyncio.run(server.vision_image_base64({"type": "image", "data": raw})) == raw
+
+
+def test_formats_the_model_does_not_take_are_converted_even_when_normalising_is_off(monkeypatch):
+    monkeypatch.setattr(server, "VISION_IMAGE_NORMALIZE", False)
+    out = BytesIO()
+    Image.new("RGB", (64, 48), (10, 200, 30)).save(out, "BMP")
+    data = "data:image/bmp;base64," + base64.b64encode(out.getvalue()).decode()
+
+    image = decoded(asyncio.run(server.vision_image_base64({"type": "image", "data": data})))
+
+    assert (image.format, image.size) == ("JPEG", (64, 48))
+
+
+def test_unreadable_image_in_a_format_the_model_does_not_take_fails_the_attachment():
+    data = "data:image/heic;base64," + base64.b64encode(b"not really an image").decode()
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(server.vision_image_base64({"type": "image", "data": data}))
+
+
+class FakeDescriptions:
+    def __init__(self):
+        self.docs = {}
+
+    async def find_one(self, query, projection=None):
+        return self.docs.get(query["_id"])
+
+    async def replace_one(self, query, doc, upsert=False):
+        self.docs[query["_id"]] = doc
+
+
+class FakeDB:
+    def __init__(self):
+        self.image_descriptions = FakeDescriptions()
+
+
+@pytest.fixture
+def vision_calls(monkeypatch):
+    calls = []
+
+    class FakeChat:
+        def __init__(self, **kwargs):
+            pass
+
+        def with_model(self, provider, model):
+            self.model = model
+            return self
+
+        async def send_message(self, message):
+            calls.append(self.model)
+            await asyncio.sleep(0.01)
+            return "SUMMARY: A purple rectangle."
+
+    monkeypatch.setattr(server, "LlmChat", FakeChat)
+    monkeypatch.setattr(server, "db", FakeDB())
+    return calls
+
+
+def test_prepass_describes_an_image_once_for_every_persona(vision_calls):
+    data = photo()
+
+    async def personas_arrive_together():
+        return await asyncio.gather(*[server.prepare_image({"type": "image", "data": data}, True) for _ in range(5)])
+
+    results = asyncio.run(personas_arrive_together())
+    again = asyncio.run(server.prepare_image({"type": "image", "data": data}, True))
+
+    assert vision_calls == [server.VISION_PREPASS_MODEL]
+    assert {description for _, description in results + [again]} == {"SUMMARY: A purple rectangle."}
+
+
+def test_failed_prepass_falls_back_to_sending_the_image(vision_calls, monkeypatch):
+    async def broken(key, base64_data):
+        raise RuntimeError("vision model unavailable")
+
+    monkeypatch.setattr(server, "_load_image_description", broken)
+
+    base64_data, description = asyncio.run(server.prepare_image({"type": "image", "data": photo()}, True))
+
+    assert description is None
+    assert base64_data